@@ -0,0 +1,372 @@
+#! /usr/bin/env python
+#
+#  Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Performance benchmarks for the config parser and the rules
+
+    ./bench.py                          print a table of timings
+    ./bench.py -o results.json          also save them as JSON
+    ./bench.py -c results.json          compare with saved results
+    ./bench.py -s servers -b parse      run only some of the benchmarks
+    ./bench.py -m 100000                measure the memory used by configs
+    ./bench.py --startup                check the start up time of the CLI
+    ./bench.py --fleet 100000           time queries on a fleet index
+"""
+
+import os
+import sys
+import time
+import json
+import platform
+import subprocess
+import py_compile
+
+from StringIO import StringIO
+from optparse import OptionParser
+
+import zoocfg
+from zoocfg import ZooCfg, CompactZooCfg, Rules, RuleRegistry, RulesResult
+
+SCENARIOS = (
+    ('small', dict(keys=0, servers=3)),
+    ('keys', dict(keys=5000, servers=3)),
+    ('servers', dict(keys=0, servers=255)),
+    ('comments', dict(keys=500, servers=3, comments=5)),
+    ('broken', dict(keys=500, servers=3, broken=0.3)),
+)
+
+def generate_config(keys=0, servers=0, comments=0, broken=0.0, observers=0.1):
+    """ Generate a synthetic config file. `keys` extra keys are added to
+    a typical config, `comments` comment lines are added before each 
+    line and a fraction `broken` of the extra lines have no separator. """
+    lines = [
+        'tickTime=2000',
+        'initLimit=10',
+        'syncLimit=5',
+        'dataDir=/var/zookeeper/data',
+        'dataLogDir=/var/zookeeper/log',
+        'clientPort=2181',
+    ]
+    for i in range(keys):
+        if broken and i % int(1 / broken) == 0:
+            lines.append('broken-line-%d' % i)
+        elif i % 2:
+            lines.append('key%d = value-%d # trailing comment' % (i, i))
+        else:
+            lines.append('key%d=%d' % (i, i))
+
+    for i in range(1, servers + 1):
+        suffix = ':observer' if observers and i % int(1 / observers) == 0 else ''
+        lines.append('server.%d=zoo%d.example.com:2888:3888%s' % (i, i, suffix))
+
+    if comments:
+        result = []
+        for line in lines:
+            result.extend('# comment line %d' % i for i in range(comments))
+            result.append(line)
+        lines = result
+
+    return '\n'.join(lines) + '\n'
+
+def legacy_parse(content):
+    """ The readlines() based parser replaced by zoocfg.tokenize """
+    result = {}
+    for line in StringIO(content).readlines():
+        try:
+            line = line[:line.index('#')]
+        except ValueError:
+            pass
+
+        if not line.strip():
+            continue
+
+        try:
+            key, value = map(str.strip, line.split('='))
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                pass
+            result[key] = value
+        except ValueError:
+            pass
+    return result
+
+def legacy_check_all(cfg):
+    """ The Rules.__dict__ scan replaced by the rule registry """
+    warnings, errors = [], []
+    for name, ref in Rules.__dict__.items():
+        try:
+            if hasattr(ref, 'mro') and Rules.BaseRule in ref.mro() and ref != Rules.BaseRule:
+                w, e = ref.check(cfg)
+                warnings.extend(w)
+                errors.extend(e)
+        except Exception, e:
+            errors.append('`%s` rule check failed: %s' % (name, e))
+    return RulesResult(warnings, errors)
+
+def measure(fn, min_time=0.05, repeat=5):
+    """ Return the best time in seconds of a single call of `fn` """
+    number, elapsed = 1, 0
+    while True: # calibrate the number of calls per measurement
+        start = time.time()
+        for _ in xrange(number):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in xrange(number):
+            fn()
+        best = min(best, time.time() - start)
+    return best / number
+
+def benchmarks(content, legacy=False):
+    """ Return a list of (name, function) pairs for a config content """
+    cfg = ZooCfg(content)
+
+    def get_servers():
+        cfg._server_table = None
+        cfg.get_servers()
+
+    result = [
+        ('parse', lambda: ZooCfg()._parse(content, set(), {})),
+        ('get_servers', get_servers),
+        ('check_all', lambda: Rules.check_all(ZooCfg(content))),
+    ]
+    for id, check in RuleRegistry.table:
+        result.append(('rule.%s' % id, lambda check=check: check(cfg)))
+
+    if legacy:
+        result.append(('legacy.parse', lambda: legacy_parse(content)))
+        result.append(('legacy.check_all', lambda: legacy_check_all(ZooCfg(content))))
+    return result
+
+def run(scenarios=None, names=None, legacy=False, min_time=0.05):
+    """ Run the benchmarks. Returns a dict of `scenario/name` to seconds """
+    results = {}
+    for scenario, kwargs in SCENARIOS:
+        if scenarios and scenario not in scenarios:
+            continue
+
+        content = generate_config(**kwargs)
+        for name, fn in benchmarks(content, legacy):
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            results['%s/%s' % (scenario, name)] = measure(fn, min_time)
+    return results
+
+def resident_memory():
+    """ Resident set size of the current process in bytes """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def measure_memory(cls_name, count):
+    """ Bytes used by `count` parsed configs and their server tables.
+    Runs in a fresh process so that measurements do not interfere. """
+    code = 'import bench; print bench._memory_child(%r, %d)' % (cls_name, count)
+    output = subprocess.Popen([sys.executable, '-c', code], 
+        stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).communicate()[0]
+    return int(output)
+
+def _memory_child(cls_name, count):
+    cls = getattr(zoocfg, cls_name)
+    contents = [generate_config(servers=5).replace('2181', str(i)) 
+        for i in range(count)]
+
+    before = resident_memory()
+    configs = [cls(content) for content in contents]
+    for cfg in configs:
+        cfg.get_servers()
+    return resident_memory() - before
+
+# milliseconds zoocfg may add to the start up time of the interpreter:
+# about twice what checking one file takes, and under 20ms in total
+STARTUP_BUDGET = 8.0
+
+def measure_startup(runs=20, argv=('samples/standalone-zoo.cfg',)):
+    """ Best wall time in seconds of a run of the installed `zoocfg` 
+    command and of a bare interpreter, each in a fresh process. The 
+    module is byte-compiled first like it is when installed. """
+    here = os.path.dirname(os.path.abspath(__file__))
+    py_compile.compile(os.path.join(here, 'zoocfg.py'))
+    env = dict(os.environ, PYTHONPATH=here)
+
+    def best(args):
+        times = []
+        with open(os.devnull, 'w') as devnull:
+            for _ in range(runs):
+                start = time.time()
+                subprocess.call(args, stdout=devnull, stderr=devnull, cwd=here, env=env)
+                times.append(time.time() - start)
+        return min(times)
+
+    command = [sys.executable, os.path.join(here, 'bin', 'zoocfg')] + list(argv)
+    return best(command), best([sys.executable, '-c', 'pass'])
+
+FLEET_QUERIES = ('snapCount<5000', 'skipACL=yes', 'reusedPort=2888', 
+    'host=zoo7-1.example.com,port=2888', 'dataDir=/var/zookeeper/77')
+
+def measure_fleet(count, queries=FLEET_QUERIES, repeat=5):
+    """ Index `count` synthetic configs and return the index size in bytes
+    and the best time in seconds of each query, mapping the index again 
+    each time """
+    import random, tempfile
+    rnd = random.Random(1)
+    entries = {}
+    for i in range(count):
+        content = generate_config(servers=3).replace('2888', 
+            str(rnd.choice([2888, 2889]))).replace('zoo', 'zoo%d-' % (i % 1000))
+        content = content.replace('dataDir=/var/zoo%d-keeper/data' % (i % 1000), 
+            'dataDir=/var/zookeeper/%d' % i)
+        content += 'snapCount=%d\nskipACL=%s\n' % (rnd.choice([1000, 10000, 100000]),
+            rnd.choice(['yes', 'no', 'no', 'no']))
+        entries['/etc/zookeeper/%d/zoo.cfg' % i] = (0.0, len(content), 
+            '\0' * 8) + zoocfg.FleetIndex.entry(content)
+
+    fd, path = tempfile.mkstemp(prefix='fleet-')
+    os.close(fd)
+    try:
+        zoocfg.FleetIndex.write(path, entries)
+        results = {}
+        for query in queries:
+            times = []
+            for _ in range(repeat):
+                start = time.time()
+                index = zoocfg.FleetIndex(path)
+                index.query(query)
+                index.close()
+                times.append(time.time() - start)
+            results[query] = min(times)
+        return os.path.getsize(path), results
+    finally:
+        os.unlink(path)
+
+def metadata():
+    try:
+        commit = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def report(results, baseline=None, threshold=0.1):
+    """ Print a table of results. Returns the number of regressions 
+    larger than `threshold` compared with the baseline. """
+    regressions = 0
+    for name in sorted(results):
+        line = '%-45s %12.2fus' % (name, results[name] * 1e6)
+        if baseline and name in baseline:
+            ratio = results[name] / baseline[name]
+            line += '  %6.2fx' % ratio
+            if ratio > 1 + threshold:
+                line += '  REGRESSION'
+                regressions += 1
+        print line
+    return regressions
+
+def main(argv):
+    parser = OptionParser()
+
+    parser.add_option('-o', '--output', dest='output', default=None,
+        help='write the results as JSON to FILE', metavar='FILE')
+
+    parser.add_option('-c', '--compare', dest='compare', default=None,
+        help='compare with the JSON results in FILE', metavar='FILE')
+
+    parser.add_option('-s', '--scenario', dest='scenarios', default=[],
+        action='append', help='run only this scenario. Can be repeated.')
+
+    parser.add_option('-b', '--benchmark', dest='names', default=[],
+        action='append', help='run only the benchmarks starting with NAME. '
+        'Can be repeated.', metavar='NAME')
+
+    parser.add_option('-l', '--legacy', dest='legacy', default=False,
+        action='store_true', help='also time the replaced implementations')
+
+    parser.add_option('-t', '--min-time', dest='min_time', type='float',
+        default=0.05, help='minimum duration of each measurement in seconds')
+
+    parser.add_option('-m', '--memory', dest='memory', type='int', default=None,
+        help='measure the memory used by N configs and exit', metavar='N')
+
+    parser.add_option('--startup', dest='startup', default=False,
+        action='store_true', help='measure the start up time of the CLI '
+        'and exit. fails when zoocfg adds more than the budget to the '
+        'start up time of the interpreter')
+
+    parser.add_option('--startup-budget', dest='startup_budget', type='float',
+        default=STARTUP_BUDGET, help='start up budget in milliseconds. '
+        'defaults to %s' % STARTUP_BUDGET, metavar='MS')
+
+    parser.add_option('--fleet', dest='fleet', type='int', default=None,
+        help='time queries on an index of N configs and exit', metavar='N')
+
+    (opts, args) = parser.parse_args(argv)
+
+    if opts.startup:
+        total, interpreter = measure_startup()
+        overhead = (total - interpreter) * 1e3
+        print 'startup: %.1fms, interpreter %.1fms, zoocfg %.1fms (budget %.1fms)' % \
+            (total * 1e3, interpreter * 1e3, overhead, opts.startup_budget)
+        if overhead > opts.startup_budget:
+            print 'REGRESSION'
+            return 1
+        return 0
+
+    if opts.fleet:
+        size, results = measure_fleet(opts.fleet)
+        print '%d configs: index %.1fMB' % (opts.fleet, size / 1e6)
+        for query in FLEET_QUERIES:
+            print '  %-40s %8.2fms' % (query, results[query] * 1e3)
+        return 0
+
+    if opts.memory:
+        full = measure_memory('ZooCfg', opts.memory)
+        compact = measure_memory('CompactZooCfg', opts.memory)
+        print '%d configs: ZooCfg %.1fMB, CompactZooCfg %.1fMB (%.0f%% less)' % \
+            (opts.memory, full / 1e6, compact / 1e6, 100 - compact * 100.0 / full)
+        return 0
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = run(opts.scenarios, opts.names, opts.legacy, opts.min_time)
+    regressions = report(results, baseline)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({'meta': metadata(), 'results': results}, f, 
+                indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
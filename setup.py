@@ -2,7 +2,7 @@
 try:
     from setuptools import setup
 except ImportError:
-    from distutils import setup
+    from distutils.core import setup
 
 setup(
     name='zoocfg',
@@ -12,7 +12,8 @@ setup(
     author_email='contact@andreisavu.ro',
     license='Apache License 2.0',
     url='http://github.com/andreisavu/python-zoocfg',
-    scripts=['zoocfg.py'],
+    py_modules=['zoocfg'],
+    scripts=['zoocfg.py', 'bin/zoocfg'],
     test_suite='test'
 )
 
@@ -19,6 +19,18 @@
 import unittest
 import sys
 import os
+import json
+import copy
+import shutil
+import tempfile
+import threading
+import socket
+import SocketServer
+import struct
+import subprocess
+import time
+import signal
+import operator
 from StringIO import StringIO
 
 import zoocfg
@@ -44,13 +56,13 @@ class TestZooCfg(unittest.TestCase):
     def test_parse_two_lines(self):
         cfg = ZooCfg('a=23\nb=asd')
 
-        assert cfg.a == 23
+        assert cfg.a == '23'
         assert cfg.b == 'asd'
 
     def test_skip_broken_lines(self):
         cfg = ZooCfg('broken-line\na=3')
 
-        assert cfg.a == 3
+        assert cfg.a == '3'
 
     def test_default_values(self):
         cfg = ZooCfg()
@@ -72,12 +84,12 @@ class TestZooCfg(unittest.TestCase):
         cfg = ZooCfg('#a=5\nb=6')
 
         assert hasattr(cfg, '#a') is False
-        assert cfg.b == 6
+        assert cfg.b == '6'
 
     def test_ignore_comments_at_the_end_of_the_line(self):
         cfg = ZooCfg('a=5 # ignored\nb=6')
 
-        assert cfg.a == 5 and cfg.b == 6
+        assert cfg.a == '5' and cfg.b == '6'
 
     def test_get_list_of_servers(self):
         cfg = ZooCfg(TYPICAL_ZOO_CFG)
@@ -87,6 +99,18 @@ class TestZooCfg(unittest.TestCase):
         assert servers[0].port == 2888
         assert servers[0].election_port == 3888
 
+    def test_servers_with_client_port(self):
+        cfg = ZooCfg('server.1=zoo1:2888:3888:participant;2181\n'
+            'server.2=zoo2:2888:3888;0.0.0.0:2182\n'
+            'server.3=zoo3:2888:3888:observer\n')
+        servers = cfg.get_servers()
+        self.assertEqual([s.type for s in servers], ['participant', 'participant', 'observer'])
+        self.assertEqual([s.client_port for s in servers], [2181, 2182, None])
+        assert servers[0].election_port == 3888
+
+        cfg = ZooCfg('server.1=zoo1:2888:3888;client')
+        self.assertRaises(ValueError, cfg.get_servers)
+
     def test_get_list_of_servers_with_invalid_id(self):
         cfg = ZooCfg("server.0=localhost:2888:3888")
         self.assertRaises(ValueError, cfg.get_servers)
@@ -94,10 +118,194 @@ class TestZooCfg(unittest.TestCase):
         cfg = ZooCfg("server.256=localhost:2888:3888")
         self.assertRaises(ValueError, cfg.get_servers)
 
+    def test_server_lookups(self):
+        cfg = ZooCfg(TYPICAL_ZOO_CFG + "server.10=zoo1:2889:3889:observer\n")
+
+        self.assertEqual([s.id for s in cfg.get_servers()], [1, 2, 3, 10])
+        assert cfg.get_server(2).host == 'zoo2'
+        assert cfg.get_server(4) is None
+        self.assertEqual([s.id for s in cfg.get_servers_by_host('zoo1')], [1, 10])
+        assert cfg.get_server_by_address('zoo1', 3889).id == 10
+        assert cfg.get_server(10).is_observer
+        assert not cfg.get_server(1).is_observer
+
+    def test_server_table_is_invalidated_by_server_keys_only(self):
+        cfg = ZooCfg(TYPICAL_ZOO_CFG)
+        servers = cfg.get_servers()
+
+        cfg['snapCount'] = 1000
+        assert cfg.get_server(1) is servers[0]
+
+        cfg['server.4'] = 'zoo4:2888:3888'
+        assert len(cfg.get_servers()) == 4
+        assert cfg.get_server(1) is not servers[0]
+
+        del cfg['server.4']
+        cfg.pop('server.3')
+        assert len(cfg.get_servers()) == 2
+
     def test_duplicate_key_in_config_file(self):
         self.assertRaises(ValueError, ZooCfg, 
             "server.2=s1:2888:3888\nserver.2=s2:2888:3888\n")
 
+    def test_known_settings_are_typed_on_access(self):
+        cfg = ZooCfg('tickTime=2000\ndataDir=1234\nskipACL=YES\n'
+            'snapCount=many\ncustom=12')
+
+        assert dict.__getitem__(cfg, 'tickTime') == '2000'
+        assert cfg.tickTime == 2000
+        assert dict.__getitem__(cfg, 'tickTime') == '2000'
+        assert cfg.dataDir == '1234'
+        assert cfg.skipACL is True and cfg.leaderServers is True
+        assert cfg.snapCount == 'many'
+        assert cfg.custom == '12'
+        assert ('tickTime', 2000) in cfg.items()
+
+    def test_access_does_not_change_the_config(self):
+        content = 'tickTime=2000\nclientPort=2181\nskipACL=yes\n'
+        cfg = ZooCfg(content)
+        before = (dict(cfg), copy.copy(cfg), cfg.copy())
+
+        assert cfg.tickTime == 2000 and cfg['clientPort'] == 2181
+        assert cfg.skipACL is True
+        assert cfg == ZooCfg(content) == before[2]
+        assert not cfg != ZooCfg(content)
+        self.assertEqual((dict(cfg), copy.copy(cfg), cfg.copy()), before)
+
+        cfg['tickTime'] = '3000'
+        assert cfg.tickTime == 3000
+
+    def test_schema(self):
+        setting = zoocfg.SCHEMA['clientPort']
+
+        assert setting.unit == 'port'
+        assert setting.coerce('2181') == 2181 and setting.coerce(2181) == 2181
+        assert setting.accepts(2181) and not setting.accepts(70000)
+        assert not setting.accepts('2181') and not setting.accepts(True)
+        self.assertEqual(map(str, setting.validate({})), 
+            ['No `clientPort` found in config file.'])
+        self.assertEqual(map(str, setting.validate({'clientPort': 'x'})), 
+            ['`clientPort` should be a valid TCP/IP port number.'])
+        assert setting.validate({})[0].key == 'clientPort'
+
+    def test_value_containing_equal_sign(self):
+        cfg = ZooCfg('a=b=c')
+
+        assert cfg.a == 'b=c'
+
+class TestCompactZooCfg(unittest.TestCase):
+
+    def test_same_values_as_zoocfg(self):
+        full = ZooCfg(TYPICAL_ZOO_CFG)
+        compact = zoocfg.CompactZooCfg(TYPICAL_ZOO_CFG)
+
+        self.assertEqual(sorted(compact.items()), sorted(full.items()))
+        assert compact == full and len(compact) == len(full)
+        assert compact.snapCount == 100000 and compact['dataLogDir'] == '/var/zookeeper/'
+        assert 'snapCount' in compact and 'missing' not in compact
+        assert compact.get('missing', 5) == 5
+        self.assertRaises(KeyError, lambda: compact['missing'])
+        self.assertEqual([s.id for s in compact.get_servers()], [1, 2, 3])
+
+        for a, b in [(zoocfg.Rules.check_all(full), zoocfg.Rules.check_all(compact))]:
+            self.assertEqual(a.warnings, b.warnings)
+            self.assertEqual(a.errors, b.errors)
+
+        for key in ('tickTime', 'server.2', 'dataLogDir', 'leaderServers'):
+            self.assertEqual(compact.line_of(key), full.line_of(key))
+
+    def test_mutations(self):
+        compact = zoocfg.CompactZooCfg(TYPICAL_ZOO_CFG)
+        zoocfg.Rules.check_incremental(compact)
+
+        compact['snapCount'] = 100
+        compact['server.4'] = 'zoo4:2888:3888'
+        del compact['skipACL']
+        del compact['initLimit']
+        assert compact.pop('missing', None) is None
+
+        assert compact.snapCount == 100
+        assert 'skipACL' not in compact and 'initLimit' not in compact
+        assert len(compact.get_servers()) == 4
+        self.assertRaises(KeyError, compact.__delitem__, 'skipACL')
+
+        check = zoocfg.Rules.check_incremental(compact)
+        expected = zoocfg.Rules.check_all(compact)
+        self.assertEqual(check.errors, expected.errors)
+        assert 'No `skipACL` found in config file.' in check.errors
+
+        compact.clear()
+        assert len(compact) == 0 and compact.items() == []
+
+    def test_copies_see_all_values(self):
+        full = ZooCfg(TYPICAL_ZOO_CFG)
+        compact = zoocfg.CompactZooCfg(TYPICAL_ZOO_CFG)
+        expected = dict(full.items())
+
+        self.assertEqual(dict(compact), expected)
+        copy = {}
+        copy.update(compact)
+        self.assertEqual(copy, expected)
+        self.assertEqual(json.loads(json.dumps(compact.copy())), 
+            json.loads(json.dumps(expected)))
+        self.assertRaises(TypeError, json.dumps, compact) # never a silent {}
+
+    def test_layouts_and_keys_are_shared(self):
+        a = zoocfg.CompactZooCfg(TYPICAL_ZOO_CFG)
+        b = zoocfg.CompactZooCfg(TYPICAL_ZOO_CFG.replace('2181', '2182'))
+
+        assert a._keys is b._keys
+        assert not hasattr(a, '__dict__') or not a.__dict__
+
+class TestTokenizer(unittest.TestCase):
+
+    def tokens(self, content):
+        return list(zoocfg.tokenize(content))
+
+    def test_separators(self):
+        self.assertEqual(self.tokens('a=1\nb:2\nc 3\nd = 4\ne\t: 5\n'), [
+            (1, 'a', '1'), (2, 'b', '2'), (3, 'c', '3'),
+            (4, 'd', '4'), (5, 'e', '5')])
+
+    def test_comments(self):
+        self.assertEqual(self.tokens('# a=1\n  ! b=2\nc=3 # comment\n'),
+            [(3, 'c', '3')])
+
+    def test_line_continuation(self):
+        self.assertEqual(self.tokens('a=1,\\\n    2,\\\n 3\nb=4'),
+            [(1, 'a', '1,2,3'), (4, 'b', '4')])
+
+    def test_no_continuation_in_comments(self):
+        self.assertEqual(self.tokens('a=1 # note \\\nb=2\nc=\\#3 # \\\nd=4\n'),
+            [(1, 'a', '1'), (2, 'b', '2'), (3, 'c', '#3'), (4, 'd', '4')])
+        self.assertEqual(self.tokens('a=1,\\\n 2 # end \\\nb=3\n'),
+            [(1, 'a', '1,2'), (3, 'b', '3')])
+
+    def test_invalid_unicode_escape(self):
+        for content in ('a=\\u12\n', 'a=\\u0x12\n', 'a=\\uzzzz\n'):
+            self.assertRaises(ValueError, self.tokens, content)
+        self.assertEqual(self.tokens('a=\\u00e9x\n'), [(1, 'a', '\xc3\xa9x')])
+
+    def test_escapes(self):
+        self.assertEqual(self.tokens('a\\=b=c\\#d\nx=\\u0041\\\\\n'),
+            [(1, 'a=b', 'c#d'), (2, 'x', 'A\\')])
+
+    def test_empty_value(self):
+        self.assertEqual(self.tokens('a=\nbroken-line\n'), [(1, 'a', '')])
+
+    def test_file_and_mmap_sources(self):
+        import mmap
+        with open(abspath('samples/replicated-zoo.cfg')) as f:
+            expected = self.tokens(f.read())
+            f.seek(0)
+            self.assertEqual(self.tokens(f), expected)
+
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.assertEqual(self.tokens(m), expected)
+            m.close()
+
+        assert (12, 'server.5', 'localhost:3185:4185') in expected
+
 class CapturingTestCase(unittest.TestCase):
 
     def _in_memory_buffer(self, stream, *args):
@@ -138,10 +346,10 @@ class TestZooCfg_CommandLine_Interface(CapturingTestCase):
     def test_run_checks_on_standalone_config(self):
         r = zoocfg.main(['-f', 'samples/standalone-zoo.cfg', '-w'])
         output = """Warnings:
-* You should run at least 3 ZooKeeper servers.
-
 * The `dataLogDir` should not use the same partition as `dataDir` in order to avoid competition between logging and snapshots. Having a dedicated log device has a large impact on throughput and stable latencies.
 
+* You should run at least 3 ZooKeeper servers.
+
 """
         assert r == 1
         assert self.stdout() == output
@@ -149,16 +357,1429 @@ class TestZooCfg_CommandLine_Interface(CapturingTestCase):
     def test_run_checks_on_replicated_config(self):
         r = zoocfg.main(['-f', 'samples/replicated-zoo.cfg', '-w'])
         output = """Warnings:
-* The `dataLogDir` should not use the same partition as `dataDir` in order to avoid competition between logging and snapshots. Having a dedicated log device has a large impact on throughput and stable latencies.
-
 * `dataDir` contains a relative path. This could be a problem if ZooKeeper is running as daemon.
 
+* The `dataLogDir` should not use the same partition as `dataDir` in order to avoid competition between logging and snapshots. Having a dedicated log device has a large impact on throughput and stable latencies.
+
 * Your ensemble contains more than 3 servers. It's recommended to set `leaderServers` to `no`. This willallow the leader to focus only on coordination.
 
 """
         assert r == 1
         assert self.stdout() == output
 
+    def test_run_checks_on_many_files(self):
+        r = zoocfg.main(['samples', '-j', '2'])
+        output = self.stdout().splitlines()
+
+        assert r == 0
+        assert output[0] == 'samples/replicated-zoo.cfg: 3 warning(s), 0 error(s)'
+        assert output[1] == 'samples/standalone-zoo.cfg: 2 warning(s), 0 error(s)'
+        assert output[2] == 'Checked 2 files: 0 ok, 2 with warnings, 0 with errors'
+
+    def test_missing_file_in_batch_is_an_error(self):
+        r = zoocfg.main(['samples/standalone-zoo.cfg', 'samples/missing.cfg'])
+
+        assert r == 2
+        assert 'Unable to load config file' in self.stdout()
+
+    def test_missing_file_in_every_mode(self):
+        missing = 'samples/missing.cfg'
+        for argv in ([missing], ['-x', 'TickTime', missing], 
+                ['--workload', '100,1K,10M', 'samples/standalone-zoo.cfg', missing],
+                ['--probe-disk', missing], ['--probe-network', missing], 
+                ['--probe-live', missing], ['--simulate', '1', missing], 
+                ['--scan-data', missing]):
+            self._in_memory_buffer('stdout', 'stderr')
+            r = zoocfg.main(argv)
+            assert r == 2, argv
+            assert 'Unable to load config file' in self.stdout(), argv
+            assert self.stderr() == '', argv
+            if '--workload' in argv: # the other file is still reported
+                assert 'recommended: snapCount=' in self.stdout()
+
+    def test_run_selected_rules(self):
+        r = zoocfg.main(['-f', 'samples/standalone-zoo.cfg', '-w', '-x', 'DataLogDir'])
+        output = """Warnings:
+* You should run at least 3 ZooKeeper servers.
+
+"""
+        assert r == 1
+        assert self.stdout() == output
+
+    def test_unknown_rule_id(self):
+        r = zoocfg.main(['-f', 'samples/standalone-zoo.cfg', '-r', 'Dummy'])
+
+        assert r == -1
+        assert self.stderr() == 'Unknown rule id(s): Dummy\n'
+
+    def test_run_ensemble_checks(self):
+        r = zoocfg.main(['-e', 'samples'])
+        output = self.stdout()
+
+        assert r == 2
+        assert output.startswith('samples: 2 warning(s), 1 error(s)\nErrors:\n')
+        assert 'Members disagree on `dataDir`' not in output
+
+class TestBatch(unittest.TestCase):
+
+    def test_expand_paths(self):
+        expected = [abspath('samples/replicated-zoo.cfg'),
+            abspath('samples/standalone-zoo.cfg')]
+
+        assert zoocfg.expand_paths([abspath('samples')]) == expected
+        assert zoocfg.expand_paths([abspath('samples/*.cfg')]) == expected
+        assert zoocfg.expand_paths(expected + expected) == expected
+
+    def test_parallel_results_match_sequential_results(self):
+        files = zoocfg.expand_paths([abspath('samples')]) * 4
+
+        sequential = list(zoocfg.check_files(files, jobs=1))
+        parallel = list(zoocfg.check_files(files, jobs=3))
+
+        self.assertEqual([f for f, _ in sequential], [f for f, _ in parallel])
+        for (_, a), (_, b) in zip(sequential, parallel):
+            self.assertEqual(a.warnings, b.warnings)
+            self.assertEqual(a.errors, b.errors)
+
+class TestProfile(CapturingTestCase):
+
+    def test_check_all_records_each_rule(self):
+        profile = zoocfg.Profile()
+        zoocfg.Rules.check_all(ZooCfg(TYPICAL_ZOO_CFG), profile=profile)
+        zoocfg.Rules.check_all(ZooCfg(TYPICAL_ZOO_CFG), profile=profile)
+
+        self.assertEqual(sorted(profile.calls), 
+            sorted('rule.%s' % id for id in zoocfg.RuleRegistry.ids()))
+        assert set(profile.calls.values()) == set([2])
+
+    def test_merge_and_rank(self):
+        a, b = zoocfg.Profile(), zoocfg.Profile()
+        a.add('parse', 0.5)
+        b.add('parse', 0.25, calls=2)
+        b.add('rule.TickTime', 1.0)
+        a.merge(b)
+
+        self.assertEqual(a.ranked(), [('rule.TickTime', 1.0, 1), ('parse', 0.75, 3)])
+
+    def test_profile_output(self):
+        path = tempfile.mkdtemp()
+        try:
+            output = os.path.join(path, 'profile.json')
+            zoocfg.main(['--profile', '--profile-output', output, 'samples'])
+            with open(output) as f:
+                profile = json.load(f)
+        finally:
+            shutil.rmtree(path)
+
+        assert profile['parse']['calls'] == 2
+        assert profile['get_servers']['calls'] == 2
+        assert profile['rule.ClientPort']['calls'] == 2
+        assert self.stderr().startswith('name ')
+
+class TestDiskAdvisor(unittest.TestCase):
+
+    def advisor(self, content=TYPICAL_ZOO_CFG, **kwargs):
+        workload = zoocfg.Workload.parse('2000,1K,200M,100M')
+        return zoocfg.DiskAdvisor(ZooCfg(content), workload, **kwargs)
+
+    def test_parse_workload(self):
+        workload = zoocfg.Workload.parse('100, 512, 2G')
+
+        assert workload.snapshot_size == 2 * 1024 ** 3
+        assert workload.disk_bandwidth is None
+        self.assertRaises(ValueError, zoocfg.Workload.parse, '100,512')
+        self.assertRaises(ValueError, zoocfg.Workload.parse, '0,512,1M')
+
+    def test_estimate(self):
+        estimate = self.advisor().estimate()
+
+        assert estimate['snapshot_interval'] == 37.5
+        assert estimate['log_bandwidth'] == 2000 * 1024
+        self.assertAlmostEqual(estimate['snapshot_ticks'], 1.0)
+        self.assertAlmostEqual(estimate['preallocs_per_second'], 2000.0 / 65536)
+
+    def test_recommendation_meets_target(self):
+        advisor = self.advisor(target=0.2)
+        recommended = advisor.recommend()
+        estimate = advisor.estimate(recommended['snapCount'], 
+            recommended['preAllocSize'])
+
+        assert estimate['snapshot_fraction'] <= 0.2
+        assert estimate['preallocs_per_second'] <= 0.1
+        assert recommended['preAllocSize'] == 32 * 1024
+
+    def test_advise(self):
+        content = TYPICAL_ZOO_CFG.replace('syncLimit=2', 'syncLimit=0')
+        check = self.advisor(content).advise()
+
+        assert len(check.warnings) == 2
+        assert check.warnings[0].startswith('Snapshots use 73% of the disk writes')
+        assert check.warnings[1].startswith('Writing a snapshot takes 1.0 ticks')
+
+        check = self.advisor('snapCount=%d\n' % 10**7 + TYPICAL_ZOO_CFG).advise()
+        assert not check.has_warnings()
+
+def write_txn_log(path, zxid, count, txn_size=100, prealloc=4096, start=1000000, interval=10):
+    """ Write a synthetic txn log with `count` records and zero padding """
+    with open(path, 'wb') as f:
+        f.write(struct.pack('>iiq', zoocfg.DataScanner.LOG_MAGIC, 2, 0))
+        for i in range(count):
+            txn = struct.pack('>qiqqi', 1, i, zxid + i, start + i * interval, 1)
+            txn += '\1' * (txn_size - len(txn))
+            f.write(struct.pack('>qi', 0, len(txn)) + txn + 'B')
+        f.write('\0' * (prealloc - f.tell() % prealloc))
+
+class TestDataScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.version2 = os.path.join(self.dir, 'version-2')
+        os.mkdir(self.version2)
+        self.cfg = ZooCfg('tickTime=2000\ndataDir=%s\n' % self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_log(self):
+        path = os.path.join(self.version2, 'log.100000001')
+        write_txn_log(path, 0x100000001, 30)
+        log = zoocfg.DataScanner.read_log(path)
+
+        assert log.count == 30 and log.size == 4096
+        assert (log.first_zxid, log.last_zxid) == (0x100000001, 0x10000001e)
+        assert log.used == 16 + 30 * (12 + 100 + 1)
+        assert (log.first_time, log.last_time) == (1000000, 1000290)
+
+    def test_empty_and_invalid_logs(self):
+        path = os.path.join(self.version2, 'log.5')
+        write_txn_log(path, 5, 0)
+        log = zoocfg.DataScanner.read_log(path)
+        assert log.count == 0 and log.first_zxid == 5 and log.last_zxid is None
+
+        with open(path, 'wb') as f:
+            f.write('\0' * 64)
+        self.assertRaises(ValueError, zoocfg.DataScanner.read_log, path)
+
+    def test_summary_and_recommendation(self):
+        write_txn_log(os.path.join(self.version2, 'log.1'), 1, 100, start=0, interval=10)
+        write_txn_log(os.path.join(self.version2, 'log.65'), 0x65, 100, start=1000, 
+            interval=10)
+        with open(os.path.join(self.version2, 'snapshot.64'), 'wb') as f:
+            f.write(struct.pack('>iiq', zoocfg.DataScanner.SNAP_MAGIC, 2, 0))
+            f.write('\0' * (1 << 20))
+
+        scanner = zoocfg.DataScanner(self.cfg).scan()
+        summary = scanner.summary()
+
+        self.assertEqual([log.name for log in scanner.logs], ['log.1', 'log.65'])
+        assert summary['txns'] == 200 and summary['snapshots'] == 1
+        self.assertAlmostEqual(summary['txn_size'], 113.0)
+        self.assertAlmostEqual(summary['write_rate'], 200 / 1.99)
+
+        recommended = scanner.recommend()
+        assert recommended['heap'] == 512
+        assert recommended['snapCount'] > 1000
+
+    def test_bad_files_are_reported_and_skipped(self):
+        write_txn_log(os.path.join(self.version2, 'log.1'), 1, 10)
+        with open(os.path.join(self.version2, 'snapshot.a'), 'wb') as f:
+            f.write(struct.pack('>iiq', zoocfg.DataScanner.SNAP_MAGIC, 2, 0))
+        for name, content in [('log.2', '\0' * 64), ('log.zz', ''),
+                ('snapshot.b', 'garbage' * 4), ('snapshot.c', 'ZK')]:
+            with open(os.path.join(self.version2, name), 'wb') as f:
+                f.write(content)
+
+        scanner = zoocfg.DataScanner(self.cfg).scan()
+
+        self.assertEqual([log.name for log in scanner.logs], ['log.1'])
+        self.assertEqual([s.name for s in scanner.snapshots], ['snapshot.a'])
+        messages = [f.message for f in scanner.findings]
+        assert len(messages) == 4, messages
+        assert 'Invalid txn log header' in messages[0]
+        assert 'Invalid file name: log.zz' in messages[1]
+        assert all('Invalid snapshot header' in m for m in messages[2:])
+
+class TestDiskProbe(CapturingTestCase):
+
+    def setUp(self):
+        CapturingTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.cfg = ZooCfg('tickTime=2000\nsyncLimit=2\npreAllocSize=64\n'
+            'dataDir=%s\n' % self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        CapturingTestCase.tearDown(self)
+
+    def test_run(self):
+        result = zoocfg.DiskProbe(self.cfg, count=20).run()
+
+        assert result['samples'] == 20
+        assert result['p50'] <= result['p99'] <= result['max']
+        assert os.listdir(self.dir) == []
+
+    def test_prealloc_is_bounded(self):
+        class Probe(zoocfg.DiskProbe):
+            MAX_PREALLOC = 128 * 1024
+        cfg = ZooCfg('preAllocSize=1048576\ndataDir=%s\n' % self.dir)
+        assert Probe(cfg, count=1).run()['prealloc_size'] == 128
+
+        result = zoocfg.DiskProbe(cfg, max_seconds=0).run()
+        assert result['prealloc_size'] == 64 and result['samples'] == 1
+
+    def test_advise(self):
+        probe = zoocfg.DiskProbe(self.cfg)
+        check = probe.advise({'p50': 1.0, 'p99': 2500.0, 'max': 4500.0})
+
+        assert len(check.warnings) == 2
+        assert '(2500.0ms) is longer than `tickTime`' in check.warnings[0]
+        assert '(4500.0ms) is longer than `syncLimit` * `tickTime`' in check.warnings[1]
+        assert not probe.advise({'p50': 1.0, 'p99': 3.0, 'max': 40.0}).has_warnings()
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        percentile = zoocfg.DiskProbe.percentile
+
+        assert percentile(samples, 0.5) == 50
+        assert percentile(samples, 0.99) == 99
+        assert percentile([7], 0.99) == 7
+
+    def test_missing_log_dir(self):
+        cfg = ZooCfg('dataDir=%s/missing\n' % self.dir)
+        self.assertRaises(ValueError, zoocfg.DiskProbe(cfg).run)
+
+class TestReachabilityProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def listener(self, backlog=5):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(backlog)
+        self.sockets.append(sock)
+        return sock.getsockname()[1]
+
+    def closed_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.sockets.append(sock)
+        return sock.getsockname()[1]
+
+    def unresponsive_port(self):
+        """ A listener with a full backlog: new connections time out """
+        port = self.listener(0)
+        sock = socket.socket()
+        sock.connect(('127.0.0.1', port))
+        self.sockets.append(sock)
+        return port
+
+    def test_endpoints(self):
+        cfg = ZooCfg('clientPort=2181\nserver.1=zk1:2888:3888\n'
+            'server.2=zk2:2888:3888\n')
+        names = [e.name for e in zoocfg.ReachabilityProbe(cfg).endpoints()]
+
+        self.assertEqual(names, ['server.1 quorum', 'server.1 election', 
+            'server.1 client', 'server.2 quorum', 'server.2 election', 
+            'server.2 client'])
+
+    def test_probe_local_listeners(self):
+        cfg = ZooCfg('tickTime=2000\nclientPort=%d\nserver.1=127.0.0.1:%d:%d\n' % 
+            (self.listener(), self.closed_port(), self.unresponsive_port()))
+        probe = zoocfg.ReachabilityProbe(cfg, timeout=0.2)
+        client, election, quorum = sorted(probe.run(), key=lambda e: e.name)
+
+        assert client.reachable and client.latency < 200
+        assert not quorum.reachable and 'refused' in quorum.error
+        assert not election.reachable and 'timed out' in election.error
+
+        check = probe.advise([client, quorum, election])
+        assert len(check.warnings) == 2
+        assert check.warnings[0].startswith('No server accepts connections')
+        assert check.warnings[1].startswith('`server.1 election` (127.0.0.1:')
+
+    def test_slow_endpoint(self):
+        cfg = ZooCfg('tickTime=20\nclientPort=2181\n')
+        probe = zoocfg.ReachabilityProbe(cfg)
+        endpoint = zoocfg.ReachabilityProbe.Endpoint('client', 'localhost', 2181)
+        endpoint.latency = 7.5
+
+        check = probe.advise([endpoint])
+        assert list(check.warnings) == ['Connecting to `client` (localhost:2181) took '
+            '7.5ms, more than a quarter of `tickTime` (20ms).']
+
+    def test_timeouts_overlap(self):
+        port = self.unresponsive_port()
+        servers = ''.join('server.%d=127.0.0.1:%d:%d\n' % (i, port, port)
+            for i in range(1, 201))
+        probe = zoocfg.ReachabilityProbe(ZooCfg(servers), timeout=0.2)
+
+        start = time.time()
+        endpoints = probe.run()
+        assert len(endpoints) == 400
+        assert not any(e.reachable for e in endpoints)
+        assert time.time() - start < 1.0
+
+class FourLetterServer(SocketServer.ThreadingTCPServer):
+    """ A stand-in ZooKeeper server answering four letter words """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    class Handler(SocketServer.BaseRequestHandler):
+        def handle(self):
+            command = self.request.recv(4)
+            time.sleep(self.server.delay)
+            self.request.sendall(self.server.responses.get(command, ''))
+
+    def __init__(self, responses, delay=0):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), 
+            FourLetterServer.Handler)
+        self.responses = responses
+        self.delay = delay
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+def four_letter_responses(mode='follower', tick=2000, data_dir='/var/zookeeper', 
+        avg_latency=0, outstanding=0):
+    return {
+        'conf': 'clientPort=2181\ndataDir=%s/version-2\ndataLogDir=%s/version-2\n'
+            'tickTime=%d\nmaxClientCnxns=10\nminSessionTimeout=%d\n'
+            'maxSessionTimeout=%d\nserverId=1\ninitLimit=10\nsyncLimit=5\n' % 
+            (data_dir, data_dir, tick, tick * 2, tick * 20),
+        'srvr': 'Zookeeper version: 3.4.14\nLatency min/avg/max: 0/%d/9\n'
+            'Received: 12\nSent: 11\nConnections: 3\nOutstanding: %d\n'
+            'Zxid: 0x100000002\nMode: %s\nNode count: 4\n' % (avg_latency, 
+            outstanding, mode),
+        'mntr': 'zk_version\t3.4.14\nzk_avg_latency\t%d\nzk_max_latency\t9\n'
+            'zk_min_latency\t0\nzk_outstanding_requests\t%d\n'
+            'zk_num_alive_connections\t3\nzk_server_state\t%s\n' % (avg_latency,
+            outstanding, mode),
+    }
+
+class TestLiveProbe(CapturingTestCase):
+
+    def setUp(self):
+        super(TestLiveProbe, self).setUp()
+        self.servers = []
+
+    def tearDown(self):
+        super(TestLiveProbe, self).tearDown()
+        for server in self.servers:
+            server.close()
+
+    def serve(self, responses, delay=0):
+        server = FourLetterServer(responses, delay)
+        self.servers.append(server)
+        return server.port
+
+    def cfg(self, tick=2000, data_dir='/var/zookeeper'):
+        return ZooCfg('tickTime=%d\ninitLimit=10\nsyncLimit=5\nclientPort=2181\n'
+            'dataDir=%s\nserver.1=127.0.0.1:2888:3888\n'
+            'server.2=127.0.0.1:2889:3889\n' % (tick, data_dir))
+
+    def members(self, cfg, *ports):
+        return [zoocfg.LiveProbe.Member('server.%d' % (i + 1), '127.0.0.1', port, cfg)
+            for i, port in enumerate(ports)]
+
+    def test_parse(self):
+        responses = four_letter_responses()
+        conf = zoocfg.LiveProbe.parse('conf', responses['conf'])
+        stat = zoocfg.LiveProbe.parse('stat', 'Clients:\n /127.0.0.1:5000[0]'
+            '(queued=0,recved=1,sent=0)\n\nMode: leader\n')
+        assert conf['dataDir'] == '/var/zookeeper/version-2'
+        assert stat == {'Mode': 'leader'}
+
+    def test_no_drift(self):
+        cfg = self.cfg()
+        probe = zoocfg.LiveProbe(cfg)
+        members = probe.run(self.members(cfg, self.serve(four_letter_responses('leader')),
+            self.serve(four_letter_responses())))
+
+        assert [m.reachable for m in members] == [True, True]
+        assert probe.drift(members[0]) == []
+        self.assertEqual(probe.status(members[0]), {'mode': 'leader', 
+            'latency_min': 0.0, 'latency_avg': 0.0, 'latency_max': 9.0, 
+            'outstanding': 0, 'connections': 3})
+
+        check = probe.advise(members)
+        assert not check.has_warnings() and not check.has_errors()
+
+    def test_drift(self):
+        cfg = self.cfg(data_dir='data')
+        probe = zoocfg.LiveProbe(cfg)
+        members = probe.run(self.members(cfg, self.serve(four_letter_responses(
+            'leader', tick=3000, data_dir='/var/lib/zookeeper/data'))))
+
+        changes = [(c.key, c.old, c.new) for c in probe.drift(members[0])]
+        self.assertEqual(changes, [('tickTime', 2000, '3000'), 
+            ('minSessionTimeout', 4000, '6000'), ('maxSessionTimeout', 40000, '60000')])
+
+        check = probe.advise(members)
+        assert check.errors[0] == '`server.1` runs with `tickTime`=3000 but '\
+            'the config file has 2000.'
+        assert check.findings[0].line == 1
+
+    def test_unreachable_and_slow(self):
+        cfg = self.cfg(tick=20)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        closed = sock.getsockname()[1]
+        probe = zoocfg.LiveProbe(cfg, timeout=0.5)
+        try:
+            members = probe.run(self.members(cfg, closed, self.serve(
+                four_letter_responses(tick=20, avg_latency=8, outstanding=1000))))
+        finally:
+            sock.close()
+
+        self.assertEqual(probe.advise(members).warnings, (
+            '`server.1` (127.0.0.1:%d) did not answer: Connection refused.' % closed,
+            '`server.2` answers requests in 8.0ms on average, more than a quarter '
+                'of `tickTime` (20ms).',
+            '`server.2` has 1000 outstanding requests and throttles clients '
+                '(`globalOutstandingLimit`=1000).',
+            'No member reports being the leader.'))
+
+    def test_whitelist_and_stat_fallback(self):
+        responses = four_letter_responses('leader')
+        responses['stat'] = responses.pop('srvr')
+        responses['mntr'] = 'mntr is not executed because it is not in the whitelist.\n'
+        cfg = self.cfg()
+        probe = zoocfg.LiveProbe(cfg)
+        member, = probe.run(self.members(cfg, self.serve(responses)))
+
+        assert sorted(member.responses) == ['conf', 'stat']
+        assert probe.status(member)['mode'] == 'leader'
+        assert probe.advise([member]).warnings == ('`server.1` (127.0.0.1:%d) did not '
+            'answer `mntr`: not in 4lw.commands.whitelist.' % member.port,)
+
+    def test_command_line(self):
+        port = self.serve(four_letter_responses('standalone'))
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, 'zoo.cfg')
+            with open(file_name, 'w') as f:
+                f.write('tickTime=3000\ndataDir=/var/zookeeper\nclientPort=%d\n'
+                    'clientPortAddress=127.0.0.1\n' % port)
+            r = zoocfg.main(['--probe-live', file_name])
+        finally:
+            shutil.rmtree(directory)
+
+        output = sys.stdout.getvalue()
+        assert r == 2
+        assert 'standalone   127.0.0.1:%d standalone, latency avg 0.0 max 9.0, '\
+            '0 outstanding, 3 connection(s)' % port in output
+        assert '* `standalone` runs with `clientPort`=2181 but the config file '\
+            'has %d.' % port in output
+        assert '* `standalone` runs with `tickTime`=2000 but the config file '\
+            'has 3000.' in output
+
+    def test_fleet_sweep_is_concurrent(self):
+        port = self.serve(four_letter_responses('leader'), delay=0.2)
+        cfgs = [self.cfg() for i in range(10)]
+        members = [m for cfg in cfgs for m in self.members(cfg, port)]
+
+        start = time.time()
+        zoocfg.LiveProbe(None).run(members)
+        assert time.time() - start < 1.5
+        assert all(len(m.responses) == 3 for m in members)
+
+class TestFindings(CapturingTestCase):
+
+    def test_findings_have_rule_key_and_line(self):
+        cfg = ZooCfg('# comment\ntickTime=-1\nclientPort=80\ndataDir=/data\n')
+        check = zoocfg.Rules.check_all(cfg, select=['TickTime', 'ClientPort', 'DataLogDir'])
+        findings = dict((f.rule, f) for f in check.findings)
+
+        self.assertEqual(findings['TickTime'].as_dict(), {'rule': 'TickTime',
+            'severity': 'error', 'key': 'tickTime', 'line': 2, 'message':
+            '`tickTime` should be a positive number measured in milliseconds'})
+        self.assertEqual((findings['ClientPort'].severity, findings['ClientPort'].line), 
+            ('warning', 3))
+        assert findings['DataLogDir'].line == 4 # copied from dataDir
+
+    def test_messages_are_formatted_lazily(self):
+        finding = zoocfg.Finding('`%s` is %d', ('a', 1), 'a')
+        check = zoocfg.RulesResult([finding], ['plain'])
+
+        assert check.count(zoocfg.Finding.WARNING) == 1 and check.has_errors()
+        assert finding.template == '`%s` is %d'
+        self.assertEqual(check.warnings, ('`a` is 1',))
+        self.assertEqual(check.errors, ('plain',))
+
+    def test_ndjson_output(self):
+        ret = zoocfg.main(['--format', 'ndjson', 'samples'])
+        records = [json.loads(line) for line in self.stdout().splitlines()]
+
+        assert ret == 0
+        self.assertEqual([r['file'] for r in records], 
+            ['samples/replicated-zoo.cfg', 'samples/standalone-zoo.cfg'])
+        self.assertEqual([r['warnings'] for r in records], [3, 2])
+        assert records[0]['findings'] == [] # warnings are shown with -w
+
+    def test_json_output(self):
+        ret = zoocfg.main(['--format', 'json', '-w', 'samples/standalone-zoo.cfg'])
+        records = json.loads(self.stdout())
+
+        assert ret == 1 and len(records) == 1
+        self.assertEqual([f['rule'] for f in records[0]['findings']],
+            ['DataLogDir', 'OddNumberOfServers'])
+
+    def test_empty_json_array(self):
+        out = StringIO()
+        zoocfg.JSONReporter(out, lines=False).close()
+        assert json.loads(out.getvalue()) == []
+
+class TestResultCache(CapturingTestCase):
+
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestResultCache, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def test_cached_run_reports_hits(self):
+        argv = ['--cache', self.path, '-w', 'samples']
+        r1 = zoocfg.main(argv)
+        r2 = zoocfg.main(argv)
+
+        assert r1 == r2 == 1
+        self.assertEqual(self.stderr().splitlines(), 
+            ['Cache: 0 hit(s), 2 miss(es)', 'Cache: 2 hit(s), 0 miss(es)'])
+        output = self.stdout()
+        half = len(output) // 2
+        assert output[:half] == output[half:]
+
+    def test_evict_only_after_misses(self):
+        evictions, evict = [], zoocfg.ResultCache.evict
+        zoocfg.ResultCache.evict = lambda cache: evictions.append(cache) or 0
+        try:
+            argv = ['--cache', self.path, 'samples']
+            zoocfg.main(argv)
+            zoocfg.main(argv)
+        finally:
+            zoocfg.ResultCache.evict = evict
+        assert len(evictions) == 1
+
+    def test_key_depends_on_content_and_rules(self):
+        cache = zoocfg.ResultCache(self.path)
+
+        assert cache.key('a=1') == cache.key('a=1')
+        assert cache.key('a=1') != cache.key('a=2')
+        assert cache.key('a=1') != cache.key('a=1', select=['TickTime'])
+
+    def test_evict_least_recently_used(self):
+        cache = zoocfg.ResultCache(self.path, max_entries=2)
+        result = zoocfg.RulesResult(['w'], [])
+        for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+            cache.put(key, result)
+            os.utime(cache._file_name(key), (i, i))
+        cache.get('aa1') # touch
+
+        assert cache.evict() == 1
+        assert cache.get('bb2') is None
+        self.assertEqual(cache.get('aa1').warnings, ('w',))
+        assert cache.get('cc3').cached
+
+    def test_malformed_entries_are_misses(self):
+        cache = zoocfg.ResultCache(self.path)
+        for i, content in enumerate(['{"rules": []}', '[1, 2]', '{"findings": "x"}',
+                '{"findings": [], "inputs": [1]}', '{"findings"']):
+            key = 'ee%d' % i
+            cache.put(key, zoocfg.RulesResult([], []))
+            with open(cache._file_name(key), 'w') as f:
+                f.write(content)
+
+            assert cache.get(key) is None, content
+            assert not os.path.exists(cache._file_name(key))
+        assert (cache.hits, cache.misses) == (0, 5)
+
+    def test_findings_round_trip(self):
+        cache = zoocfg.ResultCache(self.path)
+        check = zoocfg.Rules.check_all(ZooCfg('tickTime=-1\n'))
+        cache.put('dd4', check)
+
+        cached = cache.get('dd4')
+        io = zoocfg.ResultCache.io_rules()
+        self.assertEqual([f.as_dict() for f in cached.findings],
+            [f.as_dict() for f in check.findings if f.rule not in io])
+
+    def test_io_rules_run_again_on_hits(self):
+        registry = zoocfg.RuleRegistry
+        saved = (registry.table, dict(registry.rules), registry.plugins)
+        devices = ['sda', 'sdb']
+        def check(cls, cfg):
+            return ['on %s' % devices[0]], []
+        registry('Device', (zoocfg.Rules.BaseRule,), {'io': True,
+            'keys': ('dataDir',), 'check': classmethod(check)})
+        try:
+            cache = zoocfg.ResultCache(self.path)
+            file_name = abspath('samples/standalone-zoo.cfg')
+            first = zoocfg.check_file(file_name, cache=cache)[1]
+            devices.pop(0) # dataDir moved to another device
+            second = zoocfg.check_file(file_name, cache=cache)[1]
+        finally:
+            registry.table, registry.rules, registry.plugins = saved
+            registry._selections = {}
+
+        assert second.cached and 'on sdb' in second.warnings
+        self.assertEqual(second.warnings, tuple(w.replace('sda', 'sdb') 
+            for w in first.warnings))
+
+        cfg = ZooCfg('tickTime=2000\ndataLogDir=/log\n')
+        zoocfg.Rules.check_incremental(cfg)
+        assert 'DataLogDir' not in cfg._rule_results
+
+    def test_hits_do_not_parse_the_file(self):
+        file_name = os.path.join(self.path, 'zoo.cfg')
+        with open(file_name, 'w') as f:
+            f.write('tickTime=2000\ndataDir=/a/b1\ndataLogDir=/a/b2\n')
+        cache = zoocfg.ResultCache(self.path)
+        first = zoocfg.check_file(file_name, cache=cache)[1]
+
+        calls, tokenize = [], zoocfg.tokenize
+        zoocfg.tokenize = lambda source: calls.append(source) or tokenize(source)
+        try:
+            second = zoocfg.check_file(file_name, cache=cache)[1]
+        finally:
+            zoocfg.tokenize = tokenize
+
+        assert second.cached and not calls
+        self.assertEqual([f.as_dict() for f in second.findings],
+            [f.as_dict() for f in first.findings])
+        assert any(f.rule == 'DataLogDir' for f in second.findings)
+
+class TestFleetIndex(CapturingTestCase):
+
+    def setUp(self):
+        super(TestFleetIndex, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.index = os.path.join(self.dir, 'fleet.idx')
+
+    def tearDown(self):
+        super(TestFleetIndex, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        file_name = os.path.join(self.dir, name)
+        with open(file_name, 'w') as f:
+            f.write(content)
+        return file_name
+
+    def fleet(self, count=60):
+        import random
+        rnd = random.Random(7)
+        for i in range(count):
+            content = 'tickTime=%d\ndataDir=/var/zk/%d\nclientPort=2181\n'\
+                'initLimit=5\nskipACL=%s\n' % (rnd.choice([1000, 2000]), i % 7,
+                rnd.choice(['yes', 'no']))
+            if i % 3:
+                content += 'snapCount=%d\n' % rnd.choice([1000, 5000, 20000])
+            for id in range(1, rnd.randint(1, 4)):
+                content += 'server.%d=zk%d:%d:3888\n' % (id, rnd.randint(1, 3), 
+                    rnd.choice([2888, 2889]))
+            self.write('zoo%02d.cfg' % i, content)
+        return zoocfg.expand_paths([self.dir])
+
+    def test_queries_match_a_scan(self):
+        file_names = self.fleet()
+        zoocfg.FleetIndex.update(self.index, file_names)
+        index = zoocfg.FleetIndex(self.index)
+        entries = [zoocfg.FleetIndex.entry(open(name).read()) for name in file_names]
+        keys = zoocfg.FleetIndex.KEYS
+
+        for query in ('snapCount<5000', 'snapCount>=5000', 'snapCount!=5000', 
+                'skipACL=yes', 'tickTime=1000,skipACL=no', 'dataDir<=/var/zk/3',
+                'dataDir>/var/zk/35', 'servers>1', 'reusedPort=2888', 'maxClientCnxns=10',
+                'host=zk2,port=2889', 'port=2888,host!=zk1,tickTime>1000', 'port<3000',
+                'reusedPort=3888', 'reusedPort!=2888', 'reusedPort>2888'):
+            expected = []
+            for name, (values, servers) in zip(file_names, entries):
+                ok = True
+                server_ok = [True] * len(servers)
+                for key, op, value in index.parse_query(query):
+                    if key == 'host':
+                        server_ok = [a and op(s[0], value) for a, s in zip(server_ok, servers)]
+                    elif key == 'port':
+                        server_ok = [a and (op(s[1], value) or op(s[2], value))
+                            for a, s in zip(server_ok, servers)]
+                    elif key == 'reusedPort':
+                        found = values[keys.index(key)] or ()
+                        ok = ok and bool(found) and (all(op(port, value) for port in found)
+                            if op is operator.ne else any(op(port, value) for port in found))
+                    else:
+                        found = values[keys.index(key)]
+                        ok = ok and found is not None and op(found, value)
+                if 'host' in query or 'port' in query:
+                    ok = ok and any(server_ok)
+                if ok:
+                    expected.append(name)
+            self.assertEqual(index.query(query), expected, query)
+        index.close()
+
+    def test_all_reused_ports(self):
+        file_names = [self.write('zoo.cfg', 'tickTime=2000\nclientPort=2181\n'
+            'server.1=h:2888:3888\nserver.2=h:2888:3889\nserver.3=h:2181:3890\n'),
+            self.write('other.cfg', 'tickTime=2000\nserver.1=h:2888:3888\n')]
+        zoocfg.FleetIndex.update(self.index, file_names)
+        index = zoocfg.FleetIndex(self.index)
+        assert index.query('reusedPort=2888') == file_names[:1]
+        assert index.query('reusedPort=2181') == file_names[:1]
+        assert index.query('reusedPort!=2181') == []
+        assert index.query('reusedPort!=3888') == file_names[:1]
+        assert index.value(1, 'reusedPort') == (2181, 2888)
+        index.close()
+
+        # copied as is when the index is updated
+        self.write('other.cfg', 'tickTime=1000\n')
+        zoocfg.FleetIndex.update(self.index, file_names)
+        index = zoocfg.FleetIndex(self.index)
+        assert index.query('reusedPort>=2888') == file_names[:1]
+        index.close()
+
+    def test_incremental_update(self):
+        file_names = self.fleet(5)
+        update = zoocfg.FleetIndex.update
+        assert update(self.index, file_names) == {'parsed': 5, 'unchanged': 0, 
+            'removed': 0, 'failed': 0}
+        mtime = os.path.getmtime(self.index)
+
+        assert update(self.index, file_names)['unchanged'] == 5
+        assert os.path.getmtime(self.index) == mtime # not written again
+
+        self.write('zoo01.cfg', 'tickTime=2000\nsnapCount=10\nserver.1=zk:2888:2888\n')
+        os.utime(file_names[2], (0, 0)) # touched, same content
+        stats = update(self.index, file_names[1:] + [os.path.join(self.dir, 'missing.cfg')])
+        assert stats == {'parsed': 1, 'unchanged': 3, 'removed': 1, 'failed': 1}
+
+        index = zoocfg.FleetIndex(self.index)
+        assert len(index) == 4
+        assert index.query('snapCount<100') == [file_names[1]]
+        assert file_names[1] in index.query('reusedPort=2888')
+        assert index.file(1)[1] == 0
+        assert index.value(1, 'dataDir') == open(file_names[2]).read().split('\n')[1][8:]
+        index.close()
+
+    def test_paths_are_absolute(self):
+        file_names = self.fleet(3)
+        update = zoocfg.FleetIndex.update
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            update(self.index, [os.path.basename(name) for name in file_names])
+        finally:
+            os.chdir(cwd)
+
+        assert update(self.index, file_names) == {'parsed': 0, 'unchanged': 3,
+            'removed': 0, 'failed': 0}
+        index = zoocfg.FleetIndex(self.index)
+        try:
+            self.assertEqual(index.query('tickTime>0'), file_names)
+        finally:
+            index.close()
+
+    def test_invalid_index_and_query(self):
+        with open(self.index, 'w') as f:
+            f.write('not an index')
+        self.assertRaises(ValueError, zoocfg.FleetIndex, self.index)
+        self.assertRaises(ValueError, zoocfg.FleetIndex.parse_query, 'snapCount')
+        self.assertRaises(ValueError, zoocfg.FleetIndex.parse_query, 'bogus=1')
+        self.assertRaises(ValueError, zoocfg.FleetIndex.parse_query, 'snapCount<many')
+
+        # an unreadable index is rebuilt
+        file_name = self.write('zoo.cfg', 'tickTime=2000\n')
+        assert zoocfg.FleetIndex.update(self.index, [file_name])['parsed'] == 1
+
+    def test_command_line(self):
+        self.fleet(10)
+        r = zoocfg.main(['--index', self.index, self.dir])
+        assert r == 0
+        assert sys.stdout.getvalue().startswith('Indexed 10 file(s) in %s: '
+            '10 parsed, 0 unchanged, 0 removed, 0 failed' % self.index)
+
+        sys.stdout = StringIO()
+        r = zoocfg.main(['--index', self.index, '--query', 'skipACL=yes,servers<2'])
+        index = zoocfg.FleetIndex(self.index)
+        expected = index.query('skipACL=yes,servers<2')
+        index.close()
+        assert r == 0 and expected
+        self.assertEqual(sys.stdout.getvalue().split(), expected)
+
+        assert zoocfg.main(['--index', self.index, '--query', 'bogus=1']) == -1
+        assert zoocfg.main(['--query', 'skipACL=yes']) == -1
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.path, 'zoo.cfg')
+        self.write(self.file_name, TYPICAL_ZOO_CFG)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, file_name, content):
+        with open(file_name, 'w') as f:
+            f.write(content)
+
+    def check_changes(self, use_inotify):
+        watcher = zoocfg.Watcher([self.path], interval=0.01, 
+            settle=0.01, use_inotify=use_inotify)
+        try:
+            assert watcher.files == [self.file_name]
+            assert watcher.changes(timeout=0.05) == set()
+
+            self.write(self.file_name, TYPICAL_ZOO_CFG + 'snapCount=100\n')
+            os.utime(self.file_name, (1, 1))
+            assert watcher.changes(timeout=2) == set([self.file_name])
+
+            other = os.path.join(self.path, 'other.cfg')
+            self.write(other, 'tickTime=2000\n')
+            self.write(os.path.join(self.path, 'ignored.txt'), '')
+            assert watcher.changes(timeout=2) == set([other])
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        self.check_changes(use_inotify=False)
+
+    def test_inotify(self):
+        if not zoocfg.Watcher([self.path]).uses_inotify:
+            return # not available on this platform
+        self.check_changes(use_inotify=True)
+
+    def test_check_keeps_parsed_configs(self):
+        watcher = zoocfg.Watcher([self.file_name], use_inotify=False)
+        check = watcher.check(self.file_name)
+        cfg = watcher.configs[self.file_name]
+        assert len(check.warnings) == 1
+
+        self.write(self.file_name, TYPICAL_ZOO_CFG + 'snapCount=100\n')
+        check = watcher.check(self.file_name)
+
+        assert watcher.configs[self.file_name] is cfg
+        assert cfg.snapCount == 100
+        assert len(check.warnings) == 2
+
+    def test_cached_findings_follow_line_numbers(self):
+        watcher = zoocfg.Watcher([self.file_name], use_inotify=False)
+        self.write(self.file_name, 'tickTime=2000\nsnapCount=100\n')
+        first = [f for f in watcher.check(self.file_name).findings 
+            if f.key == 'snapCount']
+        assert [f.line for f in first] == [2]
+
+        self.write(self.file_name, '# moved down\n\ntickTime=2000\nsnapCount=100\n')
+        check = watcher.check(self.file_name)
+        assert watcher.configs[self.file_name].line_of('snapCount') == 4
+        assert [f.line for f in check.findings if f.key == 'snapCount'] == [4]
+        assert [f.line for f in first] == [2] # earlier results are kept
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = zoocfg.Daemon(os.path.join(self.path, 'zoocfg.sock'))
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.client = zoocfg.DaemonClient(self.server.server_address)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.path)
+
+    def test_check_content_and_path(self):
+        expected = zoocfg.Rules.check_all(ZooCfg(TYPICAL_ZOO_CFG))
+
+        check = self.client.check(content=TYPICAL_ZOO_CFG)
+        self.assertEqual(check.warnings, expected.warnings)
+
+        check = self.client.check(path=abspath('samples/standalone-zoo.cfg'))
+        assert len(check.warnings) == 2
+
+        check = self.client.check(content=TYPICAL_ZOO_CFG, select=['TickTime'])
+        assert not check.has_warnings()
+
+    def test_errors_and_stats(self):
+        self.assertRaises(ValueError, self.client.check, path='/missing/zoo.cfg')
+        self.client.check(content=TYPICAL_ZOO_CFG)
+
+        stats = self.client.stats()
+        assert stats['requests'] == 2
+        assert stats['failures'] == 1
+        assert stats['max_latency'] >= stats['avg_latency'] > 0
+
+    def test_concurrent_clients(self):
+        results = []
+        def run():
+            client = zoocfg.DaemonClient(self.server.server_address)
+            for _ in range(20):
+                results.append(client.check(content=TYPICAL_ZOO_CFG))
+            client.close()
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        assert len(results) == 80
+        assert self.client.stats()['requests'] == 80
+
+class TestDaemonStartup(CapturingTestCase):
+
+    def setUp(self):
+        super(TestDaemonStartup, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.sock = os.path.join(self.path, 'zoocfg.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(TestDaemonStartup, self).tearDown()
+
+    def test_replace_stale_socket_only(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.sock)
+        stale.close() # bound but nobody listens anymore
+        zoocfg.Daemon(self.sock).server_close()
+
+        server = zoocfg.Daemon(self.sock)
+        try:
+            self.assertRaises(IOError, zoocfg.Daemon, self.sock)
+            assert zoocfg.main(['--daemon', self.sock]) == -1
+            assert 'already listening' in self.stderr()
+        finally:
+            server.server_close()
+
+        with open(self.sock, 'w') as f:
+            f.write('precious')
+        assert zoocfg.main(['--daemon', self.sock]) == -1
+        assert open(self.sock).read() == 'precious'
+
+    def test_main_returns_after_shutdown(self):
+        servers, results, saved = [], [], zoocfg.Daemon
+        class Daemon(saved):
+            def __init__(self, path, timeout=None):
+                saved.__init__(self, path, timeout)
+                servers.append(self)
+
+        zoocfg.Daemon = Daemon
+        try:
+            thread = threading.Thread(target=lambda: 
+                results.append(zoocfg.main(['--daemon', self.sock])))
+            thread.start()
+            while not servers and thread.is_alive():
+                time.sleep(0.01)
+            servers[0].shutdown()
+            thread.join()
+        finally:
+            zoocfg.Daemon = saved
+
+        assert results == [0] and self.stderr() == ''
+        assert not os.path.exists(self.sock)
+
+class TestEnsemble(CapturingTestCase):
+
+    def ensemble(self, *contents):
+        ensemble = zoocfg.Ensemble()
+        for i, content in enumerate(contents):
+            ensemble.add('zoo%d.cfg' % (i + 1), ZooCfg(content), 
+                myid=i + 1, host='zoo%d' % (i + 1))
+        return ensemble
+
+    def test_consistent_ensemble(self):
+        check = self.ensemble(*[TYPICAL_ZOO_CFG] * 3).check()
+
+        assert not check.has_errors() and not check.has_warnings()
+
+    def test_mismatched_settings(self):
+        other = TYPICAL_ZOO_CFG.replace('tickTime=2000', 'tickTime=3000')
+        check = self.ensemble(TYPICAL_ZOO_CFG, TYPICAL_ZOO_CFG, other).check()
+
+        self.assertEqual(check.errors, ('Members disagree on `tickTime`: '
+            '2000 (zoo1.cfg, zoo2.cfg); 3000 (zoo3.cfg).',))
+
+    def test_mismatched_server_list(self):
+        other = TYPICAL_ZOO_CFG.replace('zoo3:2888', 'zoo4:2888')
+        check = self.ensemble(TYPICAL_ZOO_CFG, TYPICAL_ZOO_CFG, other).check()
+
+        assert len(check.errors) == 2
+        assert check.errors[0] == '`zoo3.cfg`: `server.3` points to `zoo4` '\
+            'but the member runs on `zoo3`.'
+        assert check.errors[1].startswith('Members disagree on the server list')
+
+    def test_myid(self):
+        ensemble = self.ensemble(TYPICAL_ZOO_CFG)
+        ensemble.add('zoo4.cfg', ZooCfg(TYPICAL_ZOO_CFG), myid=4)
+        ensemble.add('zoo5.cfg', ZooCfg(TYPICAL_ZOO_CFG), myid=1)
+        ensemble.add('zoo6.cfg', ZooCfg(TYPICAL_ZOO_CFG.replace('/var/zookeeper/', '/missing')))
+        check = ensemble.check()
+
+        self.assertEqual(check.errors, (
+            '`zoo4.cfg`: myid 4 has no `server.4` entry.',
+            '`zoo1.cfg` and `zoo5.cfg` both use myid 1.'))
+        self.assertEqual(check.warnings, 
+            ('`zoo6.cfg`: unable to find the `myid` of the member.',))
+
+    def test_read_myid_from_data_dir(self):
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, 'myid'), 'w') as f:
+                f.write('2\n')
+            cfg = ZooCfg('dataDir=%s' % path)
+            assert zoocfg.Ensemble.read_myid(cfg) == 2
+        finally:
+            shutil.rmtree(path)
+
+    def members(self, root, myids):
+        servers = ''.join('server.%d=zk%d:2888:3888\n' % (i, i) for i in (1, 2, 3))
+        for i, myid in enumerate(myids):
+            directory = os.path.join(root, 'zk%d' % (i + 1))
+            os.mkdir(directory)
+            with open(os.path.join(directory, 'zoo.cfg'), 'w') as f:
+                f.write(TYPICAL_ZOO_CFG.split('server.')[0] + servers)
+            if myid is not None:
+                with open(os.path.join(directory, 'myid'), 'w') as f:
+                    f.write('%d\n' % myid)
+
+    def test_identity_from_the_command_line(self):
+        root = tempfile.mkdtemp()
+        try:
+            self.members(root, [1, 2, 2])
+            r = zoocfg.main(['-e', root])
+            output = sys.stdout.getvalue()
+            assert r == 2
+            assert '`%s/zk3/zoo.cfg`: `server.2` points to `zk2` but the member '\
+                'runs on `zk3`.' % root in output
+            assert '`%s/zk2/zoo.cfg` and `%s/zk3/zoo.cfg` both use myid 2.' % \
+                (root, root) in output
+
+            # no myid file: the host is the directory name, unless given
+            os.unlink(os.path.join(root, 'zk3', 'myid'))
+            sys.stdout = StringIO()
+            assert zoocfg.main(['-e', '-w', root]) == 0
+            assert zoocfg.main(['-e', root, '--member', 'zk3=1']) == 2
+            assert 'points to `zk1` but the member runs on `zk3`' in sys.stdout.getvalue()
+            assert zoocfg.main(['-e', root, '--member', 'zk3']) == -1
+        finally:
+            shutil.rmtree(root)
+
+class TestRestartPlan(CapturingTestCase):
+
+    def cfg(self, ids, extra=''):
+        return ZooCfg('tickTime=2000\ninitLimit=10\ndataDir=/var/zookeeper\n' + 
+            extra + ''.join('server.%d=zk%d:2888:3888\n' % (i, i) for i in ids))
+
+    def steps(self, plan):
+        return [(s.action, s.server, s.role, s.safe) for s in plan.steps]
+
+    def test_diff_categories(self):
+        diff = zoocfg.ConfigDiff(self.cfg([1, 2, 3]), 
+            self.cfg([1, 2], 'syncLimit=3\nmaxClientCnxns=20\nsnapCount=10\n'))
+        categories = diff.by_category()
+
+        self.assertEqual(sorted(categories), ['limits', 'membership', 'storage', 'timing'])
+        change = categories['membership'][0]
+        assert (change.key, change.old, change.new) == ('server.3', 'zk3:2888:3888', None)
+        assert not zoocfg.ConfigDiff(self.cfg([1]), self.cfg([1]))
+
+    def test_followers_before_leader(self):
+        plan = zoocfg.RestartPlan(self.cfg([1, 2, 3]), self.cfg([1, 2, 3], 'snapCount=10\n'), 
+            leader=2)
+
+        self.assertEqual(self.steps(plan), [('restart', 1, 'follower', True), 
+            ('restart', 3, 'follower', True), ('restart', 2, 'leader', True)])
+        assert plan.safe and plan.unavailability == 20000 and plan.duration == 60000
+
+    def test_grow_and_shrink(self):
+        plan = zoocfg.RestartPlan(self.cfg([1, 2, 3]), self.cfg([1, 2, 3, 4, 5]))
+        self.assertEqual([(s.action, s.server) for s in plan.steps], [('start', 4), 
+            ('start', 5), ('restart', 1), ('restart', 2), ('restart', 3)])
+        assert plan.safe
+
+        plan = zoocfg.RestartPlan(self.cfg([1, 2, 3, 4, 5]), self.cfg([1, 2, 3]), leader=4)
+        self.assertEqual([(s.action, s.server) for s in plan.steps], [('restart', 1), 
+            ('restart', 2), ('restart', 3), ('stop', 5), ('stop', 4)])
+        assert plan.safe
+
+    def test_quorum_loss(self):
+        plan = zoocfg.RestartPlan(self.cfg([1, 2]), self.cfg([1, 2], 'snapCount=10\n'))
+
+        assert not plan.safe
+        assert plan.unavailability == 40000
+        assert not zoocfg.RestartPlan(self.cfg([1, 2]), self.cfg([1, 2])).steps
+
+    def test_from_ensembles(self):
+        old, new = zoocfg.Ensemble(), zoocfg.Ensemble()
+        for i in (1, 2, 3):
+            old.add('zk%d' % i, self.cfg([1, 2, 3]), myid=i)
+            new.add('zk%d' % i, self.cfg([1, 2, 3], i == 3 and 'snapCount=10\n' or ''), myid=i)
+
+        plan = zoocfg.RestartPlan.from_ensembles(old, new)
+        self.assertEqual(self.steps(plan), [('restart', 3, 'leader', True)])
+
+    def ensemble_dirs(self, root, names, tick=2000):
+        for name in names:
+            os.makedirs(os.path.join(root, name))
+            with open(os.path.join(root, name, 'zoo.cfg'), 'w') as f:
+                f.write('tickTime=%d\ninitLimit=10\ndataDir=/var/zookeeper\n%s' % 
+                    (tick, ''.join('server.%d=zk%d:2888:3888\n' % (i, i) for i in (1, 2, 3))))
+
+    def test_members_without_myid(self):
+        root = tempfile.mkdtemp()
+        try:
+            # the hosts are the directory names
+            self.ensemble_dirs(os.path.join(root, 'old'), ['zk1', 'zk2', 'zk3'])
+            self.ensemble_dirs(os.path.join(root, 'new'), ['zk1', 'zk2', 'zk3'], 4000)
+            r = zoocfg.main(['--diff', os.path.join(root, 'old'), os.path.join(root, 'new')])
+            output = sys.stdout.getvalue()
+            assert r == 0
+            assert 'tickTime: 2000 -> 4000' in output
+            assert '3. restart server.3 (leader)' in output
+
+            # nothing tells which server each member is
+            self.ensemble_dirs(os.path.join(root, 'a'), ['m1', 'm2', 'm3'])
+            self.ensemble_dirs(os.path.join(root, 'b'), ['m1', 'm2', 'm3'], 4000)
+            old, new = [zoocfg.Ensemble.from_files(zoocfg.expand_paths(
+                [os.path.join(root, name)])) for name in ('a', 'b')]
+            self.assertRaises(ValueError, zoocfg.RestartPlan.from_ensembles, old, new)
+
+            r = zoocfg.main(['--diff', os.path.join(root, 'a'), os.path.join(root, 'b')])
+            assert r == -1
+            assert 'Unable to find the server id of' in sys.stderr.getvalue()
+
+            r = zoocfg.main(['--diff', os.path.join(root, 'a'), os.path.join(root, 'b'),
+                '--member', 'm1=1', '--member', 'm2=2', '--member', 'm3=3'])
+            assert r == 0
+        finally:
+            shutil.rmtree(root)
+
+    def test_no_empty_plan_for_changes(self):
+        self.assertRaises(ValueError, zoocfg.RestartPlan, ZooCfg('tickTime=2000\n'
+            'initLimit=10\n'), ZooCfg('tickTime=4000\ninitLimit=10\n'))
+
+class TestQuorumSimulator(unittest.TestCase):
+
+    def cfg(self, ids, observers=()):
+        return ZooCfg('tickTime=100\nsyncLimit=2\n' + ''.join(
+            'server.%d=zk%d:2888:3888%s\n' % (i, i, i in observers and ':observer' or '') 
+            for i in ids))
+
+    def test_commit_waits_for_majority(self):
+        latency = {(5, 1): (1.0, 0.01), (5, 2): (2.0, 0.01), (3, 5): (50.0, 0.01), 
+            (4, 5): (80.0, 0.01)}
+        sim = zoocfg.QuorumSimulator(self.cfg([1, 2, 3, 4, 5]), latency, seed=1)
+        result = sim.run(1000, use_numpy=False)
+
+        assert sim.leader == 5 and sim.quorum == 3
+        self.assertAlmostEqual(result['commit_p50'], 2.0, places=1)
+        self.assertAlmostEqual(result['election_p50'], 204.0, places=0)
+        assert result['follower_timeout'] == result['quorum_loss'] == 0
+
+    def test_observers_do_not_vote(self):
+        sim = zoocfg.QuorumSimulator(self.cfg([1, 2, 3, 4], observers=(4,)))
+        assert sim.leader == 3 and sim.followers == [1, 2] and sim.quorum == 2
+
+    def test_timeouts_and_quorum_loss(self):
+        sim = zoocfg.QuorumSimulator(self.cfg([1, 2, 3]), default=(400.0, 0.01), seed=1)
+        result = sim.run(100, use_numpy=False)
+
+        assert result['follower_timeout'] == 1.0 and result['quorum_loss'] == 1.0
+        check = sim.advise(result)
+        assert len(check.warnings) == 3
+        assert check.warnings[1].startswith('Followers exceed `syncLimit` (200ms)')
+
+    def test_numpy_matches_python(self):
+        sim = zoocfg.QuorumSimulator(self.cfg([1, 2, 3, 4, 5]), default=(5.0, 0.5), seed=1)
+        if sim._numpy() is None:
+            self.assertRaises(ValueError, sim.run, 10, True)
+            return
+
+        a, b = sim.run(20000, use_numpy=True), sim.run(20000, use_numpy=False)
+        self.assertAlmostEqual(a['commit_p50'] / b['commit_p50'], 1.0, places=1)
+
+class TestBench(unittest.TestCase):
+
+    def test_generate_config(self):
+        import bench
+        content = bench.generate_config(keys=100, servers=20, comments=2, broken=0.1)
+        cfg = ZooCfg(content)
+
+        assert len(cfg.get_servers()) == 20
+        assert len([s for s in cfg.get_servers() if s.is_observer]) == 2
+        assert len([k for k in cfg if k.startswith('key')]) == 90
+        assert content.count('# comment line') == 2 * (6 + 100 + 20)
+
+    def test_startup_defers_imports(self):
+        code = 'import sys, zoocfg; print sorted(m for m in %r if m in sys.modules)' % \
+            ['json', 'hashlib', 'tempfile', 'socket', 'threading', 'SocketServer', 'optparse']
+        output = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+        self.assertEqual(output.strip(), '[]')
+
+    def test_measure_startup(self):
+        import bench
+        total, interpreter = bench.measure_startup(runs=5)
+        assert total > interpreter > 0
+
+    def test_check_one_file_without_optparse(self):
+        def run(*argv):
+            code = 'import sys, zoocfg; zoocfg.main(%r); print "optparse" in sys.modules' % \
+                list(argv)
+            return subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+
+        simple = run('-w', '-f', 'samples/standalone-zoo.cfg')
+        full = run('-w', '-f', 'samples/standalone-zoo.cfg', '-j', '1')
+        assert simple.endswith('False\n') and full.endswith('True\n')
+        self.assertEqual(simple[:-len('False\n')], full[:-len('True\n')])
+
+        assert zoocfg._simple_args(['-w', 'a.cfg', '--file', 'b.cfg']) == (['a.cfg', 'b.cfg'], True)
+        assert zoocfg._simple_args(['-j', '2', 'a.cfg']) is None
+        assert zoocfg._simple_args(['-f']) is None
+
+    def test_run_selected_benchmarks(self):
+        import bench
+        results = bench.run(['small'], ['parse', 'rule.TickTime'], min_time=0.001)
+
+        self.assertEqual(sorted(results), ['small/parse', 'small/rule.TickTime'])
+
+class TestRuleScheduler(CapturingTestCase):
+
+    def setUp(self):
+        super(TestRuleScheduler, self).setUp()
+        registry = zoocfg.RuleRegistry
+        self.saved = (registry.table, dict(registry.rules), registry.plugins)
+
+    def tearDown(self):
+        super(TestRuleScheduler, self).tearDown()
+        registry = zoocfg.RuleRegistry
+        registry.table, registry.rules, registry.plugins = self.saved
+        registry._selections = {}
+
+    def io_rule(self, id, delay, timeout=None, error=None):
+        def check(cls, cfg):
+            time.sleep(delay)
+            if error:
+                raise error
+            return ['%s done' % id], []
+
+        return zoocfg.RuleRegistry(id, (zoocfg.Rules.BaseRule,), {'io': True,
+            'timeout': timeout, 'keys': ('tickTime',), 'check': classmethod(check)})
+
+    def test_slow_rule_times_out(self):
+        self.io_rule('SlowRule', 2, timeout=0.1)
+        cfg = ZooCfg('tickTime=-1\n')
+
+        start = time.time()
+        check = zoocfg.Rules.check_all(cfg, select=['SlowRule', 'TickTime'])
+        assert time.time() - start < 1
+
+        self.assertEqual(check.errors, (
+            '`tickTime` should be a positive number measured in milliseconds',
+            '`SlowRule` rule timed out after 0.1s'))
+
+    def test_io_rules_run_concurrently(self):
+        for i in range(3):
+            self.io_rule('Sleep%d' % i, 0.2)
+
+        start = time.time()
+        check = zoocfg.Rules.check_all(ZooCfg(), select=['Sleep0', 'Sleep1', 'Sleep2'])
+        assert time.time() - start < 0.5
+        self.assertEqual(check.warnings, ('Sleep0 done', 'Sleep1 done', 'Sleep2 done'))
+
+    def test_io_rule_errors(self):
+        self.io_rule('Broken', 0, error=IOError('stale NFS handle'))
+        check = zoocfg.Rules.check_all(ZooCfg(), select=['Broken'])
+        self.assertEqual(check.errors, ('`Broken` rule check failed: stale NFS handle',))
+
+    def test_lone_io_rule_runs_inline(self):
+        threads = []
+        def check(cls, cfg):
+            threads.append(threading.current_thread())
+            return [], []
+        zoocfg.RuleRegistry('Inline', (zoocfg.Rules.BaseRule,), {'io': True,
+            'keys': ('tickTime',), 'check': classmethod(check)})
+
+        zoocfg.Rules.check_all(ZooCfg(), select=['Inline'])
+        assert threads == [threading.current_thread()]
+        assert signal.getsignal(signal.SIGALRM) == signal.SIG_DFL
+
+    def test_inline_call_restores_the_previous_alarm(self):
+        alarms = []
+        handler = lambda signum, frame: alarms.append(signum)
+        saved = signal.signal(signal.SIGALRM, handler)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 5)
+            pool = zoocfg.RulePool()
+            assert pool.call(1, lambda: threading.current_thread()) is \
+                threading.current_thread()
+            self.assertRaises(zoocfg.RuleTimeout, pool.call, 0.05, time.sleep, 1)
+
+            assert signal.getsignal(signal.SIGALRM) is handler
+            assert 4 < signal.getitimer(signal.ITIMER_REAL)[0] <= 5
+            assert not alarms
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, saved)
+
+    def test_timeout_argument(self):
+        self.io_rule('SlowRule', 2)
+        default = zoocfg.Rules.TIMEOUT
+        check = zoocfg.Rules.check_all(ZooCfg(), select=['SlowRule'], timeout=0.1)
+        self.assertEqual(check.errors, ('`SlowRule` rule timed out after 0.1s',))
+
+        zoocfg.main(['--rule-timeout', '0.1', '-r', 'SlowRule',
+            'samples/standalone-zoo.cfg', 'samples/replicated-zoo.cfg'])
+        assert self.stdout().count('timed out after 0.1s') == 2
+        assert zoocfg.Rules.TIMEOUT == default
+
+    def test_wait_does_not_poll(self):
+        pool = zoocfg.RulePool()
+        pool.wait(pool.submit(time.sleep, 0), 1) # start the worker
+        start = time.time()
+        for i in range(20):
+            pool.wait(pool.submit(time.sleep, 0.004), 1)
+        assert time.time() - start < 20 * 0.006
+
+    def test_cancel_queued_task(self):
+        pool, ran = zoocfg.RulePool(size=1), []
+        slow = pool.submit(time.sleep, 0.3)
+        queued = pool.submit(ran.append, 1)
+
+        self.assertRaises(zoocfg.RuleTimeout, pool.wait, queued, 0.05)
+        assert pool.wait(slow, 1) is None
+        time.sleep(0.05)
+        assert ran == [] and queued.state == 'cancelled'
+
+    def test_load_plugins(self):
+        test = self
+
+        class EntryPoint(object):
+            name = 'site'
+            def load(self):
+                test.io_rule('SitePolicy', 0)
+
+        assert zoocfg.RuleRegistry.load_plugins([EntryPoint()]) == ['site']
+        assert zoocfg.RuleRegistry.load_plugins([EntryPoint()]) == ['site']
+        assert 'SitePolicy' in zoocfg.RuleRegistry.ids()
+
 class TestRules(unittest.TestCase):
 
     def check(self, cls, warning_count, error_count, cfg=None, **kwargs):
@@ -169,6 +1790,69 @@ class TestRules(unittest.TestCase):
         self.assertEqual(len(w), warning_count)
         self.assertEqual(len(e), error_count, str(e))
 
+    def test_rule_table_is_ordered(self):
+        ids = zoocfg.RuleRegistry.ids()
+
+        assert ids[:3] == ('ClientPort', 'TickTime', 'DataDir')
+        assert ids[-1] == 'OddNumberOfServers'
+        assert 'BaseRule' not in ids
+
+    def test_select_and_exclude_rules(self):
+        table = zoocfg.RuleRegistry.select(['TickTime', 'ClientPort'])
+        self.assertEqual([id for id, _ in table], ['ClientPort', 'TickTime'])
+
+        table = zoocfg.RuleRegistry.select(exclude=['TickTime'])
+        assert len(table) == len(zoocfg.RuleRegistry.table) - 1
+
+        self.assertRaises(ValueError, zoocfg.RuleRegistry.select, ['Dummy'])
+
+        check = zoocfg.Rules.check_all(ZooCfg(), select=['TickTime'])
+        self.assertEqual(check.errors, ('No `tickTime` found in config file.',))
+
+    def test_duplicate_rule_id(self):
+        def define():
+            class TickTime(zoocfg.Rules.BaseRule):
+                pass
+        self.assertRaises(ValueError, define)
+
+    def test_check_incremental_matches_check_all(self):
+        cfg = ZooCfg(TYPICAL_ZOO_CFG)
+        check = zoocfg.Rules.check_incremental(cfg)
+        self.assertEqual(check.warnings, zoocfg.Rules.check_all(cfg).warnings)
+
+        cfg['snapCount'] = 100
+        cfg['server.4'] = 'zoo4:2888:3888'
+        check = zoocfg.Rules.check_incremental(cfg)
+        expected = zoocfg.Rules.check_all(cfg)
+        self.assertEqual(check.warnings, expected.warnings)
+        self.assertEqual(check.errors, expected.errors)
+        assert len(check.warnings) == 4
+
+    def test_check_incremental_reruns_only_affected_rules(self):
+        cfg = ZooCfg(TYPICAL_ZOO_CFG)
+        zoocfg.Rules.check_incremental(cfg)
+
+        cfg._rule_results['TickTime'] = (['cached'], [])
+        cfg._rule_results['SnapCount'] = (['cached'], [])
+        cfg._rule_results['OddNumberOfServers'] = (['cached'], [])
+
+        cfg['snapCount'] = 10000
+        del cfg['server.3']
+        check = zoocfg.Rules.check_incremental(cfg)
+
+        assert check.warnings.count('cached') == 1
+        assert 'You should run at least 3 ZooKeeper servers.' in check.warnings
+
+    def test_rules_coerce_raw_values(self):
+        self.check('TickTime', 0, 0, tickTime='2000')
+        self.check('ClientPort', 1, 0, clientPort='100')
+        self.check('SkipACL', 1, 0, skipACL='yes')
+        self.check('SkipACL', 0, 0, skipACL=False)
+        self.check('DataDir', 0, 1, dataDir='')
+
+        assert zoocfg.Rules.SessionTimeout.keys == \
+            ('minSessionTimeout', 'maxSessionTimeout')
+
     def test_clientPort(self):
         self.check('ClientPort', 1, 0, clientPort=100)
         self.check('ClientPort', 0, 1, clientPort=10**6)
@@ -183,7 +1867,41 @@ class TestRules(unittest.TestCase):
 
     def test_dataLogDir(self):
         self.check('DataLogDir', 1, 0, dataDir='/a/b', dataLogDir='/a/b')
-        self.check('DataLogDir', 0, 0, dataDir='/a/b1', dataLogDir='/a/b2')
+        # missing paths fall back to the nearest existing parent: same device
+        self.check('DataLogDir', 1, 0, dataDir='/a/b1', dataLogDir='/a/b2')
+        if os.path.isdir('/proc'):
+            self.check('DataLogDir', 0, 0, dataDir='/a/b1', dataLogDir='/proc/zookeeper')
+
+        root = tempfile.mkdtemp()
+        try:
+            data, log = os.path.join(root, 'data'), os.path.join(root, 'log')
+            w, e = zoocfg.Rules.DataLogDir.check(dotdict(dataDir=data, dataLogDir=log))
+            info = zoocfg.storage_info(root)
+        finally:
+            shutil.rmtree(root)
+        side = '%s, %s mounted on %s' % (info['source'], info['fstype'], info['mount_point'])
+        assert w[0].startswith('`dataDir` and `dataLogDir` are on the same device '
+            '%d:%d (`dataDir`: %s; `dataLogDir`: %s). ' % (os.major(info['device']),
+            os.minor(info['device']), side, side)), w
+
+    def test_storage_info(self):
+        root = tempfile.mkdtemp()
+        try:
+            info = zoocfg.storage_info(os.path.join(root, 'missing', 'log'))
+            self.assertEqual(info['resolved'], os.path.realpath(root))
+            self.assertEqual(info['device'], os.stat(root).st_dev)
+        finally:
+            shutil.rmtree(root)
+
+    def test_mountinfo(self):
+        mounts = zoocfg.Mounts.parse([
+            '22 1 253:0 / / rw,relatime shared:1 - ext4 /dev/vda rw',
+            '40 22 0:35 / /var/lib/zk\\040log rw shared:2 master:1 - xfs /dev/sdb1 rw',
+            'garbage',
+        ])
+        self.assertEqual(mounts.find('/var/lib/zk log/version-2').source, '/dev/sdb1')
+        self.assertEqual(mounts.find('/var/lib/zk').fstype, 'ext4')
+        self.assertEqual(mounts.find('/').source, '/dev/vda')
 
     def test_globalOutstandingLimit(self):
         self.check('GlobalOutstandingLimit', 0, 1, globalOutstandingLimit=-5)
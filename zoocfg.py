@@ -17,17 +17,427 @@
 # limitations under the License.
 
 import sys
+import os
 import re
+import glob
+import fnmatch
+import math
+import time
+import errno
+import select
+import struct
 
-from StringIO import StringIO
-from optparse import OptionParser
+from cStringIO import StringIO
+
+# json, hashlib, tempfile, socket, threading, SocketServer and optparse
+# are imported where they are used to keep the start up time low
 
 class dotdict(dict):
     """ Extend the standard dict to allow dot syntax """
     def __getattr__(self, name):
         return self[name]
 
-class ZooCfg(dotdict):
+_WHITESPACE = ' \t\f'
+
+_SIMPLE_LINE = re.compile(r'[ \t\f]*([^=:\s]+)[ \t\f]*([=:]?)[ \t\f]*(.*)')
+
+_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'f': '\f'}
+
+_HEX_DIGITS = '0123456789abcdefABCDEF'
+
+def tokenize(source):
+    """ Split a Java properties stream into (line number, key, value) tuples
+
+    The source can be a string, a file-like object or an mmap. It is
+    consumed one line at a time so the content is never fully loaded
+    in memory. Supports `=`, `:` and whitespace separators, `#` and `!`
+    comments, escapes and line continuations. Unlike plain Java
+    properties an unescaped `#` also starts a comment at the end of a
+    line and keys without a value are skipped as broken lines. """
+    if isinstance(source, basestring):
+        source = StringIO(source)
+
+    if hasattr(source, '__iter__'):
+        lines = iter(source)
+    else:
+        lines = iter(source.readline, '')
+
+    match = _SIMPLE_LINE.match
+    line_no = 0
+    for line in lines:
+        line_no += 1
+
+        if '\\' in line:
+            start = line_no
+            line = line.lstrip(_WHITESPACE).rstrip('\r\n')
+            if not line or line[0] in '#!':
+                continue
+
+            line = _strip_comment(line)
+            while _is_continued(line):
+                next_line = next(lines, '')
+                line_no += 1
+                line = _strip_comment(line[:-1] + 
+                    next_line.lstrip(_WHITESPACE).rstrip('\r\n'))
+
+            try:
+                pair = _split_escaped(line)
+            except ValueError, e:
+                raise ValueError, '%s found in config file on line %d.' % (e, start)
+            if pair is not None:
+                yield start, pair[0], pair[1]
+            continue
+
+        if '#' in line:
+            line = line[:line.index('#')]
+
+        m = match(line)
+        if m is None or m.group(1)[0] == '!':
+            continue
+
+        key, sep, value = m.groups()
+        value = value.strip()
+        if sep or value:
+            yield line_no, key, value
+
+def _is_continued(line):
+    """ A line ending in an odd number of backslashes continues on the next line """
+    count = len(line) - len(line.rstrip('\\'))
+    return count % 2 == 1
+
+def _strip_comment(line):
+    """ Cut the line at the first unescaped `#` """
+    i = line.find('#')
+    while i > 0:
+        count = len(line[:i]) - len(line[:i].rstrip('\\'))
+        if count % 2 == 0:
+            break
+        i = line.find('#', i + 1)
+    return line if i < 0 else line[:i]
+
+def _split_escaped(line):
+    key, value, sep = [], [], False
+    current = key
+
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i]
+        if c == '\\' and i + 1 < n:
+            i += 1
+            c = line[i]
+            if c == 'u':
+                digits = line[i+1:i+5]
+                if len(digits) != 4 or digits.strip(_HEX_DIGITS):
+                    raise ValueError, 'Invalid escape `\\u%s`' % digits
+                current.append(unichr(int(digits, 16)).encode('utf-8'))
+                i += 4
+            else:
+                current.append(_ESCAPES.get(c, c))
+
+        elif c == '#':
+            break
+
+        elif current is key and (c in '=:' or c in _WHITESPACE):
+            current = value
+            while i + 1 < n and line[i+1] in _WHITESPACE:
+                i += 1
+            if c not in '=:' and i + 1 < n and line[i+1] in '=:':
+                i += 1
+                c = line[i]
+                while i + 1 < n and line[i+1] in _WHITESPACE:
+                    i += 1
+            sep = c in '=:'
+
+        else:
+            current.append(c)
+        i += 1
+
+    key, value = ''.join(key), ''.join(value).strip()
+    if not key or (not sep and not value):
+        return None # just skip broken line
+
+    return key, value
+
+class Setting(object):
+    """ Type, unit and allowed values of a known ZooKeeper setting """
+
+    __slots__ = ('name', 'type', 'unit', 'min', 'max', 'choices', 
+        'required', 'message')
+
+    def __init__(self, name, type=str, unit=None, min=None, max=None,
+            choices=None, required=False, message=None):
+        self.name = name
+        self.type = type
+        self.unit = unit
+        self.min = min
+        self.max = max
+        self.choices = choices
+        self.required = required
+        self.message = message or '`%s` has an invalid value.' % name
+
+    def coerce(self, value):
+        """ Convert a raw string to the type of the setting. Returns
+        the value unchanged if it is not a string or not valid. """
+        if not isinstance(value, basestring) or self.type is str:
+            return value
+
+        if self.type is int:
+            try:
+                return int(value)
+            except ValueError:
+                return value
+
+        if self.type is bool:
+            return {'yes': True, 'no': False}.get(value.strip().lower(), value)
+
+        return value
+
+    def accepts(self, value):
+        if self.type is int:
+            if not isinstance(value, (int, long)) or isinstance(value, bool):
+                return False
+            if self.min is not None and value < self.min:
+                return False
+            if self.max is not None and value > self.max:
+                return False
+
+        elif self.type is bool:
+            if not isinstance(value, bool):
+                return False
+
+        elif not isinstance(value, basestring) or not value:
+            return False
+
+        return self.choices is None or value in self.choices
+
+    def positive(self, cfg):
+        """ The typed value of an int setting in cfg, or its default.
+        Raises ValueError when it is not a positive integer. """
+        value = self.coerce(cfg.get(self.name, ZooCfg._defaults.get(self.name)))
+        if not self.accepts(value) or not value:
+            raise ValueError, '`%s` should be a positive integer.' % self.name
+        return value
+
+    def validate(self, cfg):
+        """ Return the list of errors found for this setting """
+        if self.name not in cfg:
+            if self.required:
+                return [Finding('No `%s` found in config file.', (self.name,), self.name)]
+            return []
+
+        if not self.accepts(self.coerce(cfg[self.name])):
+            return [Finding(self.message, (), self.name)]
+        return []
+
+    def __repr__(self):
+        return '<Setting name="%s" type="%s">' % (self.name, self.type.__name__)
+
+SCHEMA = dict((setting.name, setting) for setting in (
+    Setting('clientPort', int, 'port', 0, 65535, required=True,
+        message='`clientPort` should be a valid TCP/IP port number.'),
+    Setting('clientPortAddress', str),
+    Setting('tickTime', int, 'ms', 1, required=True,
+        message='`tickTime` should be a positive number measured in milliseconds'),
+    Setting('dataDir', str, 'path', required=True,
+        message='`dataDir` should be a path.'),
+    Setting('dataLogDir', str, 'path', required=True,
+        message='`dataLogDir` should be a path.'),
+    Setting('globalOutstandingLimit', int, 'requests', 0, required=True,
+        message='`globalOutstandingLimit` should be a positive integer'),
+    Setting('preAllocSize', int, 'KB', 0, required=True,
+        message='`preAllocSize` should be a positive number of kilobytes.'),
+    Setting('snapCount', int, 'transactions', 0, required=True,
+        message='`snapCount` should be a positive integer.'),
+    Setting('traceFile', str, 'path'),
+    Setting('maxClientCnxns', int, 'connections', 0, required=True,
+        message='`maxClientCnxns` should be a positive integer or 0.'),
+    Setting('minSessionTimeout', int, 'ms', 0, required=True,
+        message='`minSessionTimeout` should be a positive integer.'),
+    Setting('maxSessionTimeout', int, 'ms', 0, required=True,
+        message='`maxSessionTimeout` should be a positive integer.'),
+    Setting('initLimit', int, 'ticks', 0, required=True,
+        message='`initLimit` should be a positiv number of tick counts.'),
+    Setting('syncLimit', int, 'ticks', 0,
+        message='`syncLimit` should be a positive number of ticks'),
+    Setting('electionAlg', int, choices=(0, 1, 2, 3), required=True,
+        message='Unknown `electionAlg`. Valid values: 0, 1, 2, 3.'),
+    Setting('leaderServers', bool, required=True,
+        message='`leaderServers` should be "yes" or "no".'),
+    Setting('skipACL', bool, required=True,
+        message='`skipACL` should be "yes" or "no".'),
+    Setting('forceSync', bool,
+        message='`forceSync` should be "yes" or "no".'),
+    Setting('cnxTimeout', int, 'ms', 1),
+    Setting('peerType', str, choices=('participant', 'observer')),
+    Setting('autopurge.snapRetainCount', int, 'snapshots', 3),
+    Setting('autopurge.purgeInterval', int, 'hours', 0),
+))
+
+def existing_parent(path):
+    """ Resolve the path or its nearest existing parent directory """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.path.realpath(path)
+
+class Mounts(object):
+    """ Mount points parsed from /proc/self/mountinfo """
+
+    class Mount(object):
+
+        __slots__ = ('mount_point', 'fstype', 'source')
+
+        def __init__(self, mount_point, fstype, source):
+            self.mount_point = mount_point
+            self.fstype = fstype
+            self.source = source
+
+        def __repr__(self):
+            return '<Mounts.Mount mount_point="%s" fstype="%s" source="%s">' % \
+                (self.mount_point, self.fstype, self.source)
+
+    _cache = {}
+
+    def __init__(self, mounts):
+        # the longest mount point wins when looking up a path
+        self.mounts = sorted(mounts, key=lambda m: -len(m.mount_point))
+
+    @classmethod
+    def load(cls, file_name='/proc/self/mountinfo'):
+        """ Parse the mount table once. Returns an empty table if the 
+        file is not available. """
+        try:
+            return cls._cache[file_name]
+        except KeyError:
+            pass
+
+        try:
+            with open(file_name) as f:
+                mounts = cls.parse(f)
+        except IOError:
+            mounts = cls([])
+        cls._cache[file_name] = mounts
+        return mounts
+
+    @classmethod
+    def parse(cls, lines):
+        mounts = []
+        for line in lines:
+            fields = line.split()
+            try:
+                separator = fields.index('-')
+                mount_point = fields[4].decode('string_escape')
+                mounts.append(Mounts.Mount(mount_point, 
+                    fields[separator + 1], fields[separator + 2]))
+            except (ValueError, IndexError):
+                continue # malformed line
+        return cls(mounts)
+
+    def find(self, path):
+        """ Return the Mount holding the path or None """
+        for mount in self.mounts:
+            prefix = os.path.join(mount.mount_point, '')
+            if path == mount.mount_point or path.startswith(prefix):
+                return mount
+        return None
+
+def storage_info(path, mounts=None):
+    """ Return the device, mount point, filesystem type and source 
+    device holding the path or its nearest existing parent """
+    resolved = existing_parent(path)
+    mount = (mounts or Mounts.load()).find(resolved)
+    return {
+        'path': path,
+        'resolved': resolved,
+        'device': os.stat(resolved).st_dev,
+        'mount_point': mount and mount.mount_point,
+        'fstype': mount and mount.fstype,
+        'source': mount and mount.source,
+    }
+
+class _ConfigMethods(object):
+    """ The methods of ZooCfg that only use the mapping interface, shared
+    with CompactZooCfg which is not a dict """
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return self[name]
+
+    @classmethod
+    def from_file(cls, file_name):
+        with open(file_name) as f:
+            return cls(f)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def _changed(self, key):
+        self._changed_keys.add(key)
+        if key.startswith('server.'):
+            if key in self:
+                self._server_keys.add(key)
+            else:
+                self._server_keys.discard(key)
+            self._server_table = None
+
+    def get_servers(self):
+        """ Return the list of servers listed in the config file """
+        return list(self._get_server_table().servers)
+
+    def get_server(self, id):
+        """ Return the server with the given ID or None """
+        return self._get_server_table().by_id.get(id)
+
+    def get_servers_by_host(self, host):
+        """ Return the list of servers running on the given host """
+        return list(self._get_server_table().by_host.get(host, ()))
+
+    def get_server_by_address(self, host, port):
+        """ Return the server using the given quorum or 
+        election port on the given host or None """
+        return self._get_server_table().by_address.get((host, port))
+
+    def _get_server_table(self):
+        if self._server_table is None:
+            servers = []
+            for key in self._server_keys:
+                suffix = key[len('server.'):]
+                if not suffix.isdigit():
+                    continue
+
+                id = int(suffix)
+                if id < 1 or id > 255:
+                    raise ValueError, "Server ID should be an " \
+                        "integer value between 1 and 255. " \
+                        "Got `%s`." % id
+                servers.append(ZooCfg.Server(id, self[key]))
+
+            self._server_table = ZooCfg.ServerTable(servers)
+        return self._server_table
+
+    def _parse(self, content, server_keys, lines):
+        result = {}
+        for line_no, key, value in tokenize(content):
+            if key in result:
+                raise ValueError, 'Duplicate key '\
+                    '`%s` found in config file on line %d.' % (key, line_no)
+            if key.startswith('server.'):
+                server_keys.add(key)
+            result[key] = value
+            lines[key] = line_no
+        return result
+
+class ZooCfg(_ConfigMethods, dotdict):
 
     _defaults = dotdict({
         'globalOutstandingLimit': 1000,
@@ -37,13 +447,16 @@ class ZooCfg(dotdict):
         'minSessionTimeout': 2,
         'maxSessionTimeout': 20,
         'electionAlg': 3,
-        'leaderServers': 'yes',
-        'skipACL': 'no',
+        'leaderServers': True, # yes
+        'skipACL': False, # no
 #       'syncLimit':  10
     })
 
     class Server(object):
 
+        __slots__ = ('_id', '_cfg', '_host', '_port', '_election_port', '_type',
+            '_client_port')
+
         @property
         def id(self): return self._id
 
@@ -56,14 +469,30 @@ class ZooCfg(dotdict):
         @property
         def election_port(self): return self._election_port
 
+        @property
+        def type(self): return self._type
+
+        @property
+        def is_observer(self): return self._type == 'observer'
+
+        @property
+        def client_port(self): return self._client_port
+
         def __init__(self, id, cfg):
             self._id = id
             self._cfg = cfg
             
-            host, port, election_port = cfg.split(':')[:3]
-            self._host = host
+            # host:port:port[:type][;[clientPortAddress:]clientPort]
+            address, _, client = cfg.partition(';')
+            parts = address.split(':')
+            host, port, election_port = parts[:3]
+            self._host = intern(host) if type(host) is str else host
             self._port = int(port)
             self._election_port = int(election_port)
+            self._type = len(parts) > 3 and parts[3].strip() or 'participant'
+
+            if self._type not in ('participant', 'observer'):
+                raise ValueError, 'Invalid server type: %s' % self._type
 
             if not (1 < self._port < 65535):
                 raise ValueError, 'Invalid server port number: %d' % self._port
@@ -71,401 +500,3194 @@ class ZooCfg(dotdict):
             if not (1 < self._election_port < 65535):
                 raise ValueError, 'Invalid election port number: %d' % self._election_port
 
+            self._client_port = None
+            if client.strip():
+                client_port = client.strip().rsplit(':', 1)[-1]
+                if not client_port.isdigit() or not (1 < int(client_port) < 65535):
+                    raise ValueError, 'Invalid client port number: %s' % client_port
+                self._client_port = int(client_port)
+
         def __repr__(self):
             return '<ZooCfg.Server id="%s" '\
                 'cfg="%s">' % (self._id, self._cfg)
 
-    @classmethod
-    def from_file(cls, file_name):
-        return cls(open(file_name).read())
-    
+    class ServerTable(object):
+        """ Servers ordered by ID. The indexes by ID, host and address
+        are built on first use. """
+
+        __slots__ = ('servers', '_by_id', '_by_host', '_by_address')
+
+        def __init__(self, servers):
+            self.servers = tuple(sorted(servers, key=lambda s: s.id))
+            self._by_id = self._by_host = self._by_address = None
+
+            for a, b in zip(self.servers, self.servers[1:]):
+                if a.id == b.id:
+                    raise ValueError, "Duplicate server id "\
+                        "`server.%s`." % a.id
+
+        @property
+        def by_id(self):
+            if self._by_id is None:
+                self._by_id = dict((server.id, server) for server in self.servers)
+            return self._by_id
+
+        @property
+        def by_host(self):
+            if self._by_host is None:
+                self._by_host = {}
+                for server in self.servers:
+                    self._by_host.setdefault(server.host, []).append(server)
+            return self._by_host
+
+        @property
+        def by_address(self):
+            if self._by_address is None:
+                self._by_address = {}
+                for server in self.servers:
+                    self._by_address[(server.host, server.port)] = server
+                    self._by_address[(server.host, server.election_port)] = server
+            return self._by_address
+
     def __init__(self, content=''):
+        """ Parse the content of a config file. The content can be
+        a string, a file-like object or an mmap """
         super(ZooCfg, self).__init__()
 
-        self.update(self._defaults)
-        self.update(self._parse(content))
+        self._server_keys = set()
+        self._server_table = None
+        self._changed_keys = set()
+        self._rule_results = {}
+        self._lines = {}
+        self._typed = {}
+
+        dict.update(self, self._defaults)
+        dict.update(self, self._parse(content, self._server_keys, self._lines))
         if 'dataLogDir' not in self and 'dataDir' in self:
             self['dataLogDir'] = self['dataDir']
+            self._lines['dataLogDir'] = self._lines['dataDir']
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if type(value) is str:
+            setting = SCHEMA.get(key)
+            if setting is not None:
+                # the typed values are cached aside: the dict storage
+                # read by ==, dict(cfg) and copy.copy() keeps the strings
+                cached = self._typed.get(key)
+                if cached is not None and cached[0] is value:
+                    return cached[1]
+                typed = setting.coerce(value)
+                self._typed[key] = (value, typed)
+                return typed
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-    def get_servers(self):
-        """ Return the list of servers listed in the config file """
-        result = {}
-        for key, value in self.iteritems():
-            m = re.match('server.(\d+)', key)
-            if m is not None:
-                id = int(m.group(1))
-                if id < 1 or id > 255:
-                    raise ValueError, "Server ID should be an " \
-                        "integer value between 1 and 255. " \
-                        "Got `%s`." % id
-                if id in result:
-                    raise ValueError, "Duplicate server id "\
-                        "`server.%s`." % id
-                result[id] = ZooCfg.Server(id, value)
-        return result.values()
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
 
-    def _parse(self, content):
-        h = StringIO(content)
-        result = {}
-        for line in h.readlines():
+    def items(self):
+        return list(self.iteritems())
 
-            try:
-                line = line[:line.index('#')]
-            except ValueError:
-                pass
+    def itervalues(self):
+        for key in self:
+            yield self[key]
 
-            if not line.strip():
-                continue
+    def values(self):
+        return list(self.itervalues())
 
-            for k, v in self._parse_line(line).iteritems():
-                if k in result:
-                    raise ValueError, 'Duplicate key '\
-                        '`%s` found in config file.' % k
-                result[k] = v
-        return result
+    def copy(self):
+        return dict(self.iteritems())
 
-    def _parse_line(self, line):
-        try:
-            key, value = map(str.strip, line.split('='))
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
 
-            try:
-                value = int(value)
-            except (TypeError, ValueError):
-                pass
+    def __ne__(self, other):
+        return not self == other
 
-            return {key: value}
-        except ValueError:
-            return {} # just skip broken line
+    def __setitem__(self, key, value):
+        super(ZooCfg, self).__setitem__(key, value)
+        self._changed(key)
 
-class RulesResult(object):
-    """ A result obtained by checking all the config rules """
+    def __delitem__(self, key):
+        super(ZooCfg, self).__delitem__(key)
+        self._changed(key)
 
-    def __init__(self, warnings, errors):
-        self.warnings = tuple(warnings)
-        self.errors = tuple(errors)
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super(ZooCfg, self).pop(key, *args)
 
-    def has_errors(self):
-        return bool(self.errors)
+    def popitem(self):
+        for key in self:
+            return key, self.pop(key)
+        raise KeyError, 'popitem(): dictionary is empty'
 
-    def has_warnings(self):
-        return bool(self.warnings)
+    def clear(self):
+        super(ZooCfg, self).clear()
+        self._server_keys.clear()
+        self._server_table = None
+        self._changed_keys.clear()
+        self._rule_results.clear()
+        self._typed.clear()
 
-class Rules(object):
-    """ ZooKeeper config validation rules """
+    def pop_changed_keys(self):
+        """ Return the set of keys changed since the last call """
+        keys, self._changed_keys = self._changed_keys, set()
+        return keys
 
-    @classmethod
-    def check_all(cls, cfg):
-        """ Check all configuration rules """
-        warnings, errors = [], []
+    def line_of(self, key):
+        """ Return the line number of the key in the config file or None """
+        return self._lines.get(key)
 
-        for name, ref in Rules.__dict__.items():
-            try:
-                if hasattr(ref, 'mro') and Rules.BaseRule in ref.mro() and ref != Rules.BaseRule:
-                    w, e = ref.check(cfg)
+class CompactZooCfg(_ConfigMethods):
+    """ A ZooCfg using less memory when many configs are loaded at once
 
-                    warnings.extend(w)
-                    errors.extend(e)
-            except Exception, e:
-                errors.append('`%s` rule check failed: %s' % (name, e))
+    The values are packed in a tuple and the key positions are stored in
+    layouts shared by all the configs with the same keys. The defaults
+    are a shared read-only layer used when a key is missing and the 
+    bookkeeping used by the server table and by `Rules.check_incremental`
+    is allocated only when needed. Dotted and mapping access behave like 
+    for ZooCfg but it is not a dict subclass, which would leave the dict
+    storage read by C code empty: `dict(cfg)` copies the values and 
+    `json.dumps(cfg)` needs `cfg.copy()`. """
 
-        return RulesResult(warnings, errors)
+    __slots__ = ('_keys', '_index', '_values', '_lines', '_server_keys', 
+        '_server_table', '_changed_keys', '_rule_cache')
 
-    class BaseRule(object):
-        """ Inherit from this class when defining a new validation rule """
-        @classmethod
-        def check(cls, cfg):
-            pass
+    __hash__ = None
 
-    class ClientPort(BaseRule):
-        """ A valid TCP/IP port >1024 """
+    _defaults = ZooCfg._defaults
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+    _DELETED = object()
 
-            if 'clientPort' not in cfg:
-                errors.append('No `clientPort` found in config file.')
+    _EMPTY = frozenset()
 
-            elif not isinstance(cfg.clientPort, int) or cfg.clientPort < 0 or cfg.clientPort > 65535:
-                errors.append('`clientPort` should be a valid TCP/IP port number.')
+    _layouts = {}
 
-            elif cfg.clientPort < 1024:
-                warnings.append('`clientPort` < 1024. You should not run '\
-                    'ZooKeeper using the root account')
+    def __init__(self, content=''):
+        self._server_table = self._rule_cache = None
+        self._server_keys = self._changed_keys = self._EMPTY
+
+        server_keys, lines = set(), {}
+        values = self._parse(content, server_keys, lines)
+        if server_keys:
+            self._server_keys = tuple(server_keys)
+
+        if 'dataLogDir' not in values and 'dataDir' in values:
+            values['dataLogDir'] = values['dataDir']
+            lines['dataLogDir'] = lines['dataDir']
+
+        keys = tuple(sorted(values))
+        self._set_layout(keys)
+        self._values = tuple(values[key] for key in keys)
+        self._lines = tuple(lines.get(key, 0) for key in keys)
+
+    def _set_layout(self, keys):
+        layout = CompactZooCfg._layouts.get(keys)
+        if layout is None:
+            keys = tuple(intern(key) if type(key) is str else key for key in keys)
+            layout = CompactZooCfg._layouts[keys] = \
+                (keys, dict((key, i) for i, key in enumerate(keys)))
+        self._keys, self._index = layout
+
+    def line_of(self, key):
+        i = self._index.get(key)
+        if i is None or i >= len(self._lines):
+            return None
+        return self._lines[i] or None
+
+    @property
+    def _rule_results(self):
+        if self._rule_cache is None:
+            self._rule_cache = {}
+        return self._rule_cache
+
+    def __getitem__(self, key):
+        i = self._index.get(key)
+        if i is None:
+            if key in self._defaults:
+                return self._defaults[key]
+            raise KeyError, key
+
+        value = self._values[i]
+        if value is self._DELETED:
+            raise KeyError, key
+
+        if type(value) is str:
+            setting = SCHEMA.get(key)
+            if setting is not None:
+                typed = setting.coerce(value)
+                if typed is not value: # cache the typed value
+                    self._values = self._values[:i] + (typed,) + self._values[i+1:]
+                return typed
+        return value
+
+    def __setitem__(self, key, value):
+        self._store(key, value)
+        self._changed(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError, key
+        self._store(key, self._DELETED)
+        self._changed(key)
+
+    def _store(self, key, value):
+        i = self._index.get(key)
+        if i is None:
+            self._set_layout(self._keys + (key,))
+            self._values += (value,)
+        else:
+            self._values = self._values[:i] + (value,) + self._values[i+1:]
+
+    def __contains__(self, key):
+        i = self._index.get(key)
+        if i is None:
+            return key in self._defaults
+        return self._values[i] is not self._DELETED
+
+    has_key = __contains__
+
+    def __iter__(self):
+        for key, value in zip(self._keys, self._values):
+            if value is not self._DELETED:
+                yield key
+        for key in self._defaults:
+            if key not in self._index:
+                yield key
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-            return warnings, errors
+    def copy(self):
+        return dict(self.items())
 
-    class TickTime(BaseRule):
-        """ The length of a single tick, which is the basic time unit used by 
-        ZooKeeper, measured in milliseconds"""
+    def pop(self, key, *args):
+        try:
+            value = self[key]
+        except KeyError:
+            if args:
+                return args[0]
+            raise
+        del self[key]
+        return value
+
+    def popitem(self):
+        for key in self:
+            return key, self.pop(key)
+        raise KeyError, 'popitem(): dictionary is empty'
+
+    def clear(self):
+        keys = tuple(self._defaults)
+        self._set_layout(keys)
+        self._values = (self._DELETED,) * len(keys)
+        self._lines = ()
+        self._server_keys, self._server_table = self._EMPTY, None
+        self._changed_keys, self._rule_cache = self._EMPTY, None
+
+    def pop_changed_keys(self):
+        keys, self._changed_keys = self._changed_keys, self._EMPTY
+        return set(keys)
+
+    def _changed(self, key):
+        if self._changed_keys is self._EMPTY:
+            self._changed_keys = set()
+        if key.startswith('server.') and not isinstance(self._server_keys, set):
+            self._server_keys = set(self._server_keys)
+        _ConfigMethods._changed(self, key)
+
+class Finding(object):
+    """ A warning or an error reported by a rule
+
+    The message is formatted from `template` and `args` only when it is
+    read, so reporters that don't need the text never pay for it. """
+
+    __slots__ = ('rule', 'severity', 'key', 'line', 'template', 'args')
+
+    WARNING, ERROR = 'warning', 'error'
+
+    def __init__(self, template, args=(), key=None, rule=None, 
+            severity=None, line=None):
+        self.template = template
+        self.args = args
+        self.key = key
+        self.rule = rule
+        self.severity = severity
+        self.line = line
+
+    @property
+    def message(self):
+        return self.template % self.args if self.args else self.template
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return '<Finding rule="%s" severity="%s" key="%s">' % \
+            (self.rule, self.severity, self.key)
+
+    def __reduce__(self):
+        return (Finding, (self.template, self.args, self.key, self.rule, 
+            self.severity, self.line))
+
+    def as_dict(self):
+        return {'rule': self.rule, 'severity': self.severity, 'key': self.key,
+            'line': self.line, 'message': self.message}
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['message'], (), data.get('key'), data.get('rule'), 
+            data['severity'], data.get('line'))
 
-            if 'tickTime' not in cfg:
-                errors.append('No `tickTime` found in config file.')
+class RulesResult(object):
+    """ A result obtained by checking all the config rules
 
-            elif not isinstance(cfg.tickTime, int) or cfg.tickTime <= 0:
-                errors.append('`tickTime` should be a positive number measured in milliseconds')
+    Holds a tuple of Finding objects. Plain strings passed as warnings
+    or errors are wrapped. `warnings` and `errors` are the formatted
+    messages. """
 
-            return warnings, errors
+    inputs = None # set on the results read from a ResultCache
 
+    def __init__(self, warnings, errors, cached=False, profile=None):
+        self.findings = tuple(self._wrap(warnings, Finding.WARNING)) + \
+            tuple(self._wrap(errors, Finding.ERROR))
+        self.cached = cached
+        self.profile = profile
 
-    class DataDir(BaseRule):
-        """ The dataDir should be absolute because ZooKeeper runs as a daemon """
+    @staticmethod
+    def _wrap(items, severity):
+        for item in items:
+            if not isinstance(item, Finding):
+                item = Finding(item)
+            if item.severity is None:
+                item.severity = severity
+            yield item
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+    @classmethod
+    def from_findings(cls, findings, cached=False):
+        warnings = [f for f in findings if f.severity == Finding.WARNING]
+        errors = [f for f in findings if f.severity != Finding.WARNING]
+        return cls(warnings, errors, cached)
 
-            if 'dataDir' not in cfg:
-                errors.append('No `dataDir` found in config file.')
+    @property
+    def warnings(self):
+        return tuple(f.message for f in self.findings 
+            if f.severity == Finding.WARNING)
 
-            elif cfg.dataDir[0] != '/':
-                warnings.append('`dataDir` contains a relative path. '\
-                    'This could be a problem if ZooKeeper is running as daemon.')
+    @property
+    def errors(self):
+        return tuple(f.message for f in self.findings 
+            if f.severity == Finding.ERROR)
 
-            return warnings, errors
+    def count(self, severity):
+        return sum(1 for f in self.findings if f.severity == severity)
 
-    class DataLogDir(BaseRule):
-        """ Warn that dataLogDir should be on another partition """
+    def has_errors(self):
+        return any(f.severity == Finding.ERROR for f in self.findings)
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+    def has_warnings(self):
+        return any(f.severity == Finding.WARNING for f in self.findings)
 
-            if 'dataLogDir' not in cfg:
-                errors.append('No `dataLogDir` found in config file.')
+class Profile(object):
+    """ Wall time and call counts of the parse steps and of each rule
 
-            elif cfg.dataLogDir == cfg.dataDir:
-                warnings.append('The `dataLogDir` should not use the same partition as `dataDir` '\
-                    'in order to avoid competition between logging and snapshots. Having a '\
-                    'dedicated log device has a large impact on throughput and stable latencies.')
+    Profiles are plain picklable objects and can be merged so that the
+    numbers collected by many workers can be aggregated. """
 
-            return warnings, errors            
+    def __init__(self):
+        self.calls = {}
+        self.times = {}
 
-    class GlobalOutstandingLimit(BaseRule):
-        
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+    def add(self, name, elapsed, calls=1):
+        self.calls[name] = self.calls.get(name, 0) + calls
+        self.times[name] = self.times.get(name, 0.0) + elapsed
 
-            if 'globalOutstandingLimit' not in cfg:
-                errors.append('No `globalOutstandingLimit` found in config file.')
+    def merge(self, other):
+        for name, elapsed in other.times.iteritems():
+            self.add(name, elapsed, other.calls[name])
+        return self
 
-            elif not isinstance(cfg.globalOutstandingLimit, int) or cfg.globalOutstandingLimit < 0:
-                errors.append('`globalOutstandingLimit` should be a positive integer')
+    def timed(self, name, fn):
+        """ Wrap `fn` so that each call is recorded under `name` """
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.time() - start)
+        return wrapper
+
+    def wrap_table(self, table):
+        return tuple((id, self.timed('rule.%s' % id, check)) for id, check in table)
+
+    def ranked(self):
+        """ Return (name, total time, calls) tuples, slowest first """
+        return sorted(((name, self.times[name], self.calls[name]) 
+            for name in self.times), key=lambda item: -item[1])
+
+    def as_dict(self):
+        return dict((name, {'time': elapsed, 'calls': calls}) 
+            for name, elapsed, calls in self.ranked())
+
+    def report(self, out):
+        total = sum(self.times.itervalues()) or 1.0
+        print >>out, '%-30s %10s %12s %14s %6s' % \
+            ('name', 'calls', 'total (ms)', 'per call (us)', '%')
+        for name, elapsed, calls in self.ranked():
+            print >>out, '%-30s %10d %12.3f %14.3f %6.1f' % (name, calls, 
+                elapsed * 1e3, elapsed * 1e6 / calls, elapsed * 100 / total)
+
+class RulePool(object):
+    """ Bounded pool of daemon threads running the I/O rules
+
+    Waiting for a task that does not finish in time cancels it: a task
+    still queued is dropped and a running one is abandoned and its 
+    result ignored. Python threads cannot be killed, so an abandoned 
+    worker exits when its check returns and a new worker takes its 
+    place. The threads are started on first use and again after a fork. """
+
+    class Task(object):
+
+        __slots__ = ('fn', 'args', 'state', 'result', 'error', 'done', 'lock')
+
+        def __init__(self, fn, args):
+            import threading
+            self.fn = fn
+            self.args = args
+            self.state = 'pending'
+            self.result = self.error = None
+            self.done = threading.Event()
+            self.lock = threading.Lock()
+
+        def run(self):
+            with self.lock:
+                if self.state != 'pending':
+                    return # cancelled before it started
+                self.state = 'running'
+            try:
+                result, error = self.fn(*self.args), None
+            except Exception, e:
+                result, error = None, e
+            with self.lock:
+                if self.state == 'running':
+                    self.state = 'done'
+                    self.result, self.error = result, error
+            self.done.set()
+
+        def cancel(self):
+            """ Returns True if the task was running and got abandoned """
+            with self.lock:
+                if self.state == 'pending':
+                    self.state = 'cancelled'
+                elif self.state == 'running':
+                    self.state = 'abandoned'
+                    return True
+            return False
+
+    def __init__(self, size=4):
+        self.size = size
+        self._pid = None
+
+    def _start(self):
+        import threading, Queue
+        self._pid = os.getpid()
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        if getattr(self, '_wake', None) is not None:
+            map(os.close, self._wake) # inherited from the parent
+        self._wake, self._deadlines = None, []
+
+    def _spawn(self):
+        import threading
+        self._workers += 1
+        thread = threading.Thread(target=self._work)
+        thread.daemon = True
+        thread.start()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            task.run()
+            if task.state == 'abandoned':
+                return # replaced when the task timed out
+
+    def submit(self, fn, *args):
+        if self._pid != os.getpid():
+            self._start()
+        task = RulePool.Task(fn, args)
+        with self._lock:
+            if self._workers < self.size:
+                self._spawn()
+        self._queue.put(task)
+        return task
+
+    def _watch(self):
+        """ Cancel the tasks past their deadline. Sleeps in select() on
+        the wake pipe until the earliest deadline: the timed waits of 
+        Python 2 threading poll. """
+        import heapq
+        while True:
+            expired, now = [], time.time()
+            with self._lock:
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(self._deadlines)[1])
+                delay = self._deadlines[0][0] - now if self._deadlines else None
+            for task in expired:
+                if task.cancel():
+                    with self._lock:
+                        self._spawn()
+                task.done.set()
+            if not expired and select.select([self._wake[0]], [], [], delay)[0]:
+                os.read(self._wake[0], 512)
+
+    def wait(self, task, timeout):
+        """ Wait for the task until the timeout (seconds) and return its
+        result. Raises the rule exception or RuleTimeout. """
+        import heapq, threading
+        if not task.done.is_set():
+            with self._lock:
+                if self._wake is None:
+                    self._wake = os.pipe()
+                    thread = threading.Thread(target=self._watch)
+                    thread.daemon = True
+                    thread.start()
+                heapq.heappush(self._deadlines, (time.time() + timeout, task))
+                if self._deadlines[0][1] is task:
+                    os.write(self._wake[1], '.')
+            task.done.wait() # blocks on a lock, unlike a timed wait
+        if task.state != 'done':
+            raise RuleTimeout, timeout
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+    class Alarm(BaseException):
+        """ Raised by SIGALRM in an inline call. Not an Exception, so 
+        the `except Exception` of a check does not swallow it """
+
+    def call(self, timeout, fn, *args):
+        """ Run fn(*args) in the calling thread and return its result,
+        given up with RuleTimeout after the timeout (seconds). SIGALRM
+        interrupts the call in the main thread unless an earlier alarm
+        is pending, else the pool runs it. The previous handler and the
+        rest of a later alarm are restored after the call. """
+        import signal, threading
+        if not hasattr(signal, 'setitimer') or \
+                not isinstance(threading.current_thread(), threading._MainThread) or \
+                signal.getsignal(signal.SIGALRM) is None or \
+                0 < signal.getitimer(signal.ITIMER_REAL)[0] <= timeout:
+            return self.wait(self.submit(fn, *args), timeout)
+
+        armed = [True]
+        def alarm(signum, frame):
+            if armed[0]:
+                raise RulePool.Alarm
+        previous = signal.signal(signal.SIGALRM, alarm)
+        start = time.time()
+        delay, interval = signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return fn(*args)
+        except RulePool.Alarm:
+            raise RuleTimeout, timeout
+        finally:
+            armed[0] = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            if delay:
+                signal.setitimer(signal.ITIMER_REAL,
+                    max(delay - (time.time() - start), 1e-6), interval)
 
-            return warnings, errors
+class RuleTimeout(Exception):
+    """ An I/O rule did not finish in time """
 
-    class PreAllocSize(BaseRule):
-        """ Transaction log block prealloc size """
+class RuleRegistry(type):
+    """ Metaclass that registers validation rules in definition order
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+    Every subclass of `Rules.BaseRule` is added to an immutable table of
+    (rule id, check function) pairs when the class is defined. The rule
+    id defaults to the class name. """
 
-            if 'preAllocSize' not in cfg:
-                errors.append('No `preAllocSize` found in config file.')
+    table = ()
 
-            elif not isinstance(cfg.preAllocSize, int) or cfg.preAllocSize < 0:
-                errors.append('`preAllocSize` should be a positive number of kilobytes.')
+    rules = {}
 
-            return warnings, errors
+    plugin_group = 'zoocfg.rules'
 
-    class SnapCount(BaseRule):
-        """ The number of transaction processed before a snapshot is generated """
+    plugins = None
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+    _selections = {}
 
-            if 'snapCount' not in cfg:
-                errors.append('No `snapCount` found in config file.')
+    def __init__(cls, name, bases, attrs):
+        super(RuleRegistry, cls).__init__(name, bases, attrs)
+        if attrs.get('abstract'):
+            return # base classes are not rules
 
-            elif not isinstance(cfg.snapCount, int) or cfg.snapCount < 0:
-                errors.append('`snapCount` should be a positive integer.')
+        if 'keys' not in attrs and getattr(cls, 'settings', None):
+            cls.keys = tuple(cls.settings)
 
-            elif cfg.snapCount < 5000:
-                warnings.append('Settings `snapCount` to low may hurt server performance.')
+        cls.id = attrs.get('id', name)
+        if cls.id in RuleRegistry.ids():
+            raise ValueError, 'Duplicate rule id `%s`.' % cls.id
 
-            return warnings, errors
+        RuleRegistry.table += ((cls.id, cls.check),)
+        RuleRegistry.rules[cls.id] = cls
+        RuleRegistry._selections = {}
 
-    class TraceFile(BaseRule):
-        """ Enable the tracefile. Useful for debugging but this will impact performance. """
+    @staticmethod
+    def ids():
+        return tuple(id for id, _ in RuleRegistry.table)
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+    @staticmethod
+    def load_plugins(entry_points=None):
+        """ Import the rule packs registered under the `zoocfg.rules` 
+        setuptools entry point group. Their rules register themselves
+        when their classes are defined. Packs are imported once. Returns
+        the names of the loaded packs. """
+        if RuleRegistry.plugins is not None and entry_points is None:
+            return RuleRegistry.plugins
 
-            if 'traceFile' in cfg:
-                warnings.append('Enabling the tracefile will impact system performance')
+        if entry_points is None:
+            try:
+                import pkg_resources
+                entry_points = pkg_resources.iter_entry_points(RuleRegistry.plugin_group)
+            except ImportError:
+                entry_points = ()
+
+        loaded = list(RuleRegistry.plugins or ())
+        for entry_point in entry_points:
+            if entry_point.name not in loaded:
+                entry_point.load()
+                loaded.append(entry_point.name)
+        RuleRegistry.plugins = loaded
+        return loaded
+
+    @staticmethod
+    def select(select=None, exclude=None):
+        """ Return the subset of the rule table matching the given ids """
+        key = (frozenset(select or ()), frozenset(exclude or ()))
+        try:
+            return RuleRegistry._selections[key]
+        except KeyError:
+            pass
 
-            return warnings, errors
+        unknown = (key[0] | key[1]) - set(RuleRegistry.ids())
+        if unknown:
+            raise ValueError, 'Unknown rule id(s): %s' % \
+                ', '.join(sorted(unknown))
 
-    class MaxClientCnxns(BaseRule):
-        """ Limit the total number of concurrent connections handle by a member of the ensemble """
+        table = tuple((id, check) for id, check in RuleRegistry.table
+            if (not select or id in key[0]) and id not in key[1])
+        RuleRegistry._selections[key] = table
+        return table
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+class Rules(object):
+    """ ZooKeeper config validation rules
 
-            if 'maxClientCnxns' not in cfg:
-                errors.append('`No `maxClientCnxns` found in config file.')
+    Pure rules run inline. Rules tagged with `io` run concurrently on a
+    shared RulePool and each one is given up after its `timeout` or 
+    TIMEOUT seconds, so a slow check never stalls the other rules. The
+    checks take a `timeout` argument replacing TIMEOUT for one run. A
+    lone I/O rule runs inline to skip the thread handoff. """
 
-            elif not isinstance(cfg.maxClientCnxns, int) or cfg.maxClientCnxns < 0:
-                errors.append('`maxClientCnxns` should be a positive integer or 0.')
+    TIMEOUT = 10.0
 
-            elif cfg.maxClientCnxns == 0:
-                warnings.append('`maxClientCnxns` is set to 0. '\
-                    'The server is vulnerable to DOS attacks.')
+    pool = RulePool()
 
-            return warnings, errors
+    @classmethod
+    def check_all(cls, cfg, select=None, exclude=None, profile=None, timeout=None):
+        """ Check all configuration rules or only the rules 
+        with the ids listed in `select` and not in `exclude`.
+        The time spent in each rule is recorded in `profile`. """
+        table = RuleRegistry.table
+        if select or exclude:
+            table = RuleRegistry.select(select, exclude)
+        if profile is not None:
+            table = profile.wrap_table(table)
 
-    class SessionTimeout(BaseRule):
+        warnings, errors = [], []
+        for id, result in cls._run(cfg, table, timeout=timeout):
+            if isinstance(result, Finding):
+                errors.append(result)
+                continue
+            w, e = result
+            if w or e:
+                cls._annotate(cfg, id, w, e)
+            warnings.extend(w)
+            errors.extend(e)
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+        return RulesResult(warnings, errors)
 
-            if 'minSessionTimeout' not in cfg:
-                errors.append('No `minSessionTimeout` found in config file.')
+    @classmethod
+    def _run(cls, cfg, table, cache=None, timeout=None):
+        """ Run the checks of the table and yield (id, result) pairs in
+        table order. The result is a (warnings, errors) pair or an error
+        Finding when the check failed. Results found in `cache` are 
+        reused and new ones are stored in it, except the results of I/O
+        rules which depend on the machine and not only on `cfg`. """
+        rules, tasks = RuleRegistry.rules, {}
+        timeout = timeout or cls.TIMEOUT
+        pending = [(id, check) for id, check in table if rules[id].io and 
+            (cache is None or id not in cache) and rules[id].needs_io(cfg)]
+        if len(pending) > 1: # a lone I/O rule runs inline
+            for id, check in pending:
+                tasks[id] = cls.pool.submit(check, cfg)
+
+        for id, check in table:
+            if cache is not None and id in cache:
+                yield id, cache[id]
+                continue
+            try:
+                if id in tasks:
+                    result = cls.pool.wait(tasks[id], rules[id].timeout or timeout)
+                elif pending and pending[0][0] == id:
+                    result = cls.pool.call(rules[id].timeout or timeout, check, cfg)
+                else:
+                    result = check(cfg)
+            except RuleTimeout, e:
+                yield id, Finding('`%s` rule timed out after %.1fs', (id, e.args[0]), rule=id)
+                continue
+            except Exception, e:
+                yield id, Finding('`%s` rule check failed: %s', (id, e), rule=id)
+                continue
 
-            elif not isinstance(cfg.minSessionTimeout, int) or cfg.minSessionTimeout < 0:
-                errors.append('`minSessionTimeout` should be a positive integer.')
+            if cache is not None and not rules[id].io:
+                cache[id] = result
+            yield id, result
+
+    @staticmethod
+    def _annotate(cfg, id, warnings, errors):
+        """ Turn the messages of a rule into Findings with the rule id, the
+        key and its line number. The key defaults to the first key read by 
+        the rule. Cached Findings get a copy when their line moved. """
+        keys = RuleRegistry.rules[id].keys
+        line_of = getattr(cfg, 'line_of', None)
+        for items in (warnings, errors):
+            for i, item in enumerate(items):
+                if not isinstance(item, Finding):
+                    item = items[i] = Finding(item)
+                elif item.rule is not None: # already annotated and cached
+                    if line_of is not None and item.key is not None and \
+                            item.line != line_of(item.key):
+                        items[i] = Finding(item.template, item.args, item.key, 
+                            item.rule, item.severity, line_of(item.key))
+                    continue
+                item.rule = id
+                if item.key is None and keys:
+                    item.key = keys[0]
+                if line_of is not None and item.key is not None:
+                    item.line = line_of(item.key)
 
-            if 'maxSessionTimeout' not in cfg:
-                errors.append('No `maxSessionTimeout` found in config file.')
+    @classmethod
+    def check_incremental(cls, cfg, select=None, exclude=None, profile=None,
+            timeout=None):
+        """ Check the configuration rules but only rerun the rules reading 
+        keys changed since the previous call. The results of the other
+        rules are taken from the cache stored on the ZooCfg object. """
+        changed = cfg.pop_changed_keys()
+        if any(key.startswith('server.') for key in changed):
+            changed.add('server.*')
+
+        cache = cfg._rule_results
+        for id in cache.keys():
+            keys = RuleRegistry.rules[id].keys
+            if keys is None or not changed.isdisjoint(keys):
+                del cache[id]
 
-            elif not isinstance(cfg.maxSessionTimeout, int) or cfg.maxSessionTimeout < 0:
-                errors.append('`maxSessionTimeout` should be a positive integer.')
+        warnings, errors = [], []
 
-            if not errors:
-                if cfg.minSessionTimeout > cfg.maxSessionTimeout:
-                    errors.append('`minSessionTimeout` > `maxSessionTimeout`')
+        table = RuleRegistry.table
+        if select or exclude:
+            table = RuleRegistry.select(select, exclude)
+        if profile is not None:
+            table = profile.wrap_table(table)
 
-            return warnings, errors
+        for id, result in cls._run(cfg, table, cache, timeout):
+            if isinstance(result, Finding):
+                errors.append(result)
+                continue
+            w, e = result
+            cls._annotate(cfg, id, w, e)
 
-    class InitLimit(BaseRule):
+            warnings.extend(w)
+            errors.extend(e)
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+        return RulesResult(warnings, errors)
 
-            if 'initLimit' not in cfg:
-                errors.append('No `initLimit` found in config file.')
+    class BaseRule(object):
+        """ Inherit from this class when defining a new validation rule.
+        List the config keys read by the rule in `keys`. Use `server.*`
+        for rules reading the list of servers and None for rules that 
+        must run again after any change. Set `io` for rules touching the
+        filesystem or the network and `timeout` to override the default
+        timeout of those rules. Override `needs_io` when only some 
+        configs require I/O. """
+        __metaclass__ = RuleRegistry
 
-            elif not isinstance(cfg.initLimit, int) or cfg.initLimit < 0:
-                errors.append('`initLimit` should be a positiv number of tick counts.')
+        abstract = True
 
-            return warnings, errors
+        keys = None
 
-    class ElectionAlg(BaseRule):
-        """ Check the selected election algorithm """
+        io = False
 
-        @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+        timeout = None
 
-            if 'electionAlg' not in cfg:
-                errors.append('No `electionAlg` found in config file.')
+        @classmethod
+        def needs_io(cls, cfg):
+            return cls.io
 
-            elif cfg.electionAlg not in (0, 1, 2, 3):
-                errors.append('Unknown `electionAlg`. Valid values: 0, 1, 2, 3.')
+        @classmethod
+        def check(cls, cfg):
+            pass
 
-            elif cfg.electionAlg in (1, 2):
-                warnings.append('Election algorithm implementation 1 and 2 are no longer supported.')
+    class SettingRule(BaseRule):
+        """ A rule checking the type and range of the `settings` declared 
+        in SCHEMA. Override `advise` to check the values once they are
+        known to be valid. `keys` defaults to `settings`. """
 
-            return warnings, errors
+        abstract = True
 
-    class LeaderServers(BaseRule):
+        settings = ()
 
         @classmethod
         def check(cls, cfg):
             warnings, errors = [], []
 
-            if 'leaderServers' not in cfg:
-                errors.append('No `leaderServers` found in config file.')
-
-            elif cfg.leaderServers not in ('yes', 'no'):
-                errors.append('`leaderServers` should be "yes" or "no".')
+            for name in cls.settings:
+                errors.extend(SCHEMA[name].validate(cfg))
 
-            elif len(cfg.get_servers()) > 3:
-                warnings.append('Your ensemble contains more than 3 servers. '\
-                    'It\'s recommended to set `leaderServers` to `no`. This will'\
-                    'allow the leader to focus only on coordination.')
+            if not errors:
+                cls.advise(cfg, warnings, errors)
 
             return warnings, errors
 
-    class SyncLimit(BaseRule):
-
         @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+        def advise(cls, cfg, warnings, errors):
+            pass
 
-            if 'syncLimit' in cfg and (not isinstance(cfg.syncLimit, int) or cfg.syncLimit < 0):
-                errors.append('`syncLimit` should be a positive number of ticks')
+        @staticmethod
+        def value(cfg, name):
+            """ The typed value of a setting """
+            return SCHEMA[name].coerce(cfg[name])
 
-            return warnings, errors
+    class ClientPort(SettingRule):
+        """ A valid TCP/IP port >1024 """
 
-    class SkipACL(BaseRule):
+        settings = ('clientPort',)
 
         @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
-
-            if 'skipACL' not in cfg:
-                errors.append('No `skipACL` found in config file.')
+        def advise(cls, cfg, warnings, errors):
+            if cls.value(cfg, 'clientPort') < 1024:
+                warnings.append('`clientPort` < 1024. You should not run '\
+                    'ZooKeeper using the root account')
 
-            elif cfg.skipACL not in ('yes', 'no'):
-                errors.append('`skipACL` should be "yes" or "no".')
+    class TickTime(SettingRule):
+        """ The length of a single tick, which is the basic time unit used by 
+        ZooKeeper, measured in milliseconds"""
 
-            elif cfg.skipACL == 'yes':
-                warnings.append('`skipACL` is `yes`. This results'\
-                    ' in a boost in throughput, but opens up full '\
-                    'access to the data tree to everyone.')
+        settings = ('tickTime',)
 
-            return warnings, errors
+    class DataDir(SettingRule):
+        """ The dataDir should be absolute because ZooKeeper runs as a daemon """
 
-    class OddNumberOfServers(BaseRule):
+        settings = ('dataDir',)
 
         @classmethod
-        def check(cls, cfg):
-            warnings, errors = [], []
+        def advise(cls, cfg, warnings, errors):
+            if cfg.dataDir[0] != '/':
+                warnings.append('`dataDir` contains a relative path. '\
+                    'This could be a problem if ZooKeeper is running as daemon.')
 
-            count = len(cfg.get_servers())
-            if count < 3:
-                warnings.append('You should run at least 3 ZooKeeper servers.')
+    class DataLogDir(SettingRule):
+        """ Warn that dataLogDir should be on another partition """
 
-            elif count % 2 == 0:
-                warnings.append('You should run an odd number of servers.')
+        settings = ('dataLogDir',)
 
-            return warnings, errors
+        keys = ('dataLogDir', 'dataDir')
 
-def main(argv):
-    parser = OptionParser()
+        io = True
 
-    parser.add_option('-f', '--file', dest='filename', 
-        help="ZooKeeper config FILE", metavar="FILE")
+        @classmethod
+        def needs_io(cls, cfg):
+            # the devices are looked up only for different paths
+            return cfg.get('dataLogDir') != cfg.get('dataDir')
 
-    parser.add_option('-w', '--warnings', dest='warnings',
-        default=False, action='store_true', 
-        help='show warnings. defaults to false')
+        @classmethod
+        def advise(cls, cfg, warnings, errors):
+            data_dir = cfg.get('dataDir')
+            if cfg.dataLogDir == data_dir:
+                warnings.append('The `dataLogDir` should not use the same partition as `dataDir` '\
+                    'in order to avoid competition between logging and snapshots. Having a '\
+                    'dedicated log device has a large impact on throughput and stable latencies.')
 
-    (opts, args) = parser.parse_args(argv)
+            elif SCHEMA['dataDir'].accepts(data_dir):
+                try:
+                    log, data = storage_info(cfg.dataLogDir), storage_info(data_dir)
+                except OSError:
+                    return
+                if log['device'] == data['device']:
+                    warnings.append('`dataDir` and `dataLogDir` are on the same device '\
+                        '%d:%d (`dataDir`: %s, %s mounted on %s; `dataLogDir`: %s, %s '\
+                        'mounted on %s). Having a dedicated log device has a large impact '\
+                        'on throughput and stable latencies.' % (os.major(log['device']),
+                        os.minor(log['device']), data['source'], data['fstype'],
+                        data['mount_point'], log['source'], log['fstype'],
+                        log['mount_point']))
+
+    class GlobalOutstandingLimit(SettingRule):
+
+        settings = ('globalOutstandingLimit',)
+
+    class PreAllocSize(SettingRule):
+        """ Transaction log block prealloc size """
 
-    if opts.filename is None:
-        print >>sys.stderr, "Config file name is mandatory."
+        settings = ('preAllocSize',)
 
-        parser.print_help()
-        return -1
+    class SnapCount(SettingRule):
+        """ The number of transaction processed before a snapshot is generated """
 
-    cfg = ZooCfg.from_file(opts.filename)
-    check = Rules.check_all(cfg)
+        settings = ('snapCount',)
 
+        @classmethod
+        def advise(cls, cfg, warnings, errors):
+            if cls.value(cfg, 'snapCount') < 5000:
+                warnings.append('Settings `snapCount` to low may hurt server performance.')
+
+    class TraceFile(SettingRule):
+        """ Enable the tracefile. Useful for debugging but this will impact performance. """
+
+        settings = ('traceFile',)
+
+        @classmethod
+        def advise(cls, cfg, warnings, errors):
+            if 'traceFile' in cfg:
+                warnings.append('Enabling the tracefile will impact system performance')
+
+    class MaxClientCnxns(SettingRule):
+        """ Limit the total number of concurrent connections handle by a member of the ensemble """
+
+        settings = ('maxClientCnxns',)
+
+        @classmethod
+        def advise(cls, cfg, warnings, errors):
+            if cls.value(cfg, 'maxClientCnxns') == 0:
+                warnings.append('`maxClientCnxns` is set to 0. '\
+                    'The server is vulnerable to DOS attacks.')
+
+    class SessionTimeout(SettingRule):
+
+        settings = ('minSessionTimeout', 'maxSessionTimeout')
+
+        @classmethod
+        def advise(cls, cfg, warnings, errors):
+            if cls.value(cfg, 'minSessionTimeout') > cls.value(cfg, 'maxSessionTimeout'):
+                errors.append('`minSessionTimeout` > `maxSessionTimeout`')
+
+    class InitLimit(SettingRule):
+
+        settings = ('initLimit',)
+
+    class ElectionAlg(SettingRule):
+        """ Check the selected election algorithm """
+
+        settings = ('electionAlg',)
+
+        @classmethod
+        def advise(cls, cfg, warnings, errors):
+            if cls.value(cfg, 'electionAlg') in (1, 2):
+                warnings.append('Election algorithm implementation 1 and 2 are no longer supported.')
+
+    class LeaderServers(SettingRule):
+
+        settings = ('leaderServers',)
+
+        keys = ('leaderServers', 'server.*')
+
+        @classmethod
+        def advise(cls, cfg, warnings, errors):
+            if len(cfg.get_servers()) > 3:
+                warnings.append('Your ensemble contains more than 3 servers. '\
+                    'It\'s recommended to set `leaderServers` to `no`. This will'\
+                    'allow the leader to focus only on coordination.')
+
+    class SyncLimit(SettingRule):
+
+        settings = ('syncLimit',)
+
+    class SkipACL(SettingRule):
+
+        settings = ('skipACL',)
+
+        @classmethod
+        def advise(cls, cfg, warnings, errors):
+            if cls.value(cfg, 'skipACL') is True:
+                warnings.append('`skipACL` is `yes`. This results'\
+                    ' in a boost in throughput, but opens up full '\
+                    'access to the data tree to everyone.')
+
+    class OddNumberOfServers(BaseRule):
+
+        keys = ('server.*',)
+
+        @classmethod
+        def check(cls, cfg):
+            warnings, errors = [], []
+
+            count = len(cfg.get_servers())
+            if count < 3:
+                warnings.append('You should run at least 3 ZooKeeper servers.')
+
+            elif count % 2 == 0:
+                warnings.append('You should run an odd number of servers.')
+
+            return warnings, errors
+
+class Ensemble(object):
+    """ Consistency checks across the config files of an ensemble
+
+    Members are grouped by a fingerprint of the settings that must be 
+    the same on every member so the cost is linear in the number of 
+    members. The values are compared only when the groups differ. """
+
+    SHARED_KEYS = ('tickTime', 'initLimit', 'syncLimit', 'electionAlg')
+
+    class Member(object):
+
+        def __init__(self, name, cfg, myid=None, host=None):
+            self.name = name
+            self.cfg = cfg
+            self.myid = myid
+            self.host = host
+
+        def __repr__(self):
+            return '<Ensemble.Member name="%s" myid="%s">' % (self.name, self.myid)
+
+    def __init__(self, name=None):
+        self.name = name
+        self.members = []
+
+    @classmethod
+    def from_files(cls, file_names, name=None, identities=None):
+        """ Load the members from config files. `identities` maps a file 
+        name, or the name of its directory, to a (myid, host) pair where
+        either can be None. """
+        ensemble = cls(name)
+        identities = identities or {}
+        for file_name in file_names:
+            directory = os.path.basename(os.path.dirname(os.path.abspath(file_name)))
+            myid, host = identities.get(file_name) or identities.get(directory) \
+                or (None, None)
+            ensemble.add(file_name, ZooCfg.from_file(file_name), myid, host)
+        return ensemble
+
+    @staticmethod
+    def read_myid(cfg, file_name=None):
+        """ Read the server ID from a `myid` file next to the config file,
+        or else in `dataDir`. Returns None if there is none. """
+        paths = []
+        if file_name is not None:
+            paths.append(os.path.join(os.path.dirname(file_name), 'myid'))
+        if isinstance(cfg.get('dataDir'), basestring):
+            paths.append(os.path.join(cfg['dataDir'], 'myid'))
+
+        for path in paths:
+            try:
+                with open(path) as f:
+                    return int(f.read().strip())
+            except (IOError, ValueError):
+                pass
+        return None
+
+    @staticmethod
+    def guess_host(name, cfg):
+        """ Return the name of the directory of the config file, or the 
+        file name without extension, if it is the host of a server """
+        try:
+            hosts = cfg.get_servers_by_host
+            path = os.path.abspath(name)
+            for candidate in (os.path.basename(os.path.dirname(path)), 
+                    os.path.splitext(os.path.basename(path))[0]):
+                if hosts(candidate):
+                    return candidate
+        except ValueError:
+            pass
+        return None
+
+    def add(self, name, cfg, myid=None, host=None):
+        """ Add a member. The ID defaults to the content of the `myid` 
+        file next to the config or in `dataDir`, and the host to 
+        `clientPortAddress` or to the name of the directory or file 
+        when a server has this host. """
+        if myid is None:
+            myid = self.read_myid(cfg, name)
+        if host is None:
+            host = cfg.get('clientPortAddress') or self.guess_host(name, cfg)
+        self.members.append(Ensemble.Member(name, cfg, myid, host))
+
+    @staticmethod
+    def server_id(member):
+        """ Return the server ID of a member: its myid, or else the ID of
+        the only server on its host. None when unknown. """
+        if member.myid is not None:
+            return member.myid
+        if member.host is None:
+            return None
+        try:
+            servers = member.cfg.get_servers_by_host(member.host)
+        except ValueError:
+            return None
+        return len(servers) == 1 and servers[0].id or None
+
+    def check(self):
+        warnings, errors = [], []
+
+        groups = {}
+        for member in self.members:
+            try:
+                servers = tuple((s.id, s.host, s.port, s.election_port, s.type)
+                    for s in member.cfg.get_servers())
+            except ValueError, e:
+                errors.append('`%s`: invalid server list: %s' % (member.name, e))
+                continue
+
+            shared = tuple(member.cfg.get(key) for key in self.SHARED_KEYS)
+            groups.setdefault((servers, shared), []).append(member)
+            self._check_identity(member, warnings, errors)
+
+        if len(groups) > 1:
+            self._compare_groups(groups, errors)
+
+        seen = {}
+        for member in self.members:
+            if member.myid is not None and member.myid in seen:
+                errors.append('`%s` and `%s` both use myid %d.' % 
+                    (seen[member.myid], member.name, member.myid))
+            seen.setdefault(member.myid, member.name)
+
+        return RulesResult(warnings, errors)
+
+    def _check_identity(self, member, warnings, errors):
+        if member.myid is None:
+            if self.server_id(member) is None:
+                warnings.append('`%s`: unable to find the `myid` of the member.' % 
+                    member.name)
+            return
+
+        server = member.cfg.get_server(member.myid)
+        if server is None:
+            errors.append('`%s`: myid %d has no `server.%d` entry.' % 
+                (member.name, member.myid, member.myid))
+
+        elif member.host is not None and server.host != member.host:
+            errors.append('`%s`: `server.%d` points to `%s` but the member '\
+                'runs on `%s`.' % (member.name, member.myid, server.host, member.host))
+
+    def _compare_groups(self, groups, errors):
+        def names(members):
+            return ', '.join(m.name for m in members)
+
+        def describe(values):
+            return '; '.join('%s (%s)' % (value, names(members)) 
+                for value, members in sorted(values.items()))
+
+        by_servers = {}
+        for (servers, shared), members in groups.iteritems():
+            by_servers.setdefault(servers, []).extend(members)
+        if len(by_servers) > 1:
+            values = dict((','.join('%d=%s:%d:%d' % s[:4] for s in servers) or 'none', 
+                members) for servers, members in by_servers.iteritems())
+            errors.append('Members disagree on the server list: %s.' % describe(values))
+
+        for i, key in enumerate(self.SHARED_KEYS):
+            values = {}
+            for (servers, shared), members in groups.iteritems():
+                values.setdefault(shared[i], []).extend(members)
+            if len(values) > 1:
+                errors.append('Members disagree on `%s`: %s.' % (key, describe(values)))
+
+class ConfigDiff(object):
+    """ The keys changed between two configs, classified by category """
+
+    CATEGORIES = {
+        'timing': ('tickTime', 'initLimit', 'syncLimit', 'minSessionTimeout',
+            'maxSessionTimeout'),
+        'storage': ('dataDir', 'dataLogDir', 'snapCount', 'preAllocSize', 
+            'traceFile'),
+        'limits': ('maxClientCnxns', 'globalOutstandingLimit'),
+    }
+
+    class Change(object):
+
+        __slots__ = ('key', 'old', 'new', 'category')
+
+        def __init__(self, key, old, new, category):
+            self.key = key
+            self.old = old
+            self.new = new
+            self.category = category
+
+        def __repr__(self):
+            return '<ConfigDiff.Change key="%s" old="%s" new="%s">' % \
+                (self.key, self.old, self.new)
+
+    def __init__(self, old, new):
+        self.changes = []
+        for key in sorted(set(old) | set(new)):
+            a, b = old.get(key), new.get(key)
+            if a != b:
+                self.changes.append(ConfigDiff.Change(key, a, b, self.category(key)))
+
+    def __len__(self):
+        return len(self.changes)
+
+    @classmethod
+    def category(cls, key):
+        if key.startswith('server.'):
+            return 'membership'
+        for category, keys in cls.CATEGORIES.iteritems():
+            if key in keys:
+                return category
+        return 'other'
+
+    def by_category(self):
+        """ Return a dict of category -> list of changes """
+        result = {}
+        for change in self.changes:
+            result.setdefault(change.category, []).append(change)
+        return result
+
+class RestartPlan(object):
+    """ Order in which to restart the members of an ensemble to apply a
+    config change while keeping a quorum
+
+    New servers are started first, then the members running the old 
+    config are restarted one at a time, followers before the leader, 
+    and removed servers are stopped last. A step is safe when the 
+    members still up include a majority of the voters of the new 
+    membership and, while old configs are still running, of the old 
+    one. The leader defaults to the participant with the highest id. 
+    Restarting the leader, or any unsafe step, is counted as 
+    `initLimit` ticks of unavailability: the time allowed for an 
+    election and for the followers to sync with the new leader. """
+
+    class Step(object):
+
+        __slots__ = ('action', 'server', 'role', 'up', 'safe', 'downtime')
+
+        def __init__(self, action, server, role, up, safe, downtime):
+            self.action = action
+            self.server = server
+            self.role = role
+            self.up = up
+            self.safe = safe
+            self.downtime = downtime
+
+        def __repr__(self):
+            return '<RestartPlan.Step action="%s" server="%d">' % \
+                (self.action, self.server)
+
+    def __init__(self, old, new, leader=None, changed=None):
+        self.diff = ConfigDiff(old, new)
+        old_voters = self._voters(old)
+        new_voters = self._voters(new)
+        old_ids = set(s.id for s in old.get_servers())
+        new_ids = set(s.id for s in new.get_servers())
+
+        if leader is None and old_voters:
+            leader = max(old_voters)
+        self.leader = leader
+
+        tick = SCHEMA['tickTime'].coerce(new.get('tickTime'))
+        init = SCHEMA['initLimit'].coerce(new.get('initLimit'))
+        if not (SCHEMA['tickTime'].accepts(tick) and SCHEMA['initLimit'].accepts(init)):
+            raise ValueError, '`tickTime` and `initLimit` should be positive integers.'
+        self.sync_time = tick * init
+
+        if changed is None:
+            changed = self.diff and old_ids & new_ids or set()
+        restarts = sorted(set(changed) & old_ids & new_ids, 
+            key=lambda id: (id == leader, id))
+
+        self.steps = []
+        up, stale = set(old_ids), set(old_ids) & new_ids
+        for id in sorted(new_ids - old_ids):
+            up.add(id)
+            self._step('start', id, new_voters, up, stale, old_voters, new_voters)
+        for id in restarts:
+            self._step('restart', id, new_voters, up - set([id]), stale - set([id]),
+                old_voters, new_voters)
+            stale.discard(id)
+        for id in sorted(old_ids - new_ids, key=lambda id: (id == leader, id)):
+            up.discard(id)
+            self._step('stop', id, old_voters, up, stale, old_voters, new_voters)
+
+        if (changed or self.diff) and not self.steps:
+            raise ValueError, 'Unable to plan a restart: none of the changed '\
+                'members is in the server list.'
+
+    @classmethod
+    def from_ensembles(cls, old, new, leader=None):
+        """ Plan the restart of the members of `new` whose config differs
+        from the member with the same server ID in `old` (see 
+        Ensemble.server_id). Raises ValueError if a member can't be 
+        identified rather than planning without it. """
+        if not old.members or not new.members:
+            raise ValueError, 'Both ensembles should have members.'
+
+        def by_id(ensemble):
+            members = {}
+            for member in ensemble.members:
+                id = Ensemble.server_id(member)
+                if id is None:
+                    raise ValueError, 'Unable to find the server id of `%s`: add '\
+                        'a myid file next to it or use --member.' % member.name
+                if id in members:
+                    raise ValueError, '`%s` and `%s` both are server %d.' % \
+                        (members[id].name, member.name, id)
+                members[id] = member
+            return members
+
+        before, after = by_id(old), by_id(new)
+        changed = set(id for id, member in after.iteritems() 
+            if id not in before or ConfigDiff(before[id].cfg, member.cfg))
+        common = sorted(set(before) & set(after))
+        reference = common and common[0]
+        return cls(before.get(reference, old.members[0]).cfg, 
+            after.get(reference, new.members[0]).cfg, leader, changed)
+
+    @staticmethod
+    def _voters(cfg):
+        return set(s.id for s in cfg.get_servers() if not s.is_observer)
+
+    def _step(self, action, id, voters, up, stale, old_voters, new_voters):
+        safe = len(up & new_voters) > len(new_voters) / 2
+        if stale & old_voters:
+            safe = safe and len(up & old_voters) > len(old_voters) / 2
+        role = id == self.leader and 'leader' or \
+            id in voters and 'follower' or 'observer'
+        downtime = (role == 'leader' and action != 'start' or not safe) \
+            and self.sync_time or 0
+        self.steps.append(RestartPlan.Step(action, id, role, len(up), safe, downtime))
+
+    @property
+    def safe(self):
+        return all(step.safe for step in self.steps)
+
+    @property
+    def unavailability(self):
+        """ Estimated time in milliseconds without a quorum """
+        return sum(step.downtime for step in self.steps)
+
+    @property
+    def duration(self):
+        """ Estimated time in milliseconds, waiting for each member to sync """
+        return len(self.steps) * self.sync_time
+
+class Workload(object):
+    """ Write workload of an ensemble. Sizes are in bytes and the optional
+    disk bandwidth in bytes per second. """
+
+    def __init__(self, write_rate, txn_size, snapshot_size, disk_bandwidth=None):
+        if write_rate <= 0 or txn_size <= 0 or snapshot_size <= 0:
+            raise ValueError, 'The workload values should be positive numbers.'
+        self.write_rate = float(write_rate)
+        self.txn_size = float(txn_size)
+        self.snapshot_size = float(snapshot_size)
+        self.disk_bandwidth = disk_bandwidth and float(disk_bandwidth)
+
+    @classmethod
+    def parse(cls, text):
+        """ Parse `RATE,TXN_SIZE,SNAPSHOT_SIZE[,DISK_BANDWIDTH]`. Sizes 
+        accept a K, M or G suffix. """
+        values = [parse_size(value) for value in text.split(',')]
+        if len(values) not in (3, 4):
+            raise ValueError, 'Expected RATE,TXN_SIZE,SNAPSHOT_SIZE'\
+                '[,DISK_BANDWIDTH]. Got `%s`.' % text
+        return cls(*values)
+
+def parse_size(text):
+    """ Parse a number with an optional K, M or G binary suffix """
+    text = text.strip().upper()
+    multiplier = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    return float(text) * multiplier
+
+class DiskAdvisor(object):
+    """ Estimate the disk cost of snapshots and txn log preallocation
+    for a workload and recommend `snapCount` and `preAllocSize`
+
+    ZooKeeper takes a snapshot and rolls the txn log after a random 
+    number of transactions between snapCount/2 and snapCount, so on 
+    average every 0.75 * snapCount transactions. Each new log file is 
+    extended by preAllocSize KB at a time. """
+
+    SNAPSHOT_RATIO = 0.75
+
+    PREALLOC_SECONDS = 10
+
+    def __init__(self, cfg, workload, target=0.1):
+        if not 0 < target < 1:
+            raise ValueError, 'The target fraction should be between 0 and 1.'
+        self.cfg = cfg
+        self.workload = workload
+        self.target = target
+
+    def estimate(self, snap_count=None, prealloc_size=None):
+        """ Return a dict of estimates for the current or given settings """
+        w = self.workload
+        snap_count = snap_count or SCHEMA['snapCount'].positive(self.cfg)
+        prealloc = (prealloc_size or SCHEMA['preAllocSize'].positive(self.cfg)) * 1024.0
+
+        interval = self.SNAPSHOT_RATIO * snap_count / w.write_rate
+        log_bandwidth = w.write_rate * w.txn_size
+        snapshot_bandwidth = w.snapshot_size / interval
+        log_per_file = log_bandwidth * interval
+
+        result = {
+            'snapshot_interval': interval,
+            'snapshot_bandwidth': snapshot_bandwidth,
+            'log_bandwidth': log_bandwidth,
+            'snapshot_fraction': snapshot_bandwidth / (snapshot_bandwidth + log_bandwidth),
+            'preallocs_per_second': log_bandwidth / prealloc,
+            'log_file_size': log_per_file,
+            'prealloc_unused': max(0.0, prealloc - log_per_file % prealloc) 
+                if log_per_file % prealloc else 0.0,
+        }
+        if w.disk_bandwidth:
+            duration = w.snapshot_size / w.disk_bandwidth
+            result['snapshot_duration'] = duration
+            result['snapshot_ticks'] = duration * 1000 / \
+                SCHEMA['tickTime'].positive(self.cfg)
+        return result
+
+    def recommend(self):
+        """ Return the smallest `snapCount` keeping the snapshot share of 
+        the written bytes under the target and a `preAllocSize` (KB) 
+        extending the log at most every PREALLOC_SECONDS seconds without
+        exceeding the size of a log file """
+        w = self.workload
+        k = self.target / (1 - self.target)
+        snap_count = int(math.ceil(w.snapshot_size / 
+            (k * w.txn_size * self.SNAPSHOT_RATIO)))
+
+        log_per_file = w.txn_size * snap_count * self.SNAPSHOT_RATIO
+        prealloc = min(log_per_file, w.txn_size * w.write_rate * self.PREALLOC_SECONDS)
+        prealloc_mb = max(1, int(math.ceil(prealloc / (1 << 20))))
+        prealloc_mb = 1 << (prealloc_mb - 1).bit_length() # power of two
+        return {'snapCount': snap_count, 'preAllocSize': prealloc_mb * 1024}
+
+    def advise(self):
+        """ Return a RulesResult with warnings for the current settings """
+        warnings = []
+        current = self.estimate()
+        recommended = self.recommend()
+
+        if current['snapshot_fraction'] > self.target:
+            warnings.append('Snapshots use %.0f%% of the disk writes (target %.0f%%). '\
+                'Set `snapCount` to at least %d.' % (current['snapshot_fraction'] * 100,
+                self.target * 100, recommended['snapCount']))
+
+        if current['preallocs_per_second'] > 1:
+            warnings.append('The txn log is extended %.1f times per second. '\
+                'Set `preAllocSize` to %d.' % (current['preallocs_per_second'], 
+                recommended['preAllocSize']))
+
+        if current['prealloc_unused'] > current['log_file_size']:
+            warnings.append('Each txn log file leaves %.0fMB of preallocated space '\
+                'unused. Set `preAllocSize` to %d.' % (current['prealloc_unused'] / 
+                (1 << 20), recommended['preAllocSize']))
+
+        limit = self.cfg.get('syncLimit')
+        if 'snapshot_ticks' in current and isinstance(limit, int) and \
+                current['snapshot_ticks'] > limit:
+            warnings.append('Writing a snapshot takes %.1f ticks, more than '\
+                '`syncLimit` (%d). Followers may fall behind while it runs.' % 
+                (current['snapshot_ticks'], limit))
+
+        return RulesResult(warnings, [])
+
+class DataScanner(object):
+    """ Read the snapshots and txn logs found in the `version-2` 
+    directories of `dataDir` and `dataLogDir`
+
+    Files are memory-mapped and only the headers and the length of each
+    txn log record are decoded, so large logs are never loaded in memory.
+    A txn log starts with a 16 byte header (magic, version, dbid) and 
+    each record is a checksum, a length, the txn (whose header holds the
+    zxid and the time) and an end of record byte. The rest of the file is
+    preallocated with zeros. Snapshots start with the same header and
+    are named after the last zxid they include. Unreadable files are
+    skipped and reported in `findings`. The heap is sized from the latest
+    snapshot because the whole data tree is kept in memory. """
+
+    LOG_MAGIC = 0x5A4B4C47 # ZKLG
+
+    SNAP_MAGIC = 0x5A4B534E # ZKSN
+
+    HEADER = struct.Struct('>iiq')
+
+    RECORD = struct.Struct('>qi')
+
+    LENGTH = struct.Struct('>8xi')
+
+    TXN = struct.Struct('>qiqq') # client id, cxid, zxid, time
+
+    HEAP_RATIO = 3
+
+    class LogFile(object):
+
+        __slots__ = ('name', 'size', 'used', 'count', 'first_zxid', 
+            'last_zxid', 'first_time', 'last_time')
+
+        def __init__(self, name, size):
+            self.name = name
+            self.size = size
+            self.used = self.count = 0
+            self.first_zxid = self.last_zxid = None
+            self.first_time = self.last_time = None
+
+        def __repr__(self):
+            return '<DataScanner.LogFile name="%s" count="%d">' % (self.name, self.count)
+
+    class Snapshot(object):
+
+        __slots__ = ('name', 'size', 'zxid')
+
+        def __init__(self, name, size, zxid):
+            self.name = name
+            self.size = size
+            self.zxid = zxid
+
+        def __repr__(self):
+            return '<DataScanner.Snapshot name="%s" size="%d">' % (self.name, self.size)
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.snapshots = []
+        self.logs = []
+        self.findings = []
+
+    def directories(self):
+        """ Return the existing `version-2` directories, once each """
+        result = []
+        for key in ('dataDir', 'dataLogDir'):
+            path = self.cfg.get(key)
+            if not SCHEMA[key].accepts(path):
+                continue
+            path = os.path.realpath(os.path.join(path, 'version-2'))
+            if os.path.isdir(path) and path not in result:
+                result.append(path)
+        return result
+
+    def scan(self):
+        """ Read every snapshot and txn log. Returns self. """
+        self.snapshots, self.logs, self.findings = [], [], []
+        for directory in self.directories():
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                try:
+                    if name.startswith('log.'):
+                        self.logs.append(self.read_log(path))
+                    elif name.startswith('snapshot.'):
+                        self.snapshots.append(self.read_snapshot(path))
+                except (IOError, OSError, ValueError, struct.error), e:
+                    self.findings.append(Finding('Skipped `%s`: %s', (path, e),
+                        severity=Finding.WARNING))
+
+        self.logs.sort(key=lambda log: log.first_zxid)
+        self.snapshots.sort(key=lambda snapshot: snapshot.zxid)
+        return self
+
+    @staticmethod
+    def _zxid(name):
+        try:
+            return int(name.split('.')[1], 16)
+        except (IndexError, ValueError):
+            raise ValueError, 'Invalid file name: %s' % name
+
+    @classmethod
+    def read_snapshot(cls, path):
+        """ Return the Snapshot describing a snapshot file """
+        name = os.path.basename(path)
+        zxid = cls._zxid(name)
+        with open(path, 'rb') as f:
+            header = f.read(cls.HEADER.size)
+            size = os.fstat(f.fileno()).st_size
+        if len(header) < cls.HEADER.size or \
+                cls.HEADER.unpack(header)[0] != cls.SNAP_MAGIC:
+            raise ValueError, 'Invalid snapshot header: %s' % path
+        return DataScanner.Snapshot(name, size, zxid)
+
+    @classmethod
+    def read_log(cls, path):
+        """ Return the LogFile describing a txn log """
+        import mmap
+        name = os.path.basename(path)
+        log = DataScanner.LogFile(name, os.path.getsize(path))
+        log.first_zxid = cls._zxid(name)
+        if log.size < cls.HEADER.size:
+            return log
+
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, dbid = cls.HEADER.unpack_from(data, 0)
+            if magic != cls.LOG_MAGIC:
+                raise ValueError, 'Invalid txn log header: %s' % path
+
+            record, txn = cls.RECORD, cls.TXN
+            length_at = cls.LENGTH.unpack_from # skips the checksum
+            offset, last, count = cls.HEADER.size, None, 0
+            end = log.size - record.size - txn.size
+            limit = log.size - record.size - 1
+            while offset <= end:
+                length = length_at(data, offset)[0]
+                if length < txn.size or offset + length > limit:
+                    break # preallocated space or truncated record
+                last = offset
+                count += 1
+                offset += record.size + length + 1
+
+            log.used, log.count = offset, count
+            if count:
+                _, _, log.first_zxid, log.first_time = txn.unpack_from(
+                    data, cls.HEADER.size + record.size)
+            if last is not None:
+                _, _, log.last_zxid, log.last_time = txn.unpack_from(
+                    data, last + record.size)
+        finally:
+            data.close()
+        return log
+
+    def summary(self):
+        """ Return a dict of totals over the scanned files """
+        txns = sum(log.count for log in self.logs)
+        used = sum(log.used for log in self.logs)
+        size = sum(log.size for log in self.logs)
+        times = [log.first_time for log in self.logs if log.count] + \
+            [log.last_time for log in self.logs if log.count]
+        span = times and (max(times) - min(times)) / 1000.0 or 0.0
+
+        return {
+            'snapshots': len(self.snapshots),
+            'snapshot_size': self.snapshots and self.snapshots[-1].size or 0,
+            'logs': len(self.logs),
+            'log_size': size,
+            'log_used': used,
+            'prealloc_used': size and float(used) / size or 0.0,
+            'txns': txns,
+            'txn_size': txns and float(used - self.HEADER.size * len(self.logs)) / txns,
+            'span': span,
+            'write_rate': span and txns / span or 0.0,
+            'growth': span and used / span or 0.0,
+        }
+
+    def recommend(self, target=0.1):
+        """ Return a `snapCount` for the observed workload and a JVM heap
+        size in MB """
+        summary = self.summary()
+        if not summary['snapshot_size']:
+            raise ValueError, 'No snapshot found.'
+
+        heap = summary['snapshot_size'] * self.HEAP_RATIO / float(1 << 20)
+        result = {'heap': max(512, int(math.ceil(heap / 256)) * 256)}
+        if summary['write_rate'] and summary['txn_size']:
+            workload = Workload(summary['write_rate'], summary['txn_size'], 
+                summary['snapshot_size'])
+            result['snapCount'] = DiskAdvisor(self.cfg, workload, target).recommend()['snapCount']
+        return result
+
+class DiskProbe(object):
+    """ Measure the fsync latency of txn log appends in `dataLogDir`
+
+    A probe file is preallocated with preAllocSize KB of zeros, like a 
+    new txn log, up to MAX_PREALLOC bytes or for max_seconds at most. 
+    Then appends of txn_size bytes are written and synced one at a time
+    until either count appends are done or max_seconds elapsed. Every
+    write waits for the leader's log to be synced, so the latencies are
+    compared with `tickTime` and `syncLimit`. """
+
+    TXN_SIZE = 512
+
+    CHUNK_SIZE = 64 * 1024
+
+    MAX_PREALLOC = 64 * 1024 * 1024 # the default preAllocSize
+
+    def __init__(self, cfg, txn_size=TXN_SIZE, count=200, max_seconds=5.0):
+        self.cfg = cfg
+        self.txn_size = txn_size
+        self.count = count
+        self.max_seconds = max_seconds
+
+    @staticmethod
+    def percentile(samples, fraction):
+        """ Nearest-rank percentile of sorted samples """
+        index = int(math.ceil(fraction * len(samples))) - 1
+        return samples[max(0, min(index, len(samples) - 1))]
+
+    def run(self):
+        """ Run the probe and return a dict of latencies in milliseconds """
+        log_dir = self.cfg.get('dataLogDir', self.cfg.get('dataDir'))
+        if not log_dir or not os.path.isdir(log_dir):
+            raise ValueError, 'The `dataLogDir` should be an existing directory.'
+
+        import tempfile
+        size = min(SCHEMA['preAllocSize'].positive(self.cfg) * 1024, self.MAX_PREALLOC)
+        sync = getattr(os, 'fdatasync', os.fsync)
+        fd, name = tempfile.mkstemp(prefix='.zoocfg-probe-', dir=log_dir)
+        try:
+            start = time.time()
+            deadline = start + self.max_seconds
+            zeros = '\0' * self.CHUNK_SIZE
+            for offset in xrange(0, size, self.CHUNK_SIZE):
+                if offset and time.time() >= deadline:
+                    size = offset
+                    break
+                os.write(fd, zeros[:size - offset])
+            os.fsync(fd)
+            prealloc = time.time() - start
+
+            txn, samples = '\1' * self.txn_size, []
+            deadline = time.time() + self.max_seconds
+            offset = 0
+            while len(samples) < self.count and (not samples or time.time() < deadline):
+                if offset + self.txn_size > size:
+                    offset = 0
+                os.lseek(fd, offset, os.SEEK_SET)
+                start = time.time()
+                os.write(fd, txn)
+                sync(fd)
+                samples.append((time.time() - start) * 1000)
+                offset += self.txn_size
+        finally:
+            os.close(fd)
+            os.unlink(name)
+
+        samples.sort()
+        return {
+            'samples': len(samples),
+            'prealloc_size': size / 1024,
+            'prealloc': prealloc * 1000,
+            'p50': self.percentile(samples, 0.5),
+            'p99': self.percentile(samples, 0.99),
+            'max': samples[-1],
+        }
+
+    def advise(self, result=None):
+        """ Return a RulesResult with warnings for the probe results """
+        result = result or self.run()
+        tick = SCHEMA['tickTime'].positive(self.cfg)
+        warnings = []
+
+        if result['p99'] > tick:
+            warnings.append('The 99th percentile fsync latency of `dataLogDir` '\
+                '(%.1fms) is longer than `tickTime` (%dms). Writes will queue up '\
+                'and followers will likely fall behind.' % (result['p99'], tick))
+
+        limit = self.cfg.get('syncLimit')
+        if isinstance(limit, int) and result['max'] > limit * tick:
+            warnings.append('The slowest fsync of `dataLogDir` (%.1fms) is longer '\
+                'than `syncLimit` * `tickTime` (%dms). Followers may be dropped from '\
+                'the quorum.' % (result['max'], limit * tick))
+
+        return RulesResult(warnings, [])
+
+class ReachabilityProbe(object):
+    """ Connect to the quorum and election ports of every server and to
+    the `clientPort` on each server host, and measure the connect time
+
+    Connections are non-blocking and multiplexed in a single poll loop, 
+    at most `concurrency` in flight at a time and each with its own 
+    timeout, so a whole ensemble is checked in about one timeout. Only 
+    the leader accepts connections on the quorum port. """
+
+    RTT_FRACTION = 0.25
+
+    class Endpoint(object):
+
+        __slots__ = ('name', 'host', 'port', 'latency', 'error')
+
+        def __init__(self, name, host, port):
+            self.name = name
+            self.host = host
+            self.port = port
+            self.latency = None
+            self.error = None
+
+        @property
+        def reachable(self): return self.latency is not None
+
+        def __repr__(self):
+            return '<ReachabilityProbe.Endpoint name="%s" address="%s:%d">' % \
+                (self.name, self.host, self.port)
+
+    def __init__(self, cfg, timeout=1.0, concurrency=1000):
+        self.cfg = cfg
+        self.timeout = timeout
+        self.concurrency = max(1, min(concurrency, self._max_sockets()))
+
+    @staticmethod
+    def _max_sockets():
+        try:
+            import resource
+            return resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 64
+        except (ImportError, ValueError):
+            return 256
+
+    def endpoints(self):
+        """ Return the list of endpoints to probe """
+        endpoints = []
+        client_port = self.cfg.get('clientPort')
+        servers = self.cfg.get_servers()
+        for server in servers:
+            name = 'server.%d' % server.id
+            endpoints.append(ReachabilityProbe.Endpoint(
+                name + ' quorum', server.host, server.port))
+            endpoints.append(ReachabilityProbe.Endpoint(
+                name + ' election', server.host, server.election_port))
+            if SCHEMA['clientPort'].accepts(client_port):
+                endpoints.append(ReachabilityProbe.Endpoint(
+                    name + ' client', server.host, client_port))
+
+        if not servers and SCHEMA['clientPort'].accepts(client_port):
+            host = self.cfg.get('clientPortAddress') or 'localhost'
+            endpoints.append(ReachabilityProbe.Endpoint('client', host, client_port))
+        return endpoints
+
+    def _connect(self, endpoint, addresses):
+        import socket
+        try:
+            if endpoint.host not in addresses:
+                addresses[endpoint.host] = socket.getaddrinfo(endpoint.host, 
+                    None, 0, socket.SOCK_STREAM)[0]
+            family, _, _, _, address = addresses[endpoint.host]
+        except socket.error, e:
+            endpoint.error = str(e)
+            return None
+
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        code = sock.connect_ex((address[0], endpoint.port) + address[2:])
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            endpoint.error = os.strerror(code)
+            sock.close()
+            return None
+        return sock
+
+    def run(self, endpoints=None):
+        """ Probe the endpoints and return them with `latency` (ms) or 
+        `error` set """
+        import socket
+        endpoints = self.endpoints() if endpoints is None else endpoints
+        pending = list(reversed(endpoints))
+        active, addresses = {}, {}
+        poller = select.poll()
+
+        while pending or active:
+            while pending and len(active) < self.concurrency:
+                endpoint = pending.pop()
+                start = time.time()
+                sock = self._connect(endpoint, addresses)
+                if sock is not None:
+                    active[sock.fileno()] = (sock, endpoint, start)
+                    poller.register(sock, select.POLLOUT)
+
+            if not active:
+                continue
+
+            deadline = min(start for _, _, start in active.itervalues()) + self.timeout
+            events = poller.poll(max(0, deadline - time.time()) * 1000)
+            now = time.time()
+            for fd, _ in events:
+                sock, endpoint, start = active.pop(fd)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code:
+                    endpoint.error = os.strerror(code)
+                else:
+                    endpoint.latency = (now - start) * 1000
+                poller.unregister(fd)
+                sock.close()
+
+            for fd, (sock, endpoint, start) in active.items():
+                if now - start >= self.timeout:
+                    endpoint.error = 'timed out after %.1fs' % self.timeout
+                    del active[fd]
+                    poller.unregister(fd)
+                    sock.close()
+
+        return endpoints
+
+    def advise(self, endpoints=None):
+        """ Return a RulesResult with warnings for unreachable or slow 
+        endpoints """
+        endpoints = self.run() if endpoints is None else endpoints
+        tick = SCHEMA['tickTime'].coerce(self.cfg.get('tickTime'))
+        warnings = []
+
+        quorum = [e for e in endpoints if e.name.endswith(' quorum')]
+        if quorum and not any(e.reachable for e in quorum):
+            warnings.append('No server accepts connections on its quorum port. '\
+                'The ensemble has no leader or the ports are blocked.')
+
+        for endpoint in endpoints:
+            if endpoint.name.endswith(' quorum'):
+                continue
+            if not endpoint.reachable:
+                warnings.append('`%s` (%s:%d) is not reachable: %s.' % (endpoint.name,
+                    endpoint.host, endpoint.port, endpoint.error))
+
+        if SCHEMA['tickTime'].accepts(tick) and tick:
+            for endpoint in endpoints:
+                if endpoint.reachable and endpoint.latency > tick * self.RTT_FRACTION:
+                    warnings.append('Connecting to `%s` (%s:%d) took %.1fms, more '\
+                        'than a quarter of `tickTime` (%dms).' % (endpoint.name, 
+                        endpoint.host, endpoint.port, endpoint.latency, tick))
+
+        return RulesResult(warnings, [])
+
+class LiveProbe(ReachabilityProbe):
+    """ Ask every server for its running configuration and state with the
+    `conf`, `srvr` and `mntr` four letter word commands, and report the
+    values that drifted from the config file
+
+    The server closes the connection after each answer, so every command
+    uses its own connection. They all share one poll loop with the same
+    concurrency limit and per-connection timeout as ReachabilityProbe, 
+    and the members of many configs can be swept in a single run. Servers
+    that don't know `srvr` (before 3.3) are asked for `stat` instead. """
+
+    COMMANDS = ('conf', 'srvr', 'mntr')
+
+    MAX_RESPONSE = 1 << 20
+
+    DRIFT_KEYS = ('clientPort', 'tickTime', 'initLimit', 'syncLimit', 
+        'maxClientCnxns', 'minSessionTimeout', 'maxSessionTimeout', 
+        'dataDir', 'dataLogDir')
+
+    class Member(object):
+
+        __slots__ = ('name', 'host', 'port', 'cfg', 'responses', 'errors')
+
+        def __init__(self, name, host, port, cfg):
+            self.name = name
+            self.host = host
+            self.port = port
+            self.cfg = cfg
+            self.responses = {}
+            self.errors = {}
+
+        @property
+        def reachable(self): return bool(self.responses)
+
+        def __repr__(self):
+            return '<LiveProbe.Member name="%s" address="%s:%d">' % \
+                (self.name, self.host, self.port)
+
+    class Request(object):
+
+        __slots__ = ('member', 'command', 'host', 'port', 'error', 'sent', 
+            'chunks', 'size')
+
+        def __init__(self, member, command):
+            self.member = member
+            self.command = command
+            self.host = member.host
+            self.port = member.port
+            self.error = None
+            self.sent = False
+            self.chunks = []
+            self.size = 0
+
+    def members(self):
+        """ Return the list of members to ask, one per server """
+        client_port = self.cfg.get('clientPort')
+        if not SCHEMA['clientPort'].accepts(client_port):
+            return []
+
+        members = [LiveProbe.Member('server.%d' % server.id, server.host, 
+            client_port, self.cfg) for server in self.cfg.get_servers()]
+        if not members:
+            host = self.cfg.get('clientPortAddress') or 'localhost'
+            members.append(LiveProbe.Member('standalone', host, client_port, self.cfg))
+        return members
+
+    def run(self, members=None):
+        """ Send the commands to the members and return them with the 
+        parsed `responses` and the `errors` by command """
+        import socket
+        members = self.members() if members is None else members
+        pending = [LiveProbe.Request(member, command) 
+            for member in reversed(members) for command in reversed(self.COMMANDS)]
+        active, addresses = {}, {}
+        poller = select.poll()
+
+        while pending or active:
+            while pending and len(active) < self.concurrency:
+                request = pending.pop()
+                sock = self._connect(request, addresses)
+                if sock is None:
+                    self._finish(request, pending)
+                else:
+                    active[sock.fileno()] = (sock, request, time.time())
+                    poller.register(sock, select.POLLOUT)
+
+            if not active:
+                continue
+
+            deadline = min(start for _, _, start in active.itervalues()) + self.timeout
+            events = poller.poll(max(0, deadline - time.time()) * 1000)
+            for fd, _ in events:
+                sock, request, _ = active[fd]
+                try:
+                    if not request.sent:
+                        code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        if code:
+                            raise socket.error(code, os.strerror(code))
+                        sock.send(request.command)
+                        request.sent = True
+                        poller.modify(fd, select.POLLIN)
+                        continue
+
+                    data = sock.recv(65536)
+                    if data and request.size < self.MAX_RESPONSE:
+                        request.chunks.append(data)
+                        request.size += len(data)
+                        continue
+                except socket.error, e:
+                    request.error = e.args[-1]
+
+                del active[fd]
+                poller.unregister(fd)
+                sock.close()
+                self._finish(request, pending)
+
+            now = time.time()
+            for fd, (sock, request, start) in active.items():
+                if now - start >= self.timeout:
+                    request.error = 'timed out after %.1fs' % self.timeout
+                    del active[fd]
+                    poller.unregister(fd)
+                    sock.close()
+                    self._finish(request, pending)
+
+        return members
+
+    def _finish(self, request, pending):
+        member, command = request.member, request.command
+        text = ''.join(request.chunks)
+        if request.error is None:
+            if 'not in the whitelist' in text:
+                request.error = 'not in 4lw.commands.whitelist'
+            elif not text.strip():
+                request.error = 'no response'
+
+        if request.error is None:
+            member.responses[command] = self.parse(command, text)
+        elif command == 'srvr' and request.error == 'no response':
+            pending.append(LiveProbe.Request(member, 'stat'))
+        else:
+            member.errors[command] = request.error
+
+    @staticmethod
+    def parse(command, text):
+        """ Return the key/value pairs of a response as a dict. `conf` 
+        answers key=value lines, `mntr` tab separated lines and `srvr` 
+        and `stat` "Key: value" lines. """
+        separator = {'conf': '=', 'mntr': '\t'}.get(command, ': ')
+        result = {}
+        for line in text.splitlines():
+            if line[:1].isspace():
+                continue # the client list of `stat`
+            key, found, value = line.partition(separator)
+            if found:
+                result[key.strip()] = value.strip()
+        return result
+
+    def status(self, member):
+        """ Return the mode, the request latencies (ms), the outstanding 
+        requests and the connections reported by a member. Unknown 
+        figures are None. """
+        monitor = member.responses.get('mntr', {})
+        stat = member.responses.get('srvr') or member.responses.get('stat', {})
+        latency = (stat.get('Latency min/avg/max', '').split('/') + [None] * 3)[:3]
+
+        def number(type, *values):
+            for value in values:
+                try:
+                    return type(value)
+                except (TypeError, ValueError):
+                    pass
+            return None
+
+        return {
+            'mode': monitor.get('zk_server_state') or stat.get('Mode'),
+            'latency_min': number(float, monitor.get('zk_min_latency'), latency[0]),
+            'latency_avg': number(float, monitor.get('zk_avg_latency'), latency[1]),
+            'latency_max': number(float, monitor.get('zk_max_latency'), latency[2]),
+            'outstanding': number(int, monitor.get('zk_outstanding_requests'), 
+                stat.get('Outstanding')),
+            'connections': number(int, monitor.get('zk_num_alive_connections'),
+                stat.get('Connections')),
+        }
+
+    @staticmethod
+    def expected(cfg, key):
+        """ Return the value the server should run with for a key of the 
+        config file, or None if it can't be known """
+        if key in ('minSessionTimeout', 'maxSessionTimeout') and \
+                cfg.line_of(key) is None:
+            tick = SCHEMA['tickTime'].coerce(cfg.get('tickTime'))
+            if not SCHEMA['tickTime'].accepts(tick):
+                return None
+            return tick * (key == 'minSessionTimeout' and 2 or 20)
+
+        value = SCHEMA[key].coerce(cfg.get(key))
+        return value if SCHEMA[key].accepts(value) else None
+
+    @staticmethod
+    def _same_path(expected, live):
+        if os.path.basename(live) == 'version-2':
+            live = os.path.dirname(live)
+        expected, live = os.path.normpath(expected), os.path.normpath(live)
+        if os.path.isabs(expected):
+            return expected == live
+        return live == expected or live.endswith(os.sep + expected)
+
+    def drift(self, member):
+        """ Return the list of ConfigDiff.Change from the value of the 
+        config file (old) to the value the member runs with (new) """
+        conf, changes = member.responses.get('conf', {}), []
+        for key in self.DRIFT_KEYS:
+            expected, live = self.expected(member.cfg, key), conf.get(key)
+            if expected is None or live is None:
+                continue
+            if SCHEMA[key].unit == 'path':
+                if self._same_path(expected, live):
+                    continue
+            elif SCHEMA[key].coerce(live) == expected:
+                continue
+            changes.append(ConfigDiff.Change(key, expected, live, 
+                ConfigDiff.category(key)))
+        return changes
+
+    def advise(self, members=None):
+        """ Return a RulesResult with errors for the drifted values and 
+        warnings for the members that don't answer, slow requests and 
+        throttled or split ensembles """
+        members = self.run() if members is None else members
+        warnings, errors = [], []
+
+        for member in members:
+            if not member.reachable:
+                warnings.append('`%s` (%s:%d) did not answer: %s.' % (member.name, 
+                    member.host, member.port, member.errors.get('conf')))
+                continue
+
+            for command, error in sorted(member.errors.iteritems()):
+                warnings.append('`%s` (%s:%d) did not answer `%s`: %s.' % \
+                    (member.name, member.host, member.port, command, error))
+
+            for change in self.drift(member):
+                errors.append(Finding('`%s` runs with `%s`=%s but the config '\
+                    'file has %s.', (member.name, change.key, change.new, 
+                    change.old), change.key, line=member.cfg.line_of(change.key)))
+
+            status = self.status(member)
+            tick = self.expected(member.cfg, 'tickTime')
+            if tick and status['latency_avg'] is not None and \
+                    status['latency_avg'] > tick * self.RTT_FRACTION:
+                warnings.append('`%s` answers requests in %.1fms on average, '\
+                    'more than a quarter of `tickTime` (%dms).' % (member.name, 
+                    status['latency_avg'], tick))
+
+            limit = self.expected(member.cfg, 'globalOutstandingLimit')
+            if limit and status['outstanding'] is not None and \
+                    status['outstanding'] >= limit:
+                warnings.append('`%s` has %d outstanding requests and throttles '\
+                    'clients (`globalOutstandingLimit`=%d).' % (member.name, 
+                    status['outstanding'], limit))
+
+        groups = {}
+        for member in members:
+            mode = self.status(member)['mode']
+            if member.cfg is not None and mode in ('leader', 'follower'):
+                groups.setdefault(id(member.cfg), []).append((member, mode))
+        for group in groups.itervalues():
+            leaders = [member.name for member, mode in group if mode == 'leader']
+            if len(leaders) > 1:
+                warnings.append('More than one member reports being the leader: '\
+                    '%s.' % ', '.join('`%s`' % name for name in leaders))
+            elif not leaders:
+                warnings.append('No member reports being the leader.')
+
+        return RulesResult(warnings, errors)
+
+class QuorumSimulator(object):
+    """ Monte Carlo model of write commit latency, follower timeouts and
+    election time for the membership of a config
+
+    The round trip time of each link between the leader and a follower 
+    is drawn from a log-normal distribution given by its median (ms) and
+    shape `sigma`. `latency` maps (id, id) pairs to (median, sigma) and
+    `default` is used for the other links. A write commits when the 
+    leader and a majority of the voters synced the txn, so after the 
+    (majority - 1)-th fastest follower ack. A follower is dropped when 
+    its round trip exceeds `syncLimit` ticks. An election takes the
+    finalize wait plus two rounds of notifications to a majority.
+
+    Scenarios are sampled in batches with NumPy when it is installed
+    and one by one in pure Python otherwise. """
+
+    FINALIZE_WAIT = 200
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, cfg, latency=None, default=(1.0, 0.5), fsync=0.0, 
+            leader=None, seed=None):
+        servers = cfg.get_servers()
+        voters = [s.id for s in servers if not s.is_observer]
+        if not voters:
+            raise ValueError, 'The config should list at least one participant.'
+
+        tick = SCHEMA['tickTime'].coerce(cfg.get('tickTime'))
+        sync = SCHEMA['syncLimit'].coerce(cfg.get('syncLimit'))
+        if not (SCHEMA['tickTime'].accepts(tick) and SCHEMA['syncLimit'].accepts(sync)):
+            raise ValueError, '`tickTime` and `syncLimit` should be positive integers.'
+
+        self.leader = leader if leader is not None else max(voters)
+        self.followers = [id for id in voters if id != self.leader]
+        self.quorum = len(voters) / 2 + 1
+        self.sync_limit = tick * sync
+        self.tick_time = tick
+        self.fsync = fsync
+        self.seed = seed
+
+        latency = latency or {}
+        self.links = [latency.get((self.leader, id), latency.get((id, self.leader), 
+            default)) for id in self.followers]
+
+    @staticmethod
+    def _numpy():
+        try:
+            import numpy
+            return numpy
+        except ImportError:
+            return None
+
+    def run(self, runs=10000, use_numpy=None):
+        """ Simulate `runs` scenarios and return a dict of estimates """
+        np = self._numpy() if use_numpy in (None, True) else None
+        if use_numpy and np is None:
+            raise ValueError, 'NumPy is not installed.'
+        if np is not None:
+            commits, elections, timeouts, lost = self._run_numpy(np, runs)
+        else:
+            commits, elections, timeouts, lost = self._run_python(runs)
+
+        percentile = DiskProbe.percentile
+        links = max(1, len(self.followers)) * runs
+        return {
+            'runs': runs,
+            'commit_p50': float(percentile(commits, 0.5)),
+            'commit_p99': float(percentile(commits, 0.99)),
+            'election_p50': float(percentile(elections, 0.5)),
+            'election_p99': float(percentile(elections, 0.99)),
+            'follower_timeout': float(timeouts) / links,
+            'quorum_loss': float(lost) / runs,
+        }
+
+    def _run_python(self, runs):
+        import random
+        rng = random.Random(self.seed)
+        params = [(math.log(median), sigma) for median, sigma in self.links]
+        needed = self.quorum - 1
+        commits, elections, timeouts, lost = [], [], 0, 0
+
+        for _ in xrange(runs):
+            rtts = sorted(rng.lognormvariate(mu, sigma) for mu, sigma in params)
+            fastest = needed and rtts[needed - 1] or 0.0
+            commits.append(fastest + self.fsync)
+            elections.append(self.FINALIZE_WAIT + 2 * fastest)
+            late = sum(1 for rtt in rtts if rtt > self.sync_limit)
+            timeouts += late
+            lost += len(rtts) - late < needed
+
+        commits.sort()
+        elections.sort()
+        return commits, elections, timeouts, lost
+
+    def _run_numpy(self, np, runs):
+        rng = np.random.RandomState(self.seed)
+        mu = np.log([median for median, _ in self.links])
+        sigma = np.array([sigma for _, sigma in self.links])
+        needed = self.quorum - 1
+        commits, elections, timeouts, lost = [], [], 0, 0
+
+        for start in xrange(0, runs, self.BATCH_SIZE):
+            size = min(self.BATCH_SIZE, runs - start)
+            if not needed:
+                fastest = np.zeros(size)
+                rtts = np.zeros((size, 0))
+            else:
+                rtts = rng.lognormal(mu, sigma, (size, len(self.links)))
+                fastest = np.partition(rtts, needed - 1, axis=1)[:, needed - 1]
+            commits.append(fastest + self.fsync)
+            elections.append(self.FINALIZE_WAIT + 2 * fastest)
+            late = rtts > self.sync_limit
+            timeouts += int(late.sum())
+            lost += int((rtts.shape[1] - late.sum(axis=1) < needed).sum())
+
+        return np.sort(np.concatenate(commits)), \
+            np.sort(np.concatenate(elections)), timeouts, lost
+
+    def advise(self, result=None):
+        """ Return a RulesResult with warnings for the simulation results """
+        result = result or self.run()
+        warnings = []
+
+        if result['commit_p99'] > self.tick_time:
+            warnings.append('The simulated 99th percentile commit latency '\
+                '(%.1fms) is longer than `tickTime` (%dms).' % 
+                (result['commit_p99'], self.tick_time))
+
+        if result['follower_timeout'] > 0.001:
+            warnings.append('Followers exceed `syncLimit` (%dms) in %.2f%% of '\
+                'the simulated round trips and would be dropped.' % 
+                (self.sync_limit, result['follower_timeout'] * 100))
+
+        if result['quorum_loss'] > 0:
+            warnings.append('The quorum is lost in %.2f%% of the simulated '\
+                'scenarios.' % (result['quorum_loss'] * 100))
+
+        return RulesResult(warnings, [])
+
+class ResultCache(object):
+    """ On-disk cache of validation results keyed by the hash of the 
+    config file content and a fingerprint of the rule set
+
+    Entries are small JSON files written atomically with a rename so
+    many processes can share the same cache directory. Reading an entry
+    touches it and `evict()` removes the least recently used entries
+    above `max_entries`. The findings of I/O rules depend on the machine
+    and not only on the content: they are not stored and the I/O rules
+    run again on a hit, on the values of their keys stored with the
+    entry so that the file is not parsed again. """
+
+    _fingerprint = None
+
+    class Inputs(dict):
+        """ The values and line numbers of the keys read by the I/O rules """
+
+        def __init__(self, items):
+            dict.__init__(self)
+            self._lines = {}
+            for key, (value, line) in items.iteritems():
+                key = key.encode('utf-8')
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                self[key], self._lines[key] = value, line
+
+        def __getattr__(self, name):
+            try:
+                return self[name]
+            except KeyError:
+                raise AttributeError, name
+
+        def line_of(self, key):
+            return self._lines.get(key)
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path): raise
+
+    @classmethod
+    def fingerprint(cls):
+        """ Hash of the rules code and of this module source. Computed 
+        again when rules are added, for example by plugins. """
+        if cls._fingerprint is None or cls._fingerprint[0] is not RuleRegistry.table:
+            import hashlib
+            h = hashlib.sha1()
+            for id, check in RuleRegistry.table:
+                code = check.im_func.func_code
+                h.update('%s\0%s\0%r\0' % (id, code.co_code, code.co_consts))
+            try:
+                with open(__file__.replace('.pyc', '.py'), 'rb') as f:
+                    h.update(f.read())
+            except IOError:
+                pass
+            cls._fingerprint = (RuleRegistry.table, h.hexdigest())
+        return cls._fingerprint[1]
+
+    def key(self, content, select=None, exclude=None):
+        import hashlib
+        h = hashlib.sha1(self.fingerprint())
+        h.update('\0%s\0%s\0' % (','.join(sorted(select or ())), 
+            ','.join(sorted(exclude or ()))))
+        h.update(content)
+        return h.hexdigest()
+
+    @staticmethod
+    def io_rules(select=None, exclude=None):
+        """ The ids of the selected rules whose findings are not cached """
+        table = RuleRegistry.select(select, exclude) if select or exclude \
+            else RuleRegistry.table
+        return [id for id, _ in table if RuleRegistry.rules[id].io]
+
+    @staticmethod
+    def io_keys():
+        """ The keys read by the I/O rules or None if one of them reads
+        the servers or does not list its keys """
+        keys = set()
+        for id, _ in RuleRegistry.table:
+            rule = RuleRegistry.rules[id]
+            if rule.io:
+                if rule.keys is None or 'server.*' in rule.keys:
+                    return None
+                keys.update(rule.keys)
+        return keys
+
+    def get(self, key):
+        """ Return the cached RulesResult or None. Its `inputs` are the
+        stored values of the keys read by the I/O rules, if any. """
+        import json
+        file_name = self._file_name(key)
+        try:
+            with open(file_name, 'rb') as f:
+                data = json.load(f)
+            result = RulesResult.from_findings([Finding.from_dict(item)
+                for item in data['findings']], cached=True)
+            if 'inputs' in data:
+                result.inputs = self.Inputs(data['inputs'])
+            os.utime(file_name, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.misses += 1 # not JSON or not an entry: drop it
+            try:
+                os.unlink(file_name)
+            except OSError:
+                pass
+            return None
+
+        self.hits += 1
+        return result
+
+    def put(self, key, result, cfg=None):
+        """ Store the result without the findings of the I/O rules. The
+        values they read are taken from `cfg` if given. """
+        import json, tempfile
+        file_name = self._file_name(key)
+        directory = os.path.dirname(file_name)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory): raise
+
+        data = {'findings': [finding.as_dict() for finding in result.findings
+            if finding.rule not in RuleRegistry.rules or
+            not RuleRegistry.rules[finding.rule].io]}
+        keys = self.io_keys() if cfg is not None else None
+        if keys is not None:
+            data['inputs'] = dict((key, (cfg[key], cfg.line_of(key)))
+                for key in keys if key in cfg)
+
+        fd, tmp_name = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(data, f)
+            os.rename(tmp_name, file_name)
+        except:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+
+    def evict(self):
+        """ Remove the least recently used entries above the size limit.
+        Returns the number of removed entries. The entries are only 
+        stat'ed when there are too many. """
+        file_names = []
+        for root, dirs, files in os.walk(self.path):
+            file_names.extend(os.path.join(root, name) for name in files 
+                if not name.startswith('.tmp-'))
+        if len(file_names) <= self.max_entries:
+            return 0
+
+        entries = []
+        for file_name in file_names:
+            try:
+                entries.append((os.stat(file_name).st_mtime, file_name))
+            except OSError:
+                pass # removed by another process
+
+        removed = 0
+        entries.sort()
+        for _, file_name in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.unlink(file_name)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _file_name(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+class FleetIndex(object):
+    """ Compact on-disk index of the settings of many config files
+
+    The index is one binary file: the name, mtime, size and content 
+    hash of every config file, the servers of every file, a sorted 
+    string table and one sorted column per key. A column holds the 
+    distinct values of the key, where each run of equal values ends, 
+    and the rows ordered by value, so a condition is a binary search 
+    and a slice. The file is memory-mapped on load and a query only 
+    reads the slices it needs, which takes milliseconds over 100k files.
+    Strings are stored as their rank in the string table, which keeps 
+    their order. Values are the effective ones: defaults included and
+    `dataLogDir` from `dataDir`. Files without a value are not in the 
+    column and never match.
+
+    Besides the keys of SCHEMA the index has `servers`, `observers`,
+    `reusedPort` (the ports used twice on the same host, counting 
+    clientPort) and, per server, `host` and `port` (quorum or election).
+    A condition on `reusedPort` holds if one of the ports satisfies it,
+    and `!=` if none is equal. Server conditions of a query must hold 
+    for the same server. """
+
+    MAGIC, VERSION = 'ZCIX', 2
+
+    HEADER = struct.Struct('<4sHHIII') # magic, version, columns, files, servers, strings
+    COLUMN = struct.Struct('<IcII') # name, type code, distinct values, rows
+
+    COMPUTED = ('servers', 'observers', 'reusedPort')
+    MULTI = ('reusedPort',) # a tuple of values per row
+    KEYS = tuple(sorted(SCHEMA)) + COMPUTED
+    SERVER_COLUMNS = ('.host', '.port', '.election')
+    SERVER_KEYS = ('host', 'port')
+
+    _QUERY = r'\s*([\w.]+)\s*(<=|>=|!=|=|<|>)\s*(.*?)\s*$' # compiled on first use by re
+
+    def __init__(self, path):
+        """ Map the index file at PATH. Raises ValueError if it is not
+        an index of this version. """
+        import mmap
+        self.path = path
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, columns, files, servers, strings = \
+                self.HEADER.unpack_from(self._data, 0)
+        except struct.error:
+            magic = version = None
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError, 'Invalid fleet index: %s' % path
+
+        self._size, self._server_count, self._string_count = files, servers, strings
+        self._string_offsets = None
+        self._strings_at = self.HEADER.size + self.COLUMN.size * columns
+        self._blob_at = self._strings_at + 4 * (strings + 1)
+        offset = self._blob_at + struct.unpack_from('<I', self._data, 
+            self._strings_at + 4 * strings)[0]
+
+        self._layout = {}
+        for name, code in ('.name', 'I'), ('.mtime', 'd'), ('.size', 'Q'), ('.hash', '8s'):
+            self._layout[name] = (offset, code, files)
+            offset += files * struct.calcsize(code)
+        for name, code in ('.row', 'I'), ('.host', 'I'), ('.port', 'H'), ('.election', 'H'):
+            self._layout[name] = (offset, code, servers)
+            offset += servers * struct.calcsize(code)
+
+        self._columns = {}
+        for i in xrange(columns):
+            name, code, distinct, count = self.COLUMN.unpack_from(self._data, 
+                self.HEADER.size + self.COLUMN.size * i)
+            size = struct.calcsize(code)
+            self._columns[self.string(name)] = (offset, code, distinct, count)
+            offset += (size + 4) * distinct + 4 * count
+        self._cache = {}
+
+    def close(self):
+        self._data.close()
+
+    def __len__(self):
+        return self._size
+
+    def string(self, i):
+        if self._string_offsets is None:
+            start, end = struct.unpack_from('<II', self._data, self._strings_at + 4 * i)
+        else:
+            start, end = self._string_offsets[i:i + 2]
+        return self._data[self._blob_at + start:self._blob_at + end]
+
+    def _load_strings(self):
+        """ Unpack the string offsets, faster when reading many strings """
+        if self._string_offsets is None:
+            self._string_offsets = struct.unpack_from('<%dI' % 
+                (self._string_count + 1), self._data, self._strings_at)
+
+    def _rank(self, value):
+        """ Return the rank of a string, or the rank it would have minus
+        0.5 if it is not in the table, which compares the same way """
+        low, high = 0, self._string_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.string(middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._string_count and self.string(low) == value:
+            return low
+        return low - 0.5
+
+    def _array(self, name):
+        """ Return a plain array of the files or servers tables """
+        if name not in self._cache:
+            offset, code, count = self._layout[name]
+            self._cache[name] = struct.unpack_from('<%d%s' % (count, code), 
+                self._data, offset)
+        return self._cache[name]
+
+    def _item(self, name):
+        """ Return a function reading single values of a plain array, 
+        faster than `_array` for a few values """
+        offset, code, _ = self._layout[name]
+        unpack, size = struct.Struct('<' + code).unpack_from, struct.calcsize(code)
+        return lambda i: unpack(self._data, offset + size * i)[0]
+
+    def file(self, row):
+        """ Return the (name, mtime, size, hash) of a row """
+        offset = self._layout['.hash'][0] + 8 * row
+        return (self.string(self._array('.name')[row]), self._array('.mtime')[row],
+            self._array('.size')[row], self._data[offset:offset + 8])
+
+    def rows(self):
+        """ Return a dict of file name -> row """
+        self._load_strings()
+        return dict((self.string(name), row) 
+            for row, name in enumerate(self._array('.name')))
+
+    def _match(self, key, op, value):
+        """ Return the number of rows (or servers) whose value of a key
+        satisfies `op(value)` and a function returning them as a set """
+        import operator
+        if key not in self._columns:
+            raise ValueError, 'Unknown key `%s`.' % key
+        offset, code, distinct, count = self._columns[key]
+        if isinstance(value, basestring):
+            value = self._rank(value)
+        size = struct.calcsize(code)
+        value_at = struct.Struct('<' + code).unpack_from
+        ends_at, order_at = offset + size * distinct, offset + (size + 4) * distinct
+
+        def bisect(right):
+            low, high = 0, distinct
+            while low < high:
+                middle = (low + high) // 2
+                found = value_at(self._data, offset + size * middle)[0]
+                if found < value or (right and found == value):
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+
+        def position(i): # where the run of the i-th distinct value starts
+            return i and struct.unpack_from('<I', self._data, ends_at + 4 * (i - 1))[0]
+
+        first, last = position(bisect(False)), position(bisect(True))
+        ranges = {operator.eq: [(first, last)], operator.ne: [(0, first), (last, count)],
+            operator.lt: [(0, first)], operator.le: [(0, last)],
+            operator.gt: [(last, count)], operator.ge: [(first, count)]}[op]
+
+        def unpack(start, end):
+            return struct.unpack_from('<%dI' % (end - start), self._data, 
+                order_at + 4 * start)
+
+        def rows():
+            result = set()
+            for start, end in ranges:
+                result.update(unpack(start, end))
+            if op is operator.ne and key in self.MULTI: # none is equal
+                result.difference_update(unpack(first, last))
+            return result
+        return sum(end - start for start, end in ranges), rows
+
+    def values(self, key):
+        """ Return the values of a key by row, None when missing """
+        if key not in self._columns:
+            raise ValueError, 'Unknown key `%s`.' % key
+        offset, code, distinct, count = self._columns[key]
+        size = struct.calcsize(code)
+        values = struct.unpack_from('<%d%s' % (distinct, code), self._data, offset)
+        ends = struct.unpack_from('<%dI' % distinct, self._data, offset + size * distinct)
+        order = struct.unpack_from('<%dI' % count, self._data, offset + (size + 4) * distinct)
+
+        setting = SCHEMA.get(key)
+        if setting is not None and setting.type is str:
+            values = map(self.string, values)
+        elif setting is not None and setting.type is bool:
+            values = map(bool, values)
+
+        result = [None] * (self._server_count if key in self.SERVER_COLUMNS else self._size)
+        start = 0
+        for value, end in zip(values, ends):
+            for row in order[start:end]:
+                if key in self.MULTI:
+                    result[row] = (result[row] or ()) + (value,)
+                else:
+                    result[row] = value
+            start = end
+        return result
+
+    def value(self, row, key):
+        """ Return the value of a key for a row or None """
+        if key not in self._cache:
+            self._cache[key] = self.values(key)
+        return self._cache[key][row]
+
+    @classmethod
+    def parse_query(cls, expression):
+        """ Split `key<op>value[,key<op>value...]` into a list of (key, 
+        operator, value) with the value converted to the type of the 
+        key. Operators: = != < <= > >= """
+        import operator
+        operators = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, 
+            '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+        clauses = []
+        for text in expression.split(','):
+            match = re.match(cls._QUERY, text)
+            if match is None or not match.group(3):
+                raise ValueError, 'Invalid query: `%s`' % text.strip()
+            key, op, value = match.groups()
+            if key not in cls.KEYS and key not in cls.SERVER_KEYS:
+                raise ValueError, 'Unknown key `%s`.' % key
+
+            setting = SCHEMA.get(key)
+            if setting is not None:
+                value = setting.coerce(value)
+                valid = setting.type is str or not isinstance(value, basestring)
+            elif key != 'host':
+                valid = value.isdigit()
+                value = valid and int(value) or value
+            else:
+                valid = True
+            if not valid:
+                raise ValueError, 'Invalid value for `%s`: %s' % (key, value)
+            clauses.append((key, operators[op], value))
+        return clauses
+
+    def select(self, clauses):
+        """ Return the sorted rows matching all the clauses """
+        rows = None
+        for key, op, value in clauses:
+            if key not in self.SERVER_KEYS:
+                found = self._match(key, op, int(value) 
+                    if isinstance(value, bool) else value)[1]()
+                rows = found if rows is None else rows & found
+
+        # servers: start with the most selective condition and check the
+        # others on the few servers left
+        servers = []
+        for key, op, value in clauses:
+            if key == 'host':
+                count, found = self._match('.host', op, value)
+                value = self._rank(value)
+            elif key == 'port':
+                count, found = self._match('.port', op, value)
+                election = self._match('.election', op, value)
+                count, found = count + election[0], \
+                    lambda found=found, election=election[1]: found() | election()
+            else:
+                continue
+            servers.append((count, key, op, value, found))
+
+        if servers:
+            servers.sort(key=lambda clause: clause[0])
+            candidates = servers[0][4]()
+            column = self._item if len(candidates) < self._server_count // 16 \
+                else lambda name: self._array(name).__getitem__
+            for _, key, op, value, _ in servers[1:]:
+                if key == 'host':
+                    hosts = column('.host')
+                    candidates = [i for i in candidates if op(hosts(i), value)]
+                else:
+                    ports, elections = column('.port'), column('.election')
+                    candidates = [i for i in candidates 
+                        if op(ports(i), value) or op(elections(i), value)]
+            row_of = column('.row')
+            found = set(row_of(i) for i in candidates)
+            rows = found if rows is None else rows & found
+        return range(self._size) if rows is None else sorted(rows)
+
+    def query(self, expression):
+        """ Return the names of the files matching a query such as 
+        `snapCount<5000` or `host=zk1,port=2888` """
+        rows = self.select(self.parse_query(expression))
+        names = self._array('.name')
+        if len(rows) < 1000:
+            return [self.string(names[row]) for row in rows]
+
+        self._load_strings()
+        data, offsets = self._data, self._string_offsets
+        blob = self._blob_at
+        return [data[blob + offsets[name]:blob + offsets[name + 1]] 
+            for name in [names[row] for row in rows]]
+
+    @classmethod
+    def entry(cls, content):
+        """ Return the (values, servers) indexed for a config file. Files
+        that can't be parsed have no values. """
+        try:
+            cfg = ZooCfg(content)
+            servers = cfg.get_servers()
+        except ValueError:
+            return (None,) * len(cls.KEYS), ()
+
+        values = []
+        for key in cls.KEYS[:-len(cls.COMPUTED)]:
+            value = SCHEMA[key].coerce(cfg.get(key))
+            if isinstance(value, basestring) and SCHEMA[key].type is not str:
+                value = None
+            elif isinstance(value, (int, long)) and \
+                    not -(1 << 63) <= value < (1 << 63):
+                value = None
+            values.append(value)
+
+        seen, reused = set(), set()
+        for server in servers:
+            for port in (server.port, server.election_port):
+                if (server.host, port) in seen:
+                    reused.add(port)
+                seen.add((server.host, port))
+        client_port = cfg.get('clientPort')
+        if any((server.host, client_port) in seen for server in servers):
+            reused.add(client_port)
+
+        values.extend((len(servers), sum(1 for s in servers if s.is_observer), 
+            reused and tuple(sorted(reused)) or None))
+        return tuple(values), tuple((s.host, s.port, s.election_port) for s in servers)
+
+    @classmethod
+    def update(cls, path, file_names):
+        """ Index the config files into PATH. Files whose mtime and size, 
+        or content hash, match the existing index are not parsed again.
+        Returns a dict with the number of `parsed`, `unchanged`, `removed`
+        and `failed` (unreadable) files. Files are keyed by absolute path
+        so runs from other directories update the same entries. """
+        import hashlib
+        try:
+            index = cls(path)
+        except (IOError, OSError, ValueError):
+            index, rows = None, {}
+        else:
+            rows = index.rows()
+
+        entries, stats = {}, {'parsed': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+        touched = False
+        try:
+            for file_name in file_names:
+                file_name = os.path.abspath(file_name)
+                row = rows.get(file_name)
+                try:
+                    st = os.stat(file_name)
+                    if row is not None and index.file(row)[1:3] == (st.st_mtime, st.st_size):
+                        entries[file_name] = index.file(row)[1:] + (row, None)
+                        stats['unchanged'] += 1
+                        continue
+                    with open(file_name, 'rb') as f:
+                        content = f.read()
+                except (IOError, OSError):
+                    stats['failed'] += 1
+                    continue
+
+                digest = hashlib.sha1(content).digest()[:8]
+                if row is not None and index.file(row)[3] == digest:
+                    entries[file_name] = (st.st_mtime, st.st_size, digest, row, None)
+                    stats['unchanged'] += 1
+                    touched = True
+                else:
+                    entries[file_name] = (st.st_mtime, st.st_size, digest) + \
+                        cls.entry(content)
+                    stats['parsed'] += 1
+
+            stats['removed'] = len(set(rows) - set(entries))
+            if touched or stats['parsed'] or stats['removed'] or index is None:
+                cls.write(path, entries, index)
+        finally:
+            if index is not None:
+                index.close()
+        return stats
+
+    @classmethod
+    def write(cls, path, entries, index=None):
+        """ Write a dict of file name -> (mtime, size, hash, values, 
+        servers) atomically to PATH. `values` can also be a row of 
+        `index` to copy with its servers. """
+        import tempfile
+        from bisect import bisect_right
+        names = sorted(entries)
+        text = set(key for key in cls.KEYS if key in SCHEMA and SCHEMA[key].type is str)
+
+        old_servers = {}
+        if index is not None:
+            index._load_strings()
+            hosts, ports = index._array('.host'), index._array('.port')
+            elections = index._array('.election')
+            for i, row in enumerate(index._array('.row')):
+                old_servers.setdefault(row, []).append(
+                    (index.string(hosts[i]), ports[i], elections[i]))
+
+        columns, sources = {}, [entries[name][3] for name in names]
+        for i, key in enumerate(cls.KEYS):
+            old = None
+            if index is not None:
+                old = index.values(key) if key in index._columns else [None] * len(index)
+            columns[key] = [values[i] if type(values) is tuple else old[values]
+                for values in sources]
+
+        servers = []
+        for row, name in enumerate(names):
+            values, members = entries[name][3:]
+            for host, port, election_port in (old_servers.get(values, ()) 
+                    if members is None else members):
+                servers.append((row, host, port, election_port))
+        columns['.host'] = [host for _, host, _, _ in servers]
+        columns['.port'] = [port for _, _, port, _ in servers]
+        columns['.election'] = [port for _, _, _, port in servers]
+
+        strings = set(names)
+        strings.update(cls.KEYS + cls.SERVER_COLUMNS)
+        for key in text | set(['.host']):
+            strings.update(columns[key])
+        strings.discard(None)
+        strings = sorted(strings)
+        rank = dict((string, i) for i, string in enumerate(strings))
+
+        chunks = [cls.HEADER.pack(cls.MAGIC, cls.VERSION, 
+            len(cls.KEYS + cls.SERVER_COLUMNS), len(names), len(servers), len(strings))]
+        encoded = []
+        for key in cls.KEYS + cls.SERVER_COLUMNS:
+            column = columns[key]
+            if key in text or key == '.host':
+                column = [value if value is None else rank[value] for value in column]
+            pairs = sorted((int(value), row) for row, values in enumerate(column)
+                if values is not None for value in 
+                (values if key in cls.MULTI else (values,)))
+            ordered, present = [value for value, _ in pairs], [row for _, row in pairs]
+            values = sorted(set(ordered))
+            ends = [bisect_right(ordered, value) for value in values]
+            for code in 'bhiq':
+                limit = 1 << (8 * struct.calcsize(code) - 1)
+                if not values or (-limit <= values[0] and values[-1] < limit):
+                    break
+            chunks.append(cls.COLUMN.pack(rank[key], code, len(values), len(present)))
+            encoded.append(struct.pack('<%d%s%dI%dI' % (len(values), code, len(ends), 
+                len(present)), *(values + ends + present)))
+
+        offsets, position = [0], 0
+        for string in strings:
+            position += len(string)
+            offsets.append(position)
+        chunks.append(struct.pack('<%dI' % len(offsets), *offsets))
+        chunks.extend(strings)
+
+        chunks.append(struct.pack('<%dI' % len(names), *[rank[name] for name in names]))
+        chunks.append(struct.pack('<%dd' % len(names), *[entries[name][0] for name in names]))
+        chunks.append(struct.pack('<%dQ' % len(names), *[entries[name][1] for name in names]))
+        chunks.extend(entries[name][2] for name in names)
+        for i, code in enumerate('IIHH'):
+            chunks.append(struct.pack('<%d%s' % (len(servers), code), *[server[i] 
+                if i != 1 else rank[server[i]] for server in servers]))
+        chunks.extend(encoded)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_name = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(''.join(chunks))
+            os.rename(tmp_name, path)
+        except:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+
+def expand_paths(paths, pattern='*.cfg'):
+    """ Expand a list of files, directories and glob patterns
+    to a sorted list of unique config file names """
+    result = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    if fnmatch.fnmatch(name, pattern):
+                        result.add(os.path.join(root, name))
+
+        elif os.path.exists(path):
+            result.add(path)
+
+        else:
+            matches = glob.glob(path)
+            if not matches:
+                # keep it so that the missing file is reported as an error
+                result.add(path)
+            result.update(expand_paths(matches, pattern))
+
+    return sorted(result)
+
+def check_file(file_name, select=None, exclude=None, cache=None, profile=False,
+        timeout=None):
+    """ Parse and validate a single config file. Never raises. 
+    If `profile` is true the result carries a Profile. """
+    profile = Profile() if profile else None
+    start = time.time()
+    try:
+        if cache is None:
+            cfg = ZooCfg.from_file(file_name)
+        else:
+            with open(file_name, 'rb') as f:
+                content = f.read()
+
+            key = cache.key(content, select, exclude)
+            result = cache.get(key)
+            io = result is not None and ResultCache.io_rules(select, exclude)
+            if io:
+                # only the I/O rules run, on the stored values when possible
+                inputs = result.inputs if result.inputs is not None else ZooCfg(content)
+                order = dict((id, i) for i, id in enumerate(RuleRegistry.ids()))
+                findings = result.findings + \
+                    Rules.check_all(inputs, io, timeout=timeout).findings
+                result = RulesResult.from_findings(sorted(findings,
+                    key=lambda finding: order.get(finding.rule, -1)), cached=True)
+            if result is not None:
+                if profile is not None:
+                    profile.add('cache.hit', time.time() - start)
+                    result.profile = profile
+                return file_name, result
+            cfg = ZooCfg(content)
+
+    except (IOError, OSError, ValueError), e:
+        return file_name, RulesResult([], ['Unable to load config file: %s' % e],
+            profile=profile)
+
+    if profile is not None:
+        profile.add('parse', time.time() - start)
+        try:
+            profile.timed('get_servers', cfg.get_servers)()
+        except ValueError:
+            pass # reported by the rules
+
+    result = Rules.check_all(cfg, select, exclude, profile, timeout)
+    result.profile = profile
+    if cache is not None:
+        try:
+            cache.put(key, result, cfg)
+        except (IOError, OSError):
+            pass # the cache is only an optimization
+    return file_name, result
+
+def _check_file_args(args):
+    return check_file(*args)
+
+def check_files(file_names, jobs=None, select=None, exclude=None, cache=None,
+        profile=False, timeout=None):
+    """ Parse and validate many config files using a pool of worker
+    processes. Yields (file_name, RulesResult) pairs in input order. """
+    file_names = list(file_names)
+    RuleRegistry.select(select, exclude) # fail early on unknown rule ids
+    if jobs is None:
+        jobs = cpu_count()
+    jobs = max(1, min(jobs, len(file_names)))
+
+    if jobs == 1:
+        for file_name in file_names:
+            yield check_file(file_name, select, exclude, cache, profile, timeout)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # large chunks amortize the IPC cost over many small files
+        chunksize = max(1, len(file_names) // (jobs * 4))
+        args = ((file_name, select, exclude, cache, profile, timeout)
+            for file_name in file_names)
+        for item in pool.imap(_check_file_args, args, chunksize):
+            yield item
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def print_result(check, show_warnings):
+    """ Print the warnings and errors of a single check. Returns the exit code. """
     ret = 0
-    if check.has_warnings() and opts.warnings is True:
+    if check.has_warnings() and show_warnings is True:
         print 'Warnings:'
         for warning in check.warnings: print '* %s\n' % warning
         ret = 1
@@ -477,6 +3699,980 @@ def main(argv):
 
     return ret
 
+class JSONReporter(object):
+    """ Stream check results as JSON
+
+    Each file is written as soon as its result is reported, so memory 
+    stays bounded however many files are checked. With `lines` every 
+    file is a JSON object on its own line (NDJSON), otherwise the 
+    objects are the items of a single JSON array closed by `close()`. """
+
+    def __init__(self, out, lines=True):
+        self.out = out
+        self.lines = lines
+        self.count = 0
+
+    def report(self, file_name, check, show_warnings=False):
+        """ Write the result of a file and return the exit code """
+        import json
+        record = json.dumps({
+            'file': file_name,
+            'cached': check.cached,
+            'warnings': check.count(Finding.WARNING),
+            'errors': check.count(Finding.ERROR),
+            'findings': [finding.as_dict() for finding in check.findings
+                if show_warnings or finding.severity == Finding.ERROR],
+        }, sort_keys=True)
+
+        if self.lines:
+            self.out.write(record + '\n')
+        else:
+            self.out.write((self.count and ',\n' or '[\n') + record)
+        self.out.flush()
+        self.count += 1
+
+        if check.has_errors():
+            return 2
+        return show_warnings and check.has_warnings() and 1 or 0
+
+    def close(self):
+        if not self.lines:
+            self.out.write(self.count and '\n]\n' or '[]\n')
+            self.out.flush()
+
+class Watcher(object):
+    """ Follow config files and directories and revalidate files on change
+
+    Uses inotify through libc when available and falls back to polling
+    the mtime and size of the files. Bursts of events are coalesced until
+    nothing changes for `settle` seconds. Parsed configs are kept in 
+    memory and revalidated with `Rules.check_incremental`. """
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+
+    _MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self, paths, pattern='*.cfg', interval=1.0, settle=0.05,
+            select=None, exclude=None, use_inotify=True, timeout=None):
+        self.paths = list(paths)
+        self.pattern = pattern
+        self.interval = interval
+        self.settle = settle
+        self.select = select
+        self.exclude = exclude
+        self.timeout = timeout
+
+        self.configs = {}
+        self._roots = tuple(os.path.join(path, '') 
+            for path in self.paths if os.path.isdir(path))
+        self._stats = self._stat_all()
+        self._files = set(self._stats)
+
+        self._fd, self._wds = None, {}
+        if use_inotify:
+            self._init_inotify()
+
+    @property
+    def files(self):
+        return sorted(self._files)
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def check(self, file_name):
+        """ Reparse a file and rerun the rules affected by the change """
+        try:
+            new = ZooCfg.from_file(file_name)
+        except (IOError, OSError, ValueError), e:
+            self.configs.pop(file_name, None)
+            return RulesResult([], ['Unable to load config file: %s' % e])
+
+        cfg = self.configs.get(file_name)
+        if cfg is None:
+            cfg = self.configs[file_name] = new
+        else:
+            for key in [key for key in cfg if key not in new]:
+                del cfg[key]
+            for key, value in new.iteritems():
+                if key not in cfg or cfg[key] != value:
+                    cfg[key] = value
+            cfg._lines = new._lines
+
+        return Rules.check_incremental(cfg, self.select, self.exclude,
+            timeout=self.timeout)
+
+    def changes(self, timeout=None):
+        """ Wait for changes and return the set of changed files. 
+        Returns an empty set if nothing changed before the timeout. """
+        if self._fd is not None:
+            return self._wait_inotify(timeout)
+        return self._wait_polling(timeout)
+
+    def run(self, report):
+        """ Check all the files and then check again each changed file
+        until interrupted. Calls `report(file_name, result)`. """
+        for file_name in self.files:
+            report(file_name, self.check(file_name))
+
+        while True:
+            for file_name in sorted(self.changes()):
+                report(file_name, self.check(file_name))
+
+    def _is_watched(self, path):
+        if path in self._files:
+            return True
+        return path.startswith(self._roots) and \
+            fnmatch.fnmatch(os.path.basename(path), self.pattern)
+
+    def _stat_all(self):
+        result = {}
+        for file_name in expand_paths(self.paths, self.pattern):
+            try:
+                st = os.stat(file_name)
+                result[file_name] = (st.st_mtime, st.st_size, st.st_ino)
+            except OSError:
+                pass
+        return result
+
+    def _rescan(self):
+        stats = self._stat_all()
+        changed = set(name for name, st in stats.iteritems() 
+            if self._stats.get(name) != st)
+        changed.update(set(self._stats) - set(stats))
+
+        self._stats = stats
+        self._files.update(stats)
+        return changed
+
+    def _wait_polling(self, timeout):
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            changed = self._rescan()
+            if changed:
+                while True: # coalesce a burst of writes
+                    time.sleep(self.settle)
+                    more = self._rescan()
+                    if not more:
+                        return changed
+                    changed.update(more)
+
+            if deadline and time.time() >= deadline:
+                return changed
+            time.sleep(self.interval if not deadline else 
+                max(0, min(self.interval, deadline - time.time())))
+
+    def _init_inotify(self):
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (ImportError, OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+
+        self._fd = fd
+        directories = set(os.path.dirname(name) for name in self._files)
+        for path in self.paths:
+            if os.path.isdir(path):
+                directories.update(root for root, _, _ in os.walk(path))
+        for directory in directories:
+            self._watch(directory)
+
+    def _watch(self, directory):
+        wd = self._add_watch(self._fd, directory or '.', self._MASK)
+        if wd >= 0:
+            self._wds[wd] = directory
+
+    def _wait_inotify(self, timeout):
+        changed = set()
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            if changed:
+                wait = self.settle
+            elif deadline:
+                wait = max(0, deadline - time.time())
+            else:
+                wait = None
+
+            if not select.select([self._fd], [], [], wait)[0]:
+                self._files.update(changed)
+                for file_name in changed:
+                    try:
+                        st = os.stat(file_name)
+                        self._stats[file_name] = (st.st_mtime, st.st_size, st.st_ino)
+                    except OSError:
+                        self._stats.pop(file_name, None)
+                return changed
+
+            changed.update(self._read_events())
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+
+        changed, offset = set(), 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                changed.update(self._rescan())
+                continue
+
+            if wd not in self._wds:
+                continue
+            path = os.path.join(self._wds[wd], name)
+
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and \
+                        path.startswith(self._roots):
+                    for root, _, files in os.walk(path):
+                        self._watch(root)
+                        changed.update(os.path.join(root, f) for f in files
+                            if fnmatch.fnmatch(f, self.pattern))
+
+            elif self._is_watched(path):
+                changed.add(path)
+        return changed
+
+def watch(paths, show_warnings, select=None, exclude=None, timeout=None):
+    """ Run the watch mode until interrupted """
+    watcher = Watcher(paths, select=select, exclude=exclude, timeout=timeout)
+
+    def report(file_name, check):
+        print '%s: %d warning(s), %d error(s)' % (file_name, 
+            check.count(Finding.WARNING), check.count(Finding.ERROR))
+        print_result(check, show_warnings)
+        sys.stdout.flush()
+
+    try:
+        watcher.run(report)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+class DaemonStats(object):
+    """ Thread safe request counters of the validation daemon """
+
+    def __init__(self):
+        import threading
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = self.failures = 0
+        self.total_latency = self.max_latency = 0.0
+
+    def record(self, latency, failed=False):
+        with self._lock:
+            self.requests += 1
+            self.failures += failed
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+
+    def as_dict(self):
+        with self._lock:
+            uptime = time.time() - self.started
+            return {
+                'requests': self.requests,
+                'failures': self.failures,
+                'uptime': uptime,
+                'rate': self.requests / uptime if uptime else 0.0,
+                'avg_latency': self.total_latency / self.requests 
+                    if self.requests else 0.0,
+                'max_latency': self.max_latency,
+            }
+
+_daemon_server = None
+
+def _daemon_server_class():
+    """ Define the SocketServer classes used by Daemon on first use """
+    global _daemon_server
+    if _daemon_server is not None:
+        return _daemon_server
+
+    import json, SocketServer
+
+    class Handler(SocketServer.StreamRequestHandler):
+
+        def handle(self):
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                response = self.server.owner.process(line)
+                self.wfile.write(json.dumps(response) + '\n')
+                self.wfile.flush()
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+        daemon_threads = True
+
+        def __init__(self, path, owner):
+            SocketServer.UnixStreamServer.__init__(self, path, Handler)
+            self.owner = owner
+
+    _daemon_server = Server
+    return Server
+
+class Daemon(object):
+    """ Long running validation server listening on a Unix socket
+
+    Each request and response is a JSON object on a single line and a
+    connection can be reused for many requests. Requests are one of:
+
+        {"content": "tickTime=2000\\n...", "rules": [...], "exclude": [...]}
+        {"path": "/etc/zookeeper/zoo.cfg"}
+        {"command": "stats"}
+
+    and results look like {"warnings": [...], "errors": [...]}. The 
+    requests are served by a threading SocketServer. """
+
+    def __init__(self, path, timeout=None):
+        Daemon.remove_stale(path)
+        self.timeout = timeout
+        self.stats = DaemonStats()
+        self._server = _daemon_server_class()(path, self)
+
+    @staticmethod
+    def remove_stale(path):
+        """ Unlink the socket left at `path` by a previous run. Raises 
+        IOError when it is not a socket or a daemon still listens. """
+        import socket, stat
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        if not stat.S_ISSOCK(mode):
+            raise IOError, 'Refusing to replace `%s`: not a socket.' % path
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error, e:
+            if e.errno != errno.ECONNREFUSED:
+                raise
+        else:
+            raise IOError, 'A daemon is already listening on `%s`.' % path
+        finally:
+            sock.close()
+        os.unlink(path)
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def serve_forever(self, poll_interval=0.5):
+        self._server.serve_forever(poll_interval)
+
+    def shutdown(self):
+        self._server.shutdown()
+
+    def server_close(self):
+        self._server.server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+    def process(self, line):
+        import json
+        start = time.time()
+        try:
+            request = json.loads(line)
+            if request.get('command') == 'stats':
+                return self.stats.as_dict()
+
+            select, exclude = request.get('rules'), request.get('exclude')
+            if 'content' in request:
+                cfg = ZooCfg(request['content'].encode('utf-8'))
+            else:
+                cfg = ZooCfg.from_file(request['path'])
+            check = Rules.check_all(cfg, select, exclude, timeout=self.timeout)
+
+        except Exception, e:
+            self.stats.record(time.time() - start, failed=True)
+            return {'error': str(e)}
+
+        self.stats.record(time.time() - start)
+        return {'warnings': check.warnings, 'errors': check.errors,
+            'findings': [finding.as_dict() for finding in check.findings]}
+
+class DaemonClient(object):
+    """ Persistent connection to a validation daemon """
+
+    def __init__(self, path):
+        import socket
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._rfile = self._sock.makefile('rb')
+
+    def close(self):
+        self._rfile.close()
+        self._sock.close()
+
+    def request(self, **kwargs):
+        import json
+        self._sock.sendall(json.dumps(kwargs) + '\n')
+        line = self._rfile.readline()
+        if not line:
+            raise IOError, 'Connection closed by the daemon.'
+        return json.loads(line)
+
+    def check(self, content=None, path=None, select=None, exclude=None):
+        """ Validate a config content or file. Returns a RulesResult. """
+        kwargs = {'rules': select, 'exclude': exclude}
+        if content is not None:
+            kwargs['content'] = content
+        else:
+            kwargs['path'] = path
+
+        response = self.request(**kwargs)
+        if 'error' in response:
+            raise ValueError, response['error']
+        return RulesResult.from_findings([Finding.from_dict(item) 
+            for item in response['findings']])
+
+    def stats(self):
+        return self.request(command='stats')
+
+def parse_identities(values):
+    """ Parse `NAME=ID@HOST` values, ID or @HOST being optional, into a
+    dict of NAME -> (ID, HOST) as used by Ensemble.from_files """
+    identities = {}
+    for value in values or ():
+        match = re.match(r'^([^=]+)=(\d*)(?:@(.+))?$', value)
+        if match is None or not (match.group(2) or match.group(3)):
+            raise ValueError, 'Invalid member: `%s`. Expected NAME=ID@HOST.' % value
+        name, myid, host = match.groups()
+        identities[name] = (myid and int(myid) or None, host)
+    return identities
+
+def check_ensembles(paths, identities=None):
+    """ Check each directory or glob pattern as a separate ensemble. 
+    Yields (name, RulesResult) pairs. """
+    for path in paths:
+        try:
+            ensemble = Ensemble.from_files(expand_paths([path]), path, identities)
+        except (IOError, OSError, ValueError), e:
+            yield path, RulesResult([], ['Unable to load config file: %s' % e])
+            continue
+        yield path, ensemble.check()
+
+def for_each_config(file_names, report):
+    """ Load each config file and call `report(file_name, cfg)`, which
+    prints and returns an exit code. Files that can't be loaded are 
+    reported as an error, like when checking them. Returns the worst 
+    exit code. """
+    ret = 0
+    for file_name in file_names:
+        try:
+            cfg = ZooCfg.from_file(file_name)
+        except (IOError, OSError, ValueError), e:
+            print '%s:' % file_name
+            ret = max(ret, print_result(RulesResult([], 
+                ['Unable to load config file: %s' % e]), False))
+            continue
+        ret = max(ret, report(file_name, cfg))
+    return ret
+
+def print_plan(plan):
+    """ Print the changes and the restart steps. Returns the exit code. """
+    by_category = plan.diff.by_category()
+    for category in sorted(by_category):
+        print '%s:' % category
+        for change in by_category[category]:
+            print '  %s: %s -> %s' % (change.key, 
+                change.old is None and '(unset)' or change.old,
+                change.new is None and '(unset)' or change.new)
+
+    if not plan.steps:
+        print 'No restart needed.'
+        return 0
+
+    print 'Restart plan:'
+    for i, step in enumerate(plan.steps):
+        print '  %d. %s server.%d (%s), %d member(s) up%s' % (i + 1, 
+            step.action, step.server, step.role, step.up, 
+            not step.safe and ', QUORUM LOST' or '')
+    print 'Estimated unavailability: %.1fs of %.1fs' % \
+        (plan.unavailability / 1000.0, plan.duration / 1000.0)
+    return not plan.safe and 1 or 0
+
+def print_simulation(file_name, simulator, runs):
+    result = simulator.run(runs)
+    print '%s:' % file_name
+    print '  commit latency: p50 %.2fms, p99 %.2fms' % \
+        (result['commit_p50'], result['commit_p99'])
+    print '  election time: p50 %.1fms, p99 %.1fms' % \
+        (result['election_p50'], result['election_p99'])
+    print '  follower timeouts %.3f%%, quorum lost %.3f%% (%d runs)' % \
+        (result['follower_timeout'] * 100, result['quorum_loss'] * 100, runs)
+    check = simulator.advise(result)
+    print_result(check, True)
+    return check.has_warnings() and 1 or 0
+
+def print_scan(file_name, scanner):
+    summary = scanner.scan().summary()
+    print '%s:' % file_name
+    for snapshot in scanner.snapshots:
+        print '  %s: zxid 0x%x, %.1fMB' % (snapshot.name, snapshot.zxid, 
+            snapshot.size / float(1 << 20))
+    for log in scanner.logs:
+        print '  %s: %d txn(s), zxid 0x%x-0x%x, %.1fMB of %.1fMB used' % (log.name, 
+            log.count, log.first_zxid, log.last_zxid or log.first_zxid, 
+            log.used / float(1 << 20), log.size / float(1 << 20))
+    print '  %d txn(s) in %d log(s), %.1f%% of the preallocated space used' % \
+        (summary['txns'], summary['logs'], summary['prealloc_used'] * 100)
+    if summary['span']:
+        print '  %.1f txn/s, %.1fKB/s of txn log growth' % \
+            (summary['write_rate'], summary['growth'] / 1024)
+    if summary['snapshot_size']:
+        recommended = scanner.recommend()
+        print '  recommended: %sheap %dMB' % ('snapCount' in recommended and 
+            'snapCount=%d ' % recommended['snapCount'] or '', recommended['heap'])
+    return print_result(RulesResult(scanner.findings, []), True)
+
+def print_advice(file_name, advisor):
+    estimate = advisor.estimate()
+    print '%s:' % file_name
+    print '  snapshot every %.1fs, %.1f%% of disk writes' % \
+        (estimate['snapshot_interval'], estimate['snapshot_fraction'] * 100)
+    print '  txn log %.1fKB/s, extended %.2f times per second' % \
+        (estimate['log_bandwidth'] / 1024, estimate['preallocs_per_second'])
+    recommended = advisor.recommend()
+    print '  recommended: snapCount=%d preAllocSize=%d' % \
+        (recommended['snapCount'], recommended['preAllocSize'])
+    check = advisor.advise()
+    print_result(check, True)
+    return check.has_warnings() and 1 or 0
+
+def print_probe(file_name, probe):
+    result = probe.run()
+    print '%s:' % file_name
+    print '  preallocated %dKB in %.1fms' % (result['prealloc_size'], 
+        result['prealloc'])
+    print '  fsync of %d byte appends: p50 %.2fms, p99 %.2fms, max %.2fms '\
+        '(%d samples)' % (probe.txn_size, result['p50'], result['p99'], 
+        result['max'], result['samples'])
+    check = probe.advise(result)
+    print_result(check, True)
+    return check.has_warnings() and 1 or 0
+
+def print_reachability(file_name, probe):
+    endpoints = probe.run()
+    print '%s:' % file_name
+    for endpoint in endpoints:
+        print '  %-24s %s:%d %s' % (endpoint.name, endpoint.host, endpoint.port,
+            endpoint.reachable and '%.1fms' % endpoint.latency or endpoint.error)
+    check = probe.advise(endpoints)
+    print_result(check, True)
+    return check.has_warnings() and 1 or 0
+
+def print_live(file_name, probe, members):
+    print '%s:' % file_name
+    for member in members:
+        if not member.reachable:
+            print '  %-12s %s:%d %s' % (member.name, member.host, member.port,
+                member.errors.get('conf'))
+            continue
+        status = probe.status(member)
+        print '  %-12s %s:%d %s, latency avg %s max %s, %s outstanding, '\
+            '%s connection(s)' % (member.name, member.host, member.port, 
+            status['mode'] or 'unknown', status['latency_avg'], 
+            status['latency_max'], status['outstanding'], status['connections'])
+    return print_result(probe.advise(members), True)
+
+def _simple_args(argv):
+    """ Return (file names, show warnings) when the arguments are only
+    files, `-f FILE` and `-w`, else None """
+    file_names, warnings, args = [], False, iter(argv)
+    for arg in args:
+        if arg in ('-w', '--warnings'):
+            warnings = True
+        elif arg in ('-f', '--file'):
+            file_name = next(args, None)
+            if file_name is None:
+                return None
+            file_names.append(file_name)
+        elif arg.startswith('-'):
+            return None
+        else:
+            file_names.append(arg)
+    return file_names, warnings
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # checking one file is the usual call: it skips optparse, whose 
+    # import takes longer than the check
+    simple = _simple_args(argv)
+    if simple is not None:
+        file_names = expand_paths(simple[0])
+        if len(file_names) == 1:
+            return print_result(check_file(file_names[0])[1], simple[1])
+
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [FILE|DIR|GLOB ...]')
+
+    parser.add_option('-f', '--file', dest='filenames', default=[],
+        action='append', help="ZooKeeper config FILE. Can be repeated.",
+        metavar="FILE")
+
+    parser.add_option('-w', '--warnings', dest='warnings',
+        default=False, action='store_true', 
+        help='show warnings. defaults to false')
+
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+        default=None, help='number of worker processes used when checking '
+        'many files. defaults to the number of cores', metavar='N')
+
+    parser.add_option('-r', '--rules', dest='select', default=None,
+        help='comma separated list of rule ids to check. '
+        'defaults to all the rules', metavar='IDS')
+
+    parser.add_option('-x', '--exclude', dest='exclude', default=None,
+        help='comma separated list of rule ids to skip', metavar='IDS')
+
+    parser.add_option('--cache', dest='cache', default=None,
+        help='cache validation results in DIR', metavar='DIR')
+
+    parser.add_option('--cache-size', dest='cache_size', type='int',
+        default=10000, help='maximum number of cached results. '
+        'defaults to 10000', metavar='N')
+
+    parser.add_option('--watch', dest='watch', default=False,
+        action='store_true', help='check the files again each time '
+        'they change. runs until interrupted')
+
+    parser.add_option('--daemon', dest='daemon', default=None,
+        help='serve validation requests on the Unix socket PATH',
+        metavar='PATH')
+
+    parser.add_option('-e', '--ensemble', dest='ensemble', default=False,
+        action='store_true', help='check that the files found in each '
+        'DIR or GLOB argument agree with each other')
+
+    parser.add_option('--member', dest='members', default=[], action='append',
+        help='myid and host of the member whose config file, or its '
+        'directory, is NAME. used by -e and --diff when there is no myid '
+        'file next to the config. Can be repeated.', metavar='NAME=ID@HOST')
+
+    parser.add_option('--profile', dest='profile', default=False,
+        action='store_true', help='print the time spent parsing and '
+        'in each rule to stderr')
+
+    parser.add_option('--profile-output', dest='profile_output', default=None,
+        help='write the profile as JSON to FILE', metavar='FILE')
+
+    parser.add_option('--workload', dest='workload', default=None,
+        help='estimate the snapshot and txn log disk usage for a workload '
+        'and recommend snapCount and preAllocSize. Sizes accept K, M and G '
+        'suffixes', metavar='RATE,TXN_SIZE,SNAPSHOT_SIZE[,DISK_BANDWIDTH]')
+
+    parser.add_option('--snapshot-target', dest='snapshot_target', type='float',
+        default=0.1, help='maximum fraction of the disk writes used by '
+        'snapshots. defaults to 0.1', metavar='FRACTION')
+
+    parser.add_option('--probe-disk', dest='probe_disk', default=False,
+        action='store_true', help='measure the fsync latency of txn log '
+        'appends in dataLogDir. writes up to preAllocSize KB, 64MB at most')
+
+    parser.add_option('--probe-network', dest='probe_network', default=False,
+        action='store_true', help='connect to the quorum, election and '
+        'client ports of every server and report the connect time')
+
+    parser.add_option('--probe-live', dest='probe_live', default=False,
+        action='store_true', help='ask every server for its running config '
+        'and state (conf, srvr and mntr) and report the values that drifted '
+        'from the file')
+
+    parser.add_option('--probe-timeout', dest='probe_timeout', type='float',
+        default=1.0, help='timeout of each connection used by --probe-network '
+        'and --probe-live. defaults to 1 second', metavar='SECONDS')
+
+    parser.add_option('--format', dest='format', default='text',
+        type='choice', choices=('text', 'json', 'ndjson'),
+        help='output format: text, json or ndjson (one JSON object per '
+        'file and line). defaults to text', metavar='FORMAT')
+
+    parser.add_option('--diff', dest='diff', default=False,
+        action='store_true', help='compare the OLD and NEW config files, or '
+        'the ensembles found in the OLD and NEW directories or globs, and '
+        'plan a rolling restart')
+
+    parser.add_option('--leader', dest='leader', type='int', default=None,
+        help='id of the current leader used by --diff. defaults to the '
+        'participant with the highest id', metavar='ID')
+
+    parser.add_option('--simulate', dest='simulate', default=None,
+        help='simulate commit latency, follower timeouts and elections '
+        'for links with a log-normal round trip time of MEDIAN ms',
+        metavar='MEDIAN[,SIGMA[,FSYNC]]')
+
+    parser.add_option('--runs', dest='runs', type='int', default=10000,
+        help='number of scenarios simulated by --simulate. '
+        'defaults to 10000', metavar='N')
+
+    parser.add_option('--scan-data', dest='scan_data', default=False,
+        action='store_true', help='read the snapshots and txn logs in '
+        'dataDir and dataLogDir and recommend snapCount and a heap size')
+
+    parser.add_option('--plugins', dest='plugins', default=False,
+        action='store_true', help='also check the rules of the installed '
+        'rule packs (zoocfg.rules entry points). Packs are loaded anyway '
+        'when -r or -x name an unknown rule')
+
+    parser.add_option('--rule-timeout', dest='rule_timeout', type='float',
+        default=None, help='give up on rules doing I/O after SECONDS. '
+        'defaults to %s' % Rules.TIMEOUT, metavar='SECONDS')
+
+    parser.add_option('--index', dest='index', default=None,
+        help='parse the config files into the fleet index FILE, again only '
+        'the files that changed since the last run', metavar='FILE')
+
+    parser.add_option('--query', dest='query', default=None,
+        help='print the files of the --index matching all the conditions, '
+        'for example "snapCount<5000,skipACL=yes" or "host=zk1,port=2888"',
+        metavar='KEY<OP>VALUE,...')
+
+    (opts, args) = parser.parse_args(argv)
+
+    select = opts.select and opts.select.split(',')
+    exclude = opts.exclude and opts.exclude.split(',')
+    try:
+        if opts.plugins:
+            RuleRegistry.load_plugins()
+        try:
+            RuleRegistry.select(select, exclude)
+        except ValueError:
+            RuleRegistry.load_plugins() # the ids may belong to a rule pack
+            RuleRegistry.select(select, exclude)
+    except Exception, e:
+        print >>sys.stderr, e
+        return -1
+
+    if opts.daemon is not None:
+        try:
+            server = Daemon(opts.daemon, opts.rule_timeout)
+        except (IOError, OSError), e:
+            print >>sys.stderr, e
+            return -1
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    if opts.diff:
+        paths = opts.filenames + args
+        if len(paths) != 2:
+            print >>sys.stderr, 'Two configs are needed: OLD and NEW.'
+            return -1
+        try:
+            if all(os.path.isfile(path) for path in paths):
+                plan = RestartPlan(ZooCfg.from_file(paths[0]), 
+                    ZooCfg.from_file(paths[1]), opts.leader)
+            else:
+                identities = parse_identities(opts.members)
+                plan = RestartPlan.from_ensembles(*[Ensemble.from_files(
+                    expand_paths([path]), path, identities) for path in paths], 
+                    leader=opts.leader)
+        except (IOError, OSError, ValueError), e:
+            print >>sys.stderr, e
+            return -1
+        return print_plan(plan)
+
+    if opts.index is not None:
+        paths = opts.filenames + args
+        try:
+            if paths or opts.query is None:
+                stats = FleetIndex.update(opts.index, expand_paths(paths))
+                print >>opts.query and sys.stderr or sys.stdout, 'Indexed %d file(s) '\
+                    'in %s: %d parsed, %d unchanged, %d removed, %d failed' % \
+                    (stats['parsed'] + stats['unchanged'], opts.index, stats['parsed'], 
+                    stats['unchanged'], stats['removed'], stats['failed'])
+            if opts.query is not None:
+                index = FleetIndex(opts.index)
+                try:
+                    for file_name in index.query(opts.query):
+                        print file_name
+                finally:
+                    index.close()
+        except (IOError, OSError, ValueError), e:
+            print >>sys.stderr, e
+            return -1
+        return 0
+
+    if opts.query is not None:
+        print >>sys.stderr, 'The --query option needs an --index.'
+        return -1
+
+    file_names = expand_paths(opts.filenames + args)
+    if not file_names:
+        print >>sys.stderr, "Config file name is mandatory."
+
+        parser.print_help()
+        return -1
+
+    if opts.watch:
+        return watch(opts.filenames + args, opts.warnings, select, exclude,
+            opts.rule_timeout)
+
+    if opts.workload is not None:
+        try:
+            workload = Workload.parse(opts.workload)
+            return for_each_config(file_names, lambda file_name, cfg: print_advice(
+                file_name, DiskAdvisor(cfg, workload, opts.snapshot_target)))
+        except ValueError, e:
+            print >>sys.stderr, e
+            return -1
+
+    if opts.probe_disk:
+        try:
+            return for_each_config(file_names, lambda file_name, cfg: 
+                print_probe(file_name, DiskProbe(cfg)))
+        except (ValueError, OSError), e:
+            print >>sys.stderr, e
+            return -1
+
+    if opts.probe_network:
+        try:
+            return for_each_config(file_names, lambda file_name, cfg: 
+                print_reachability(file_name, ReachabilityProbe(cfg, opts.probe_timeout)))
+        except ValueError, e:
+            print >>sys.stderr, e
+            return -1
+
+    if opts.probe_live:
+        probes = []
+        def add(file_name, cfg):
+            probe = LiveProbe(cfg, opts.probe_timeout)
+            probes.append((file_name, probe, probe.members()))
+            return 0
+        try:
+            ret = for_each_config(file_names, add)
+        except ValueError, e:
+            print >>sys.stderr, e
+            return -1
+        if probes: # a single sweep for all the files
+            probes[0][1].run([member for _, _, members in probes for member in members])
+        for file_name, probe, members in probes:
+            ret = max(ret, print_live(file_name, probe, members))
+        return ret
+
+    if opts.simulate is not None:
+        try:
+            values = [float(value) for value in opts.simulate.split(',')]
+            if not 1 <= len(values) <= 3 or min(values) < 0 or not values[0]:
+                raise ValueError, 'Invalid link latency: %s' % opts.simulate
+            default, fsync = tuple((values + [0.5])[:2]), (values + [0.5, 0.0])[2]
+            return for_each_config(file_names, lambda file_name, cfg: print_simulation(
+                file_name, QuorumSimulator(cfg, default=default, fsync=fsync), opts.runs))
+        except ValueError, e:
+            print >>sys.stderr, e
+            return -1
+
+    if opts.scan_data:
+        try:
+            return for_each_config(file_names, lambda file_name, cfg: 
+                print_scan(file_name, DataScanner(cfg)))
+        except (IOError, OSError, ValueError), e:
+            print >>sys.stderr, e
+            return -1
+
+    if opts.ensemble:
+        ret = 0
+        try:
+            identities = parse_identities(opts.members)
+        except ValueError, e:
+            print >>sys.stderr, e
+            return -1
+        for name, check in check_ensembles(opts.filenames + args, identities):
+            print '%s: %d warning(s), %d error(s)' % (name, 
+                check.count(Finding.WARNING), check.count(Finding.ERROR))
+            ret = max(ret, print_result(check, opts.warnings))
+        return ret
+
+    cache = None
+    if opts.cache is not None:
+        cache = ResultCache(opts.cache, opts.cache_size)
+
+    reporter = None
+    if opts.format != 'text':
+        reporter = JSONReporter(sys.stdout, opts.format == 'ndjson')
+
+    profiling = opts.profile or opts.profile_output is not None
+    if len(file_names) == 1 and cache is None and not profiling and reporter is None:
+        return print_result(check_file(file_names[0], select, exclude,
+            timeout=opts.rule_timeout)[1], opts.warnings)
+
+    ret, counts, hits, profile = 0, {0: 0, 1: 0, 2: 0}, 0, Profile()
+    for file_name, check in check_files(file_names, opts.jobs, select, 
+            exclude, cache, profiling, opts.rule_timeout):
+        if reporter is not None:
+            ret = max(ret, reporter.report(file_name, check, opts.warnings))
+        elif len(file_names) == 1:
+            ret = print_result(check, opts.warnings)
+        else:
+            print '%s: %d warning(s), %d error(s)' % (file_name, 
+                check.count(Finding.WARNING), check.count(Finding.ERROR))
+            ret = max(ret, print_result(check, opts.warnings))
+        counts[check.has_errors() and 2 or check.has_warnings() and 1 or 0] += 1
+        hits += check.cached
+        if check.profile is not None:
+            profile.merge(check.profile)
+
+    if reporter is not None:
+        reporter.close()
+    elif len(file_names) > 1:
+        print 'Checked %d files: %d ok, %d with warnings, %d with errors' % \
+            (len(file_names), counts[0], counts[1], counts[2])
+
+    if cache is not None:
+        # hits are counted here because the workers own their cache copies
+        print >>sys.stderr, 'Cache: %d hit(s), %d miss(es)' % \
+            (hits, len(file_names) - hits)
+        if hits < len(file_names): # only new entries grow the cache
+            cache.evict()
+
+    if opts.profile:
+        profile.report(sys.stderr)
+
+    if opts.profile_output is not None:
+        import json
+        with open(opts.profile_output, 'w') as f:
+            json.dump(profile.as_dict(), f, indent=2, sort_keys=True)
+
+    return ret
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
-